@@ -0,0 +1,51 @@
+'''
+Measures the time spent in each stage of the instrumentation of the Rodinia kernels
+(or of the OpenCL files under the directories provided as arguments), in total and per
+thousand lines of (preprocessed) source code, to track how the instrumentation scales with the size of the kernels.
+
+Usage: python benchmarks/instrumentation_stages.py [-r REPEATS] [DIR ...]
+'''
+import os
+import sys
+import argparse
+import tempfile
+from glob import glob
+from collections import defaultdict
+
+from oclude.utils import instrument_file
+from oclude.utils.parsedunit import preprocess_file
+
+rodinia_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'rodinia_kernels')
+
+parser = argparse.ArgumentParser(description='Per-stage timing of the oclude instrumentation')
+parser.add_argument('dirs', nargs='*', default=[rodinia_dir], help='directories to look for OpenCL files in')
+parser.add_argument('-r', '--repeats', type=int, default=3, help='times to instrument each file (default: 3)')
+args = parser.parse_args()
+
+files = sorted(f for d in args.dirs for f in glob(os.path.join(d, '**', '*.cl'), recursive=True))
+
+totals = defaultdict(float)
+total_lines = 0
+with tempfile.TemporaryDirectory() as tmpdir:
+    output_file = os.path.join(tmpdir, 'instr.cl')
+    for file in files:
+        lines = preprocess_file(file).count('\n')
+        total_lines += lines
+        timings = {}
+        for _ in range(args.repeats):
+            # without the cache, every repeat goes through all the stages
+            instrument_file(file, False, output_file=output_file, timings=timings, use_cache=False)
+        elapsed = sum(timings.values()) / args.repeats
+        print(f'{os.path.relpath(file)} ({lines} lines, {elapsed * 1000:.1f}ms, {elapsed * 1e6 / lines:.1f}ms/kLOC): ' +
+              ', '.join(f'{k} {v / args.repeats * 1000:.1f}ms' for k, v in timings.items()),
+              file=sys.stderr)
+        for stage, elapsed in timings.items():
+            totals[stage] += elapsed / args.repeats
+
+total = sum(totals.values())
+kloc = total_lines / 1000
+print(f'Time per stage over {len(files)} files, {total_lines} lines (average of {args.repeats} runs):')
+print(f'{"ms":>12} {"ms/kLOC":>12}')
+for stage, elapsed in totals.items():
+    print(f'{elapsed * 1000:12.1f} {elapsed * 1000 / kloc:12.1f} - {stage} ({100 * elapsed / total:.1f}%)')
+print(f'{total * 1000:12.1f} {total * 1000 / kloc:12.1f} - total')
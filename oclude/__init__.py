@@ -1,11 +1,18 @@
-from oclude.utils import profile_opencl_device
+from oclude.utils import profile_opencl_device, query_results
 from oclude.oclude import (
     profile_opencl_kernel,
+    profile_opencl_roofline,
+    instrument_many,
+    list_kernels,
     get_opencl_kernel_static_instcounts
 )
 
 __all__ = [
     'profile_opencl_device',
+    'query_results',
     'profile_opencl_kernel',
+    'profile_opencl_roofline',
+    'instrument_many',
+    'list_kernels',
     'get_opencl_kernel_static_instcounts'
 ]
@@ -3,10 +3,17 @@ import os
 from functools import reduce
 from collections import Counter
 import operator
+import json
+from time import time
+import queue
+import multiprocessing
+from datetime import datetime
 import timeout_decorator
+import numpy as np
 
 import oclude.utils as utils
-from oclude.utils.constants import llvm_instructions
+from oclude.utils.constants import llvm_instructions, float_ops_counter, default_cache_budget, profiling_result_max_age, \
+                                   forked_process_timeout
 
 # define the arguments of oclude
 parser = argparse.ArgumentParser(
@@ -17,19 +24,40 @@ parser = argparse.ArgumentParser(
 parser.add_argument('command',
     type=str,
     nargs='?',
-    choices=['kernel', 'device'],
+    choices=['kernel', 'device', 'roofline', 'instrument', 'list', 'cache', 'results'],
     help='''oclude supports the following commands:
 
-   kernel    Profile an OpenCL kernel from a given source file
-             (default if <command> is ommited)
-   device    Profile the selected OpenCL device
-             (only -p and -d flags are taken into consideration)''',
+   kernel      Profile an OpenCL kernel from a given source file
+               (default if <command> is ommited)
+   device      Profile the selected OpenCL device
+               (only -p and -d flags are taken into consideration)
+   roofline    Place an OpenCL kernel from a given source file
+               on the roofline of the selected OpenCL device
+   instrument  Instrument (and cache) the given source file or all the
+               source files under the given directory, in parallel
+   list        List the kernels of the given source file or of all the
+               source files under the given directory, in parallel
+   cache       Manage the cache of oclude (see <action>)
+   results     Query the results store (see <action> and --results-db)''',
     default='kernel'
 )
 
+parser.add_argument('action',
+    type=str,
+    nargs='?',
+    choices=['stats', 'query'],
+    help='''the action of the cache and results commands:
+
+   stats       (cache) Report the entries, the size and the hit rate
+               of the cache per artifact type (default)
+   query       (results) List the recorded runs, filtered by
+               -f, -k, -g, -l and --seed (default)''',
+    default=None
+)
+
 parser.add_argument('-f', '--file',
     type=str,
-    help='the *.cl file with the OpenCL kernel(s)'
+    help='the *.cl file with the OpenCL kernel(s) (or, for the instrument command, a directory of *.cl files)'
 )
 
 parser.add_argument('-k', '--kernel',
@@ -80,6 +108,12 @@ parser.add_argument('-i', '--inst-counts',
     action='store_true'
 )
 
+parser.add_argument('-w', '--per-work-group',
+    help='count the LLVM instructions separately for each work group and report load imbalance statistics (implies -i, requires -l)',
+    dest='pergroup',
+    action='store_true'
+)
+
 parser.add_argument('-t', '--time-it',
     help='measure kernel execution time and dump it to stdout',
     dest='timeit',
@@ -92,6 +126,106 @@ parser.add_argument('-x', '--timeout',
     default=30
 )
 
+def seed_type(value):
+    seed = int(value)
+    if seed < 0:
+        raise argparse.ArgumentTypeError(f'the seed must be a non-negative integer, not {value}')
+    return seed
+
+parser.add_argument('--seed',
+    type=seed_type,
+    help='seed the random inputs of the kernel, so that its runs (e.g. their instruction counts) are reproducible',
+    default=None
+)
+
+parser.add_argument('--inputs',
+    type=str,
+    help='a JSON file that maps (some of) the arguments of the kernel to real inputs, i.e. to .npy or raw files\n'
+         '(memory-mapped, not loaded) or to numbers (for scalars), instead of random values',
+    default=None
+)
+
+parser.add_argument('--arg-size',
+    help='the number of elements of a buffer argument, as an expression of gsize and lsize, e.g. temp=gsize*gsize\n'
+         '(may be used multiple times; default: gsize, or as much as fits in local memory for local buffers)',
+    dest='arg_sizes',
+    metavar='NAME=EXPRESSION',
+    action='append',
+    default=None
+)
+
+parser.add_argument('--use-result-cache',
+    help='reuse the cached results of an identical earlier run (same kernel, NDRange, device, seed and samples)\n'
+         'instead of running the kernel again; requires --seed',
+    dest='use_result_cache',
+    action='store_true'
+)
+
+parser.add_argument('--result-max-age',
+    type=float,
+    help='days after which cached execution times are considered stale and are measured again (default: 1)',
+    dest='result_max_age',
+    default=profiling_result_max_age / (24 * 60 * 60)
+)
+
+parser.add_argument('--results-db',
+    type=str,
+    nargs='?',
+    help='record the run in the results store at RESULTS_DB (if omitted: $OCLUDE_RESULTS_DB,\n'
+         'or else ~/.local/share/oclude/results.sqlite); also the store that the results command queries',
+    dest='results_db',
+    const=True,
+    default=None
+)
+
+# roofline flags #
+parser.add_argument('--peaks',
+    type=str,
+    help='a JSON file with the peaks of the selected device (`peak float ops` in GFLOP/s and `peak global bandwidth` in GB/s)\n'
+         'to use for the roofline command, instead of measuring them',
+    default=None
+)
+
+parser.add_argument('--json',
+    type=str,
+    help='a file to dump the roofline record of the kernel (or the runs listed by the results command) to, in JSON format',
+    dest='json_file',
+    default=None
+)
+
+# device flags #
+parser.add_argument('--quick',
+    help='profile the device for a reduced set of transfer sizes (1KB, 1MB and 64MB)',
+    action='store_true'
+)
+
+parser.add_argument('--transfer-sizes',
+    type=int,
+    nargs='+',
+    help='the transfer sizes (in bytes) to measure the bandwidth of the device for (overrides --quick)',
+    dest='transfer_sizes',
+    default=None
+)
+
+parser.add_argument('--refresh',
+    help='profile the device again, even if it has been profiled recently (its profile is cached)',
+    action='store_true'
+)
+
+parser.add_argument('--max-age',
+    type=float,
+    help='days after which the cached profile of a device is considered stale and is measured again (default: 30)',
+    dest='max_age',
+    default=30
+)
+
+# instrument and list flags #
+parser.add_argument('-j', '--workers',
+    type=int,
+    help='the number of processes to instrument (or scan) files with (default: the number of CPUs)',
+    default=None
+)
+
 # cache flags #
 parser.add_argument('--clear-cache',
     help='remove every cached info (irreversible)',
@@ -111,33 +245,223 @@ parser.add_argument('--no-cache-warnings',
     action='store_true'
 )
 
-def get_opencl_kernel_static_instcounts(file, kernel, verbose=False):
+parser.add_argument('--cache-budget',
+    type=float,
+    help=f'MiB that the cache may occupy before its least recently used entries are evicted (default: {default_cache_budget})',
+    dest='cache_budget',
+    default=default_cache_budget
+)
 
-    import tempfile, shutil
-    tempdir = tempfile.gettempdir()
-    tempfile = os.path.join(tempdir, 'oclude_static_thingies.cl')
-    shutil.copy2(file, tempfile)
+def get_opencl_kernel_static_instcounts(file, kernel, verbose=False):
 
-    kernel_instcounts = utils.instrument_file(tempfile, verbose, static_features=True)[kernel]
+    # the input file is only read, as no instrumented source code is written in this case
+    kernel_instcounts = utils.instrument_file(file, verbose, static_features=True, kernel=kernel)[kernel]
     instcounts = dict((i, 0) for i in llvm_instructions)
     for bb in kernel_instcounts:
         for instruction, count in bb:
             if instruction == 'retNOT':
                 instcounts['ret'] -= count
-            else:
+            # bytes moved and float operations are not instructions
+            elif not instruction.endswith(' bytes') and instruction != float_ops_counter:
                 instcounts[instruction] += count
 
-    os.remove(tempfile)
     return instcounts
 
+def run_in_forked_process(function, *args, timeout=forked_process_timeout):
+    '''
+    Runs the provided function in a forked process and returns its result. The kernels are run in forked processes
+    (so that they can be interrupted), in which OpenCL can not be used if their parent has already initialized it,
+    so every other use of OpenCL by the parent has to be moved to a forked process as well.
+    Raises a TimeoutError if the function does not return within `timeout` seconds,
+    and a RuntimeError if the forked process dies (e.g. crashes in the OpenCL driver) before it returns
+    '''
+    # (forked explicitly, as the function need not be picklable)
+    context = multiprocessing.get_context('fork')
+    results = context.Queue(1)
+
+    def run():
+        try:
+            results.put((True, function(*args)))
+        except BaseException as e:
+            results.put((False, e))
+
+    process = context.Process(target=run, daemon=True)
+    process.start()
+    deadline = time() + timeout
+    while True:
+        try:
+            success, result = results.get(timeout=0.1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # the result may have been written just before the process exited
+                try:
+                    success, result = results.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    raise RuntimeError(f'{function.__name__} died in a forked process (exit code: {process.exitcode})')
+            if time() > deadline:
+                process.terminate()
+                raise TimeoutError(f'{function.__name__} did not return within {timeout} seconds')
+    process.join()
+    if not success:
+        raise result
+    return result
+
+def evict_from_cache(cache, cache_budget, interact, no_cache_warnings=False):
+    '''
+    Evicts the least recently used entries of the cache until it fits in `cache_budget` MiB,
+    warning about it (unless `no_cache_warnings` is set)
+    '''
+    evicted, freed = cache.evict(int(cache_budget * 1024 * 1024))
+    if evicted and not no_cache_warnings:
+        interact(f'WARNING: Cache size exceeds its budget of {cache_budget} MiB; '
+                 f'evicted {evicted} least recently used entries ({freed / (1024 * 1024):.2f} MiB)')
+
+def instrument_into_cache(cache, file, verbose=False, kernel=None, use_cache=True):
+    '''
+    Instruments the provided file (or the provided kernel of it) into the cache, unless it is already cached
+    (in any directory of the cache). If another process is instrumenting the same file, it waits for that process
+    and reuses its result instead of instrumenting it again.
+    Returns the path of the instrumented file and whether it was found cached
+    '''
+    instrumented_file = cache.get_name_of_instrumented_file(file, kernel)
+    cached_file = cache.find_artifact(instrumented_file) if use_cache else None
+    if cached_file is None:
+        with cache.lock(instrumented_file):
+            cached_file = cache.find_artifact(instrumented_file) if use_cache else None
+            if cached_file is None:
+                utils.instrument_file(file, verbose, output_file=instrumented_file, kernel=kernel, use_cache=use_cache)
+                cache.add_artifact(instrumented_file)
+    if use_cache:
+        cache.record_access(instrumented_file, cached_file is not None)
+    return cached_file or instrumented_file, cached_file is not None
+
+def instrument_and_cache_files(files, verbose=False):
+    '''
+    Instruments the provided files one after the other, storing the results in the cache.
+    Returns a list of tuples (file, instrumented file, error message or None)
+    '''
+    cache = utils.CachedFiles()
+    results = []
+    for file in files:
+        try:
+            instrumented_file, _ = instrument_into_cache(cache, file, verbose)
+            results.append((file, instrumented_file, None))
+        except SystemExit as e:
+            results.append((file, None, f'instrumentation failed (exit code {e.code})'))
+        except Exception as e:
+            results.append((file, None, f'{e.__class__.__name__}: {e}'))
+    return results
+
+def find_opencl_files(paths, interact):
+    '''
+    Returns the provided OpenCL files, as well as all the *.cl files under the provided directories
+    '''
+    from glob import glob
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(glob(os.path.join(path, '**', '*.cl'), recursive=True))
+        elif os.path.exists(path):
+            files.append(path)
+        else:
+            interact(f'ERROR: Input file {path} does not exist.')
+            exit(1)
+
+    return files
+
+def get_files_kernels(files):
+    '''
+    Returns a list of tuples (file, its kernels or None, error message or None) for the provided files
+    '''
+    cache = utils.CachedFiles()
+    results = []
+    for file in files:
+        try:
+            results.append((file, cache.get_file_kernels(file), None))
+        except Exception as e:
+            results.append((file, None, f'{e.__class__.__name__}: {e}'))
+    return results
+
+def list_kernels(paths, workers=None, verbose=False):
+    '''
+    Lists the kernels of the provided OpenCL files (as well as of all the *.cl files under the provided directories)
+    in parallel, using a pool of `workers` processes (default: the number of CPUs).
+    Returns a dict that maps each file to a list of its kernels, or to None if its kernels could not be found
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    interact = utils.Interactor(__file__.split(os.sep)[-1])
+    interact.set_verbosity(verbose)
+
+    files = find_opencl_files(paths, interact)
+
+    # most files are only scanned, which is too quick to hand them to the workers one by one
+    workers = workers or os.cpu_count()
+    chunks = [files[i::workers] for i in range(workers) if files[i::workers]]
+
+    interact(f'Scanning {len(files)} files for kernels with {workers} workers')
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for chunk_results in executor.map(get_files_kernels, chunks):
+            for file, kernels, error in chunk_results:
+                if error is not None:
+                    interact(f'WARNING: Could not find the kernels of {file}: {error}')
+                results[file] = kernels
+
+    # report the files in the order they were found
+    return dict((file, results[file]) for file in files)
+
+def instrument_many(paths, workers=None, verbose=False):
+    '''
+    Instruments the provided OpenCL files (as well as all the *.cl files under the provided directories)
+    in parallel, using a pool of `workers` processes (default: the number of CPUs), and fills the cache.
+    Returns a dict that maps each file to its instrumented (cached) version, or to None if its instrumentation failed
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    interact = utils.Interactor(__file__.split(os.sep)[-1])
+    interact.set_verbosity(verbose)
+
+    files = find_opencl_files(paths, interact)
+
+    # identical files share the same cache entry; each group of such files is given to a single worker,
+    # which instruments the first one only, instead of having the rest of the workers wait for it
+    cache = utils.CachedFiles()
+    groups = {}
+    for file in files:
+        groups.setdefault(cache.get_name_of_instrumented_file(file), []).append(file)
+
+    # generate the parser tables once, before the workers try to load (or write) them at the same time
+    utils.warm_up_parser()
+
+    interact(f'Instrumenting {len(files)} files with {workers or os.cpu_count()} workers')
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for group_results in executor.map(instrument_and_cache_files, groups.values(), [verbose] * len(groups)):
+            for file, instrumented_file, error in group_results:
+                if error is not None:
+                    interact(f'WARNING: Could not instrument {file}: {error}')
+                results[file] = instrumented_file
+
+    return results
+
 def profile_opencl_kernel(file, kernel,
                           gsize, lsize=None,
                           platform_id=0, device_id=0,
                           samples=1,
                           instcounts=False, timeit=False,
+                          pergroup=False,
                           timeout=30,
                           verbose=False,
-                          clear_cache=False, ignore_cache=False, no_cache_warnings=False):
+                          clear_cache=False, ignore_cache=False, no_cache_warnings=False, cache_budget=default_cache_budget,
+                          seed=None, use_result_cache=False, result_max_age=profiling_result_max_age,
+                          results_db=None, inputs=None, arg_sizes=None):
 
     interact = utils.Interactor(__file__.split(os.sep)[-1])
     interact.set_verbosity(verbose)
@@ -151,53 +475,55 @@ def profile_opencl_kernel(file, kernel,
         interact(f'ERROR: Input file {file} does not exist.')
         exit(1)
 
+    if pergroup and not lsize:
+        interact(f'ERROR: argument -l/--lsize is required for per work group instruction counts')
+        exit(1)
+
+    if pergroup and not instcounts:
+        interact('INFO: Per work group instruction counts were requested; instruction counting is enabled')
+        instcounts = True
+
+    if inputs is not None:
+        try:
+            inputs = utils.load_inputs(inputs)
+        except (OSError, ValueError) as e:
+            interact(f'ERROR: Invalid inputs: {e}')
+            exit(1)
+
+    if arg_sizes:
+        try:
+            arg_sizes = utils.get_arg_sizes(arg_sizes, gsize, lsize)
+        except ValueError as e:
+            interact(f'ERROR: Invalid buffer sizes: {e}')
+            exit(1)
+
     if instcounts and timeit:
         interact('WARNING: Instruction count and execution time measurement were both requested.')
         interact('This will result in the time measurement of the instrumented kernel and not the original.')
 
     ### STEP 1: cache checking (if needed) ###
     ##########################################
-    #   1. was any of the flags below used?
-    #       instcounts: Is the instrumented version of the file cached?
-    #           YES: use it
-    #           NO: go on to instrumentation, remember to cache it when done
-    #       timeit: No need to do something
-    #   2. check if cache knows the file kernels (this whole step should be done transparently, inside cache class)
+    #   1. check if cache knows the file kernels (this whole step should be done transparently, inside cache class)
     #       YES: get them and:
     #           a. user specified a kernel: check if it exists in the file (could fail)
     #           b. user did not specify a kernel: prompt them
     #       NO: find them, and go to YES
+    #   2. was any of the flags below used?
+    #       instcounts: Is the instrumented version of the selected kernel (or of the whole file) cached?
+    #           YES: use it
+    #           NO: go on to instrumentation of the selected kernel only, remember to cache it when done
+    #       timeit: No need to do something
     ##########################################
 
     cache = utils.CachedFiles()
 
-    if cache.size > 10 * 1024 * 1024 and not no_cache_warnings:
-        interact('WARNING: Cache size exceeds 10 MiB, which is a lot. Consider running oclude with `--clear-cache`')
-
     if clear_cache:
         interact('INFO: Clearing cache')
         cache.clear()
-
-    is_cached = False
-    if ignore_cache:
-        interact('INFO: Ignoring cache')
-    else:
-        is_cached = cache.file_is_cached(file)
-        interact(f"INFO: Input file {file} is {'' if is_cached else 'not '}cached")
-
-    # step 1.1
-    if instcounts:
-        instrumented_file = cache.get_name_of_instrumented_file(file)
-        if is_cached and not ignore_cache:
-            interact('INFO: Using cached instrumented file')
-        else:
-            interact('Instrumenting source file')
-            cache.copy_file_to_cache(file)
-            utils.instrument_file(instrumented_file, verbose)
     else:
-        instrumented_file = file
+        evict_from_cache(cache, cache_budget, interact, no_cache_warnings)
 
-    # step 1.2
+    # step 1.1: the kernel is selected first, so that only that kernel is instrumented
     file_kernels = cache.get_file_kernels(file)
     if not kernel or kernel not in file_kernels:
         if kernel:
@@ -226,12 +552,74 @@ def profile_opencl_kernel(file, kernel,
         kernel = file_kernels[inp]
         interact(f"Continuing with kernel '{kernel}'")
 
+    # the selected device is only looked up (see `run_in_forked_process`) if the results need to be keyed by it
+    device_info = None
+    if (use_result_cache and seed is not None) or results_db:
+        device_info = run_in_forked_process(utils.get_selected_device_info, platform_id, device_id)
+
+    # step 1.2: the results of an identical run may have been cached (instruction counts only depend
+    # on the inputs of the kernel, which are reproducible for a seed, while timings go stale)
+    result_key = None
+    if use_result_cache:
+        if seed is None:
+            interact('WARNING: The result cache is only used for seeded runs (see `--seed`); running the kernel')
+        else:
+            result_key = cache.get_result_key(file, kernel, {
+                'gsize':       gsize,
+                'lsize':       lsize,
+                'device':      device_info['key'],
+                'seed':        seed,
+                'samples':     samples,
+                'instcounts':  instcounts,
+                'timeit':      timeit,
+                'pergroup':    pergroup,
+                **({'inputs': utils.get_inputs_fingerprint(inputs)} if inputs else {}),
+                **({'arg sizes': arg_sizes} if arg_sizes else {})
+            })
+            cached_result = cache.get_profiling_result(result_key, result_max_age if timeit else None)
+            if cached_result is not None:
+                interact(f"INFO: Using the cached results of an identical run ({time() - cached_result['timestamp']:.0f} seconds old)")
+                return cached_result['result']
+            interact('INFO: No (recent enough) cached results of an identical run')
+
+    # step 1.3
+    is_cached = False
+    if ignore_cache:
+        interact('INFO: Ignoring cache')
+    else:
+        # either the selected kernel or the whole file (e.g. by `oclude instrument`) may have been cached
+        is_cached = cache.file_is_cached(file, kernel) or cache.file_is_cached(file)
+        interact(f"INFO: Input file {file} is {'' if is_cached else 'not '}cached")
+
+    if instcounts:
+        instrumented_file = None
+        if is_cached:
+            instrumented_file = cache.find_artifact(cache.get_name_of_instrumented_file(file, kernel)) \
+                or cache.find_artifact(cache.get_name_of_instrumented_file(file))
+            if instrumented_file is not None:
+                interact('INFO: Using cached instrumented file')
+                cache.record_access(instrumented_file, True)
+            else:
+                # e.g. evicted by another oclude process in the meantime
+                interact('INFO: The cached instrumented file no longer exists')
+        if instrumented_file is None:
+            interact(f"Instrumenting kernel '{kernel}' of source file")
+            instrumented_file, is_cached = instrument_into_cache(cache, file, verbose, kernel, use_cache=not ignore_cache)
+            if is_cached:
+                interact('INFO: Using the instrumented file cached by another oclude process in the meantime')
+    else:
+        instrumented_file = file
+
     ### STEP 2: run the kernel ###
     interact(f"Running kernel '{kernel}' from file {file}")
 
+    # the seed of unseeded runs is drawn here, so that it is reported along with their results
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
     @timeout_decorator.timeout(timeout, use_signals=False, timeout_exception=TimeoutError)
-    def run_kernel_with_timeout(a, b, c, d, e, f, g, h, i, j):
-        return utils.run_kernel(a, b, c, d, e, f, g, h, i, j)
+    def run_kernel_with_timeout(*args):
+        return utils.run_kernel(*args)
 
     try:
         kernel_run_results = run_kernel_with_timeout(
@@ -240,17 +628,114 @@ def profile_opencl_kernel(file, kernel,
             platform_id, device_id,
             samples,
             instcounts, timeit,
-            verbose
+            verbose,
+            pergroup,
+            file,
+            seed,
+            inputs,
+            arg_sizes
         )
     except TimeoutError as e:
         raise TimeoutError(f'ERROR: Kernel executions timed out after {timeout} seconds. Aborting.')
         exit(1)
 
+    # the profiling overhead of the device (if it has been profiled) is needed to normalize the measured times
+    profiling_overhead = None
+    if timeit:
+        device_profile = run_in_forked_process(utils.get_cached_device_profile, platform_id, device_id)
+        if device_profile is not None:
+            profiling_overhead = device_profile['profiling overhead (time)']
+
+    result = {
+        'original file':       file,
+        'instrumented file':   instrumented_file if instrumented_file != file else None,
+        'kernel':              kernel,
+        'results':             kernel_run_results,
+        'profiling overhead':  profiling_overhead,
+        'seed':                seed
+    }
+
+    if result_key is not None and kernel_run_results is not None:
+        cache.store_profiling_result(result_key, result)
+
+    if results_db:
+        results_store = utils.ResultsStore(results_db)
+        run_id = results_store.record_run({
+            'file':        os.path.abspath(file),
+            'digest':      cache.md5(file),
+            'gsize':       gsize,
+            'lsize':       lsize,
+            'platform':    device_info['platform'],
+            'device':      device_info['device'],
+            'device key':  device_info['key'],
+            'seed':        seed,
+            'samples':     samples,
+            'instcounts':  instcounts,
+            'timeit':      timeit,
+            'pergroup':    pergroup
+        }, result)
+        results_store.close()
+        interact(f'INFO: Run recorded in the results store {results_store.path} (run {run_id})')
+
+    return result
+
+def profile_opencl_roofline(file, kernel,
+                            gsize, lsize=None,
+                            platform_id=0, device_id=0,
+                            samples=1,
+                            peaks=None,
+                            timeout=30,
+                            verbose=False):
+
+    interact = utils.Interactor(__file__.split(os.sep)[-1])
+    interact.set_verbosity(verbose)
+
+    ### STEP 1: get the peaks of the device ###
+    if isinstance(peaks, str):
+        interact(f'Loading device peaks from {peaks}')
+        with open(peaks, 'r') as f:
+            peaks = json.load(f)
+    elif peaks is None:
+        interact('Getting device peaks out of its (cached, if possible) profile')
+        try:
+            peaks = run_in_forked_process(utils.get_device_peaks, platform_id, device_id, verbose)
+        except ValueError as e:
+            interact(f'ERROR: {e}; provide the peaks of the device with `--peaks` instead')
+            exit(1)
+
+    ### STEP 2: count the float operations and the global memory traffic of the kernel ###
+    profile = profile_opencl_kernel(
+        file, kernel, gsize, lsize, platform_id, device_id, samples,
+        instcounts=True, timeout=timeout, verbose=verbose
+    )
+    kernel = profile['kernel']
+    float_ops = np.mean([r[float_ops_counter] for r in profile['results']])
+    global_bytes = np.mean([r['memory report']['global bytes'] for r in profile['results']])
+
+    ### STEP 3: measure the execution time of the original (i.e. not instrumented) kernel ###
+    profile = profile_opencl_kernel(
+        file, kernel, gsize, lsize, platform_id, device_id, samples,
+        timeit=True, timeout=timeout, verbose=verbose
+    )
+    device_time = np.mean([r['timeit']['device'] for r in profile['results']])
+
+    device_info = run_in_forked_process(utils.get_selected_device_info, platform_id, device_id)
+    roofline = utils.get_roofline(
+        float_ops, global_bytes, device_time, peaks['peak float ops'], peaks['peak global bandwidth']
+    )
+
     return {
-        'original file':     file,
-        'instrumented file': instrumented_file if instrumented_file != file else None,
-        'kernel':            kernel,
-        'results':           kernel_run_results
+        'file':         file,
+        'kernel':       kernel,
+        'gsize':        gsize,
+        'lsize':        lsize,
+        'device':       device_info['device'],
+        'platform':     device_info['platform'],
+        'float ops':    float(float_ops),
+        'global bytes': float(global_bytes),
+        'device time':  float(device_time),
+        'peaks':        peaks,
+        'roofline':     roofline
     }
 
 ###############################
@@ -264,31 +749,126 @@ def run():
     interact.set_verbosity(args.verbose)
 
     if args.command == 'device':
-        device_prof_results = utils.profile_opencl_device(args.platform_id, args.device_id, args.verbose)
+        device_prof_results = utils.profile_opencl_device(
+            args.platform_id, args.device_id, args.verbose,
+            args.quick, args.transfer_sizes,
+            args.refresh, args.max_age * 24 * 60 * 60
+        )
         indent = max(len(profiling_category) for profiling_category in device_prof_results.keys())
         print('Profiling info for selected OpenCL device:')
         for profiling_category, profiling_info in device_prof_results.items():
             if isinstance(profiling_info, dict):
                 for k, v in profiling_info.items():
-                    category_name = f'{profiling_category} bandwidth @ {k}'
+                    category_name = f'{profiling_category} @ {k}'
                     print(f'{category_name:>{indent}} - {v}')
             else:
                 print(f'{profiling_category:>{indent}} - {profiling_info}')
         exit(0)
 
+    if args.command == 'instrument':
+        if not args.file:
+            interact('ERROR: argument -f/--file is required')
+            exit(1)
+        results = instrument_many(args.file, args.workers, args.verbose)
+        evict_from_cache(utils.CachedFiles(), args.cache_budget, interact, args.no_cache_warnings)
+        failed = [file for file, instrumented_file in results.items() if instrumented_file is None]
+        print(f'Instrumented {len(results) - len(failed)} out of {len(results)} files')
+        exit(1 if failed else 0)
+
+    if args.command == 'list':
+        if not args.file:
+            interact('ERROR: argument -f/--file is required')
+            exit(1)
+        results = list_kernels(args.file, args.workers, args.verbose)
+        for file, kernels in results.items():
+            print(f"{file}: {', '.join(kernels) if kernels is not None else '(failed)'}")
+        exit(1 if None in results.values() else 0)
+
+    if args.command in ['cache', 'results']:
+        default_action = {'cache': 'stats', 'results': 'query'}[args.command]
+        if (args.action or default_action) != default_action:
+            interact(f"ERROR: The {args.command} command does not support action '{args.action}'")
+            exit(1)
+
+    if args.command == 'results':
+        runs = utils.query_results(
+            args.results_db, frame='records',
+            file=os.path.abspath(args.file) if args.file else None,
+            kernel=args.kernel, gsize=args.gsize, lsize=args.lsize, seed=args.seed
+        )
+        print(f"{'run':>6} {'timestamp':>19} {'kernel':>24} {'gsize':>9} {'lsize':>6} {'samples':>7} "
+              f"{'device time (ms)':>16} {'instructions':>14}  device")
+        for run in runs:
+            print(f"{run['id']:>6} {datetime.fromtimestamp(run['timestamp']).strftime('%Y-%m-%d %H:%M:%S'):>19} "
+                  f"{run['kernel']:>24} {run['gsize']:>9} {str(run['lsize']):>6} {run['samples']:>7} "
+                  f"{str(run['mean device time'] if run['mean device time'] is not None else '-'):>16} "
+                  f"{str(round(run['mean instructions']) if run['mean instructions'] is not None else '-'):>14}  {run['device']}")
+        if args.json_file:
+            with open(args.json_file, 'w') as f:
+                json.dump(runs, f, indent=4)
+            interact(f'Runs dumped to {args.json_file}')
+        exit(0)
+
+    if args.command == 'cache':
+        cache = utils.CachedFiles()
+        cache_stats = cache.stats()
+        indent = max(len(artifact_type) for artifact_type in cache_stats.keys())
+        print(f'Cache at {cache.cachedir} ({cache.size / (1024 * 1024):.2f} MiB out of a budget of {args.cache_budget} MiB):')
+        for artifact_type, type_stats in cache_stats.items():
+            hit_rate = f"{100 * type_stats['hit rate']:.2f}%" if type_stats['hit rate'] is not None else '-'
+            print(f"{artifact_type:>{indent}} - {type_stats['entries']} entries, {type_stats['bytes']} bytes, "
+                  f"{type_stats['hits']} hits, {type_stats['misses']} misses, hit rate {hit_rate}")
+        for shared_cachedir in cache.shared_cachedirs:
+            print(f'Shared cache (read-only) at {shared_cachedir}')
+        exit(0)
+
+    if args.command == 'roofline':
+        record = profile_opencl_roofline(
+            args.file, args.kernel,
+            args.gsize, args.lsize,
+            args.platform_id, args.device_id,
+            args.samples,
+            args.peaks,
+            args.timeout,
+            args.verbose
+        )
+        roofline = record['roofline']
+        print(f"Roofline analysis for kernel '{record['kernel']}' on device '{record['device']}':")
+        print(f"       peak float ops - {record['peaks']['peak float ops']} GFLOP/s")
+        print(f"peak global bandwidth - {record['peaks']['peak global bandwidth']} GB/s")
+        print(f"          ridge point - {roofline['ridge point']} float ops/byte")
+        print(f" arithmetic intensity - {roofline['arithmetic intensity']} float ops/byte")
+        print(f"   achieved float ops - {roofline['achieved float ops']} GFLOP/s")
+        print(f"   achieved bandwidth - {roofline['achieved bandwidth']} GB/s")
+        print(f" attainable float ops - {roofline['attainable float ops']} GFLOP/s")
+        if roofline['efficiency'] is not None:
+            print(f"The kernel is {roofline['bound']} bound and achieves {100 * roofline['efficiency']:.2f}% of its bound"
+                  + (f" ({roofline['headroom']:.2f}x headroom)" if roofline['headroom'] is not None else ''))
+        else:
+            print(f"The kernel is {roofline['bound']} bound (its efficiency is unknown: either its time or the peak of its bound is zero)")
+        if args.json_file:
+            with open(args.json_file, 'w') as f:
+                json.dump(record, f, indent=4)
+            interact(f'Roofline record dumped to {args.json_file}')
+        exit(0)
+
     args_dict = vars(args)
-    del args_dict['command']
+    args_dict['result_max_age'] = args.result_max_age * 24 * 60 * 60
+    for not_kernel_arg in ['command', 'action', 'peaks', 'json_file', 'quick', 'transfer_sizes', 'refresh', 'max_age', 'workers']:
+        del args_dict[not_kernel_arg]
     results = profile_opencl_kernel(**args_dict)
 
     ### STEP 3: dump an oclgrind-like output (if requested by user) ###
 
     # reduce all runs to a single dict of results
     selected_kernel = results['kernel']
+    profiling_overhead = results['profiling overhead']
     results = results['results']
     reduced_results = {}
     samples = args.samples
+    instcounts = args.instcounts or args.pergroup
 
-    if args.instcounts:
+    if instcounts:
         if samples > 1:
             interact(f'Calculating average instruction counts over {samples} samples... ', nl=False)
         reduced_results['instcounts'] = dict(
@@ -297,9 +877,22 @@ def run():
         reduced_results['instcounts'] = {
             k : int(v) // (samples if samples > 0 else 1) for k, v in reduced_results['instcounts'].items()
         }
+        reduced_results['memory traffic'] = dict(
+            reduce(operator.add, map(Counter, map(lambda x : x['memory traffic'], results)))
+        )
+        reduced_results['memory traffic'] = {
+            k : int(v) // (samples if samples > 0 else 1) for k, v in reduced_results['memory traffic'].items()
+        }
+        reduced_results[float_ops_counter] = sum(x[float_ops_counter] for x in results) // (samples if samples > 0 else 1)
         if samples > 1:
             interact('done', prompt=False)
 
+    if args.pergroup:
+        # imbalance statistics over the average per work group counts of all samples
+        reduced_results['group imbalance'] = utils.get_group_imbalance(
+            np.mean([r['group instcounts'] for r in results], axis=0)
+        )
+
     if args.timeit:
         if samples > 1:
             interact(f'Calculating average time profiling info over {samples} samples... ', nl=False)
@@ -312,15 +905,45 @@ def run():
         if samples > 1:
             interact('done', prompt=False)
 
+    if instcounts:
+        reduced_results['memory report'] = utils.get_memory_traffic_report(
+            reduced_results['memory traffic'],
+            reduced_results[float_ops_counter],
+            reduced_results['timeit']['device'] if args.timeit else None
+        )
+
     # in the CLI of oclude, we only need the average of the samples
     results = reduced_results
 
-    if args.instcounts:
+    if instcounts:
         print(f"Instructions executed for kernel '{selected_kernel}'" + (' (average):' if args.samples > 1 else ':'))
         for instname, instcount in sorted(results['instcounts'].items(), key=lambda item : item[1], reverse=True):
             if instcount != 0:
                 print(f'{instcount:16} - {instname}')
 
+    if instcounts:
+        memory_report = results['memory report']
+        print(f"Memory traffic for kernel '{selected_kernel}'" + (' (average, ' if args.samples > 1 else ' (') + 'in bytes):')
+        for address_space, nbytes in memory_report['bytes per address space'].items():
+            if nbytes != 0:
+                print(f'{nbytes:16} - {address_space}')
+        print(f"{memory_report['total bytes']:16} - total")
+        intensity = memory_report['arithmetic intensity']
+        print('Arithmetic intensity: ' + (f'{intensity} float ops/byte of global memory' if intensity is not None
+                                          else 'N/A (no global memory traffic)'))
+        if args.timeit and memory_report['achieved bandwidth'] is not None:
+            print(f"Achieved global memory bandwidth: {memory_report['achieved bandwidth']} GB/s")
+
+    if args.pergroup:
+        imbalance = results['group imbalance']
+        print(f"Work group load imbalance for kernel '{selected_kernel}' (instructions executed per work group"
+                + (', average' if args.samples > 1 else '') + '):')
+        for stat in ['work groups', 'mean', 'min', 'max', 'max/mean ratio', 'gini']:
+            print(f'{imbalance[stat]:16} - {stat}')
+        print('  slowest groups:')
+        for group_id, work in imbalance['slowest groups']:
+            print(f'{work:16} - group {group_id}')
+
     if args.timeit:
         kernel_results = results['timeit']
         indent = max(len(timing_scope) for timing_scope in kernel_results.keys())
@@ -328,3 +951,6 @@ def run():
                 + ('average, ' if args.samples > 1 else '') + "in milliseconds):")
         for timing_scope, time_elapsed in kernel_results.items():
             print(f'{timing_scope:>{indent}} - {time_elapsed}')
+        if profiling_overhead is not None:
+            print(f'(the profiling overhead of the device is {profiling_overhead}; '
+                  f"normalized device time: {max(kernel_results['device'] - profiling_overhead, 0)})")
@@ -1,4 +1,7 @@
 from oclude.utils.interactor import Interactor
 from oclude.utils.cachedfiles import *
-from oclude.utils.instrumentation import instrument_file
-from oclude.utils.hostcode import run_kernel, profile_opencl_device
+from oclude.utils.instrumentation import instrument_file, warm_up_parser
+from oclude.utils.kernelargs import load_inputs, get_inputs_fingerprint, get_arg_sizes, evaluate_size
+from oclude.utils.hostcode import run_kernel, profile_opencl_device, get_cached_device_profile, get_selected_device_info, get_device_peaks
+from oclude.utils.resultsstore import ResultsStore, get_results_db, query_results
+from oclude.utils.metrics import get_group_imbalance, get_memory_traffic_report, get_roofline
@@ -1,27 +1,384 @@
 import os
+import json
+import pickle
 import hashlib
-from shutil import copyfile
+import sqlite3
+import tempfile
 import subprocess as sp
+from time import time
+from functools import lru_cache
+from contextlib import contextmanager
+import shutil
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks (e.g. on Windows); entries are still written atomically, but may be produced more than once
+    fcntl = None
 
-from pycparserext.ext_c_parser import OpenCLCParser
-from pycparser.c_ast import FuncDef
+from oclude.utils.constants import instrumentation_version, argument_generator_version, cl2llCompiler, instrumentationGetter
+from oclude.utils.parsedunit import parse_unit, preprocess_file, scan_kernels
+
+@lru_cache(maxsize=None)
+def get_umask():
+    '''
+    Returns the umask of the current process (which can only be read by setting it)
+    '''
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def write_atomically(filename, data):
+    '''
+    Writes `data` (text or bytes) to `filename` through a temporary file in the same directory that
+    replaces it, so that concurrent oclude processes never see a partially written file
+    '''
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.tmp_')
+    try:
+        # the temporary file is only accessible by its owner; the file it becomes gets the usual permissions
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o666 & ~get_umask())
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+def get_oclude_version():
+    '''
+    Returns the version of the installed oclude (or 'unknown', e.g. if it runs out of a source tree)
+    '''
+    try:
+        from importlib.metadata import version
+        return version('oclude')
+    except Exception:
+        return 'unknown'
+
+@lru_cache(maxsize=None)
+def get_toolchain_version():
+    '''
+    Returns a digest of the versions of everything that the instrumentation depends on, i.e. oclude itself
+    (and the version of its instrumentation), the compiler and the instrumentation parser.
+    It is computed once per process, as it runs both tools
+    '''
+    def get_tool_version(*command):
+        try:
+            cmdout = sp.run(command, stdout=sp.PIPE, stderr=sp.PIPE)
+        except OSError:
+            return 'not found'
+        return cmdout.stdout.decode('ascii', 'replace').strip() if cmdout.returncode == 0 else 'unknown'
+
+    versions = [
+        get_oclude_version(),
+        str(instrumentation_version),
+        get_tool_version(cl2llCompiler, '--version'),
+        get_tool_version(instrumentationGetter, '--version')
+    ]
+    return hashlib.md5('\n'.join(versions).encode()).hexdigest()
+
+def get_cache_dir():
+    '''
+    Returns the (writable) directory of the cache: $OCLUDE_CACHE_DIR if it is set,
+    otherwise the `oclude` directory under $XDG_CACHE_HOME (by default, ~/.cache)
+    '''
+    if os.environ.get('OCLUDE_CACHE_DIR'):
+        return os.path.abspath(os.path.expanduser(os.environ['OCLUDE_CACHE_DIR']))
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'oclude')
+
+def get_shared_cache_dirs():
+    '''
+    Returns the read-only shared directories of the cache (e.g. on a network file system, populated in advance
+    by running oclude with $OCLUDE_CACHE_DIR pointing to them), in the order in which they are looked up:
+    those listed in $OCLUDE_SHARED_CACHE_DIRS, separated like the directories of $PATH
+    '''
+    return [
+        os.path.abspath(os.path.expanduser(shared_cachedir))
+        for shared_cachedir in os.environ.get('OCLUDE_SHARED_CACHE_DIRS', '').split(os.pathsep) if shared_cachedir
+    ]
+
+# the name of the index of the cache (see `CachedFiles.index`)
+index_name = 'index.sqlite'
+
+# the directory of the cache in which the locks of its entries are kept (see `CachedFiles.lock`)
+locks_dirname = 'locks'
+
+# must be bumped every time the tables of the index change
+index_schema_version = 2
+
+# the type of each artifact in the cache, by the prefix of its name
+artifact_types = {
+    'instr_':    'instrumented source',
+    'function_': 'function instrumentation',
+    'unit_':     'parsed unit',
+    'structs_':  'struct layouts',
+    'device_':   'device profile',
+    'result_':   'profiling result'
+}
+
+def get_artifact_type(name):
+    '''
+    Returns the type of the artifact with the provided name (see `artifact_types`)
+    '''
+    return next((artifact_type for prefix, artifact_type in artifact_types.items() if name.startswith(prefix)), 'other')
 
 class CachedFiles:
+    '''
+    The cache of oclude. Everything is written to (and evicted from) its directory (see `get_cache_dir`);
+    entries are looked up there first and then in its read-only shared directories (see `get_shared_cache_dirs`)
+    '''
+
+    # the (pickled) parsed units of the current process, by digest
+    parsed_units = {}
+
+    # the digest and the preprocessed source code of the file that the current process scanned last,
+    # which is usually the next one to be parsed (see `get_file_kernels`)
+    scanned_source = (None, None)
 
-    cachedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache')
-    commentRemover = 'cpp'
+    # the connection of the current process to the index of the cache, and the index file (and inode) it is connected to
+    index_connection, index_pid, index_inode = None, None, None
 
     def __init__(self):
+        self.cachedir = get_cache_dir()
+        self.shared_cachedirs = [d for d in get_shared_cache_dirs() if d != self.cachedir]
         # make sure that cache directory exists
-        if not os.path.exists(self.cachedir):
-            os.mkdir(self.cachedir)
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    @property
+    def index(self):
+        '''
+        The index of the cache, an SQLite database in the cache directory that records
+        - the path, mtime, size and md5 hex digest of every source file that has been hashed (see `md5`)
+        - the name, type, size and last access time of every artifact in the cache, as well as their total size
+          (see `size` and `evict`)
+        - the hits and misses of the lookups in the cache, per artifact type (see `record_access` and `stats`)
+        If it does not exist (e.g. after the cache is cleared), it is built out of the files in the cache directory
+        '''
+        index_file = os.path.join(self.cachedir, index_name)
+        try:
+            index_inode = (index_file, os.stat(index_file).st_ino)
+        except FileNotFoundError:
+            index_inode = None
+        # (re)connect if the cache has been cleared (i.e. the index file is gone or replaced) by another process
+        # or if the directory of the cache has changed
+        if CachedFiles.index_connection is None or CachedFiles.index_pid != os.getpid() or CachedFiles.index_inode != index_inode:
+            self.close_index()
+            index_is_new = index_inode is None
+            index = sqlite3.connect(index_file, timeout=60, isolation_level=None)
+            # every access to the cache is recorded in the index, so its writes must be cheap
+            index.execute('PRAGMA journal_mode = WAL')
+            index.execute('PRAGMA synchronous = NORMAL')
+            index.execute('BEGIN IMMEDIATE')
+            if index.execute('PRAGMA user_version').fetchone()[0] != index_schema_version:
+                # an index of an older version of oclude; what it records can be rebuilt out of the cache directory
+                index_is_new = True
+                for table in ['sources', 'artifacts', 'totals', 'accesses']:
+                    index.execute(f'DROP TABLE IF EXISTS {table}')
+            index.execute('CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, md5 TEXT)')
+            index.execute('CREATE TABLE IF NOT EXISTS artifacts (name TEXT PRIMARY KEY, type TEXT, size INTEGER, atime REAL)')
+            index.execute('CREATE INDEX IF NOT EXISTS artifacts_by_atime ON artifacts (atime)')
+            index.execute('CREATE TABLE IF NOT EXISTS totals (key TEXT PRIMARY KEY, value INTEGER)')
+            index.execute("INSERT OR IGNORE INTO totals VALUES ('size', 0)")
+            index.execute('CREATE TABLE IF NOT EXISTS accesses (type TEXT PRIMARY KEY, hits INTEGER, misses INTEGER)')
+            index.execute(f'PRAGMA user_version = {index_schema_version}')
+            index.execute('COMMIT')
+            CachedFiles.index_connection, CachedFiles.index_pid = index, os.getpid()
+            CachedFiles.index_inode = (index_file, os.stat(index_file).st_ino)
+            if index_is_new:
+                self.reindex()
+        return CachedFiles.index_connection
+
+    @contextmanager
+    def index_transaction(self):
+        '''
+        Context manager for a transaction on the index, during which no other process can write to it
+        '''
+        index = self.index
+        index.execute('BEGIN IMMEDIATE')
+        try:
+            yield index
+        except BaseException:
+            index.execute('ROLLBACK')
+            raise
+        index.execute('COMMIT')
+
+    def close_index(self):
+        if CachedFiles.index_connection is not None and CachedFiles.index_pid == os.getpid():
+            CachedFiles.index_connection.close()
+        CachedFiles.index_connection, CachedFiles.index_pid, CachedFiles.index_inode = None, None, None
+
+    def reindex(self):
+        '''
+        Rebuilds the artifacts of the index (and their total size) out of the files in the cache directory.
+        As access times are not reliably kept by every file system, each artifact is considered last accessed
+        when it was last modified
+        '''
+        artifacts = []
+        for name in os.listdir(self.cachedir):
+            file_path = os.path.join(self.cachedir, name)
+            if not name.startswith((index_name, '.tmp_')) and os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                artifacts.append((name, get_artifact_type(name), stat.st_size, stat.st_mtime))
+        with self.index_transaction() as index:
+            index.execute('DELETE FROM artifacts')
+            index.executemany('INSERT INTO artifacts VALUES (?, ?, ?, ?)', artifacts)
+            index.execute("UPDATE totals SET value = ? WHERE key = 'size'", (sum(artifact[2] for artifact in artifacts),))
+
+    def add_artifact(self, filename):
+        '''
+        Records the provided file (which has just been written to the cache, i.e. accessed now) in the index
+        '''
+        name = os.path.basename(filename)
+        size = os.path.getsize(filename)
+        with self.index_transaction() as index:
+            previous = index.execute('SELECT size FROM artifacts WHERE name = ?', (name,)).fetchone()
+            index.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?)', (name, get_artifact_type(name), size, time()))
+            index.execute("UPDATE totals SET value = value + ? WHERE key = 'size'", (size - (previous[0] if previous else 0),))
+
+    def store_artifact(self, filename, data):
+        '''
+        Writes `data` to the provided file of the cache (see `write_atomically`) and records it in the index
+        '''
+        write_atomically(filename, data)
+        self.add_artifact(filename)
+
+    def remove_artifact(self, filename):
+        '''
+        Removes the provided file from the cache and from the index
+        '''
+        name = os.path.basename(filename)
+        try:
+            os.remove(os.path.join(self.cachedir, name))
+        except FileNotFoundError:
+            pass
+        with self.index_transaction() as index:
+            previous = index.execute('SELECT size FROM artifacts WHERE name = ?', (name,)).fetchone()
+            if previous:
+                index.execute('DELETE FROM artifacts WHERE name = ?', (name,))
+                index.execute("UPDATE totals SET value = value - ? WHERE key = 'size'", previous)
+
+    def find_artifact(self, filename):
+        '''
+        Returns the path of the provided entry in the first directory of the cache that holds it, i.e. either
+        in the directory of the cache or in one of its shared directories, or None if none of them holds it
+        '''
+        name = os.path.basename(filename)
+        for cachedir in [self.cachedir] + self.shared_cachedirs:
+            path = os.path.join(cachedir, name)
+            if os.path.exists(path):
+                return path
+        return None
+
+    @contextmanager
+    def lock(self, filename):
+        '''
+        Context manager that holds an exclusive lock on the provided entry of the cache (which need not exist yet),
+        so that only one process at a time produces it: any other process that needs the same entry waits until
+        the lock is released and should then check again whether the entry is cached, instead of producing it again
+        '''
+        if fcntl is None:
+            yield
+            return
+        lockdir = os.path.join(self.cachedir, locks_dirname)
+        os.makedirs(lockdir, exist_ok=True)
+        fd = os.open(os.path.join(lockdir, os.path.basename(filename) + '.lock'), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing the file releases the lock as well
+            os.close(fd)
+
+    @contextmanager
+    def try_lock(self, filename):
+        '''
+        Context manager that tries to lock the provided entry of the cache (see `lock`) without waiting:
+        yields False if another process holds its lock (i.e. it is producing or using the entry), True otherwise
+        '''
+        if fcntl is None:
+            yield True
+            return
+        try:
+            # a lock that has never been taken can not be held (and its file need not be created)
+            fd = os.open(os.path.join(self.cachedir, locks_dirname, os.path.basename(filename) + '.lock'), os.O_RDWR)
+        except FileNotFoundError:
+            yield True
+            return
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+            else:
+                yield True
+        finally:
+            os.close(fd)
+
+    def record_access(self, filename, hit):
+        '''
+        Records a lookup of the provided file in the cache, i.e. a hit or a miss for its artifact type;
+        a hit is also an access to the artifact, which makes it the last one to be evicted (see `evict`)
+        '''
+        name = os.path.basename(filename)
+        column = 'hits' if hit else 'misses'
+        with self.index_transaction() as index:
+            index.execute('INSERT OR IGNORE INTO accesses VALUES (?, 0, 0)', (get_artifact_type(name),))
+            index.execute(f'UPDATE accesses SET {column} = {column} + 1 WHERE type = ?', (get_artifact_type(name),))
+            if hit:
+                index.execute('UPDATE artifacts SET atime = ? WHERE name = ?', (time(), name))
+
+    def evict(self, budget):
+        '''
+        Removes the least recently used artifacts of the cache (of any type) until their total size
+        does not exceed `budget` bytes, skipping the ones that another process holds the lock of (see `lock`).
+        Returns the number of the removed artifacts and the bytes freed
+        '''
+        with self.index_transaction() as index:
+            excess = index.execute("SELECT value FROM totals WHERE key = 'size'").fetchone()[0] - budget
+            evicted, freed = 0, 0
+            if excess > 0:
+                for name, size in index.execute('SELECT name, size FROM artifacts ORDER BY atime').fetchall():
+                    # the file is removed while its lock is held, so that no other process starts producing it meanwhile
+                    with self.try_lock(name) as locked:
+                        if not locked:
+                            continue
+                        try:
+                            os.remove(os.path.join(self.cachedir, name))
+                        except FileNotFoundError:
+                            pass
+                    index.execute('DELETE FROM artifacts WHERE name = ?', (name,))
+                    evicted += 1
+                    freed += size
+                    if freed >= excess:
+                        break
+                index.execute("UPDATE totals SET value = value - ? WHERE key = 'size'", (freed,))
+        return evicted, freed
+
+    def stats(self):
+        '''
+        Returns the number of entries, their size (in bytes) and the hits, misses and hit rate of the lookups
+        in the cache for each artifact type, as a dict {<artifact type>: {'entries': ..., 'bytes': ..., ...}}
+        '''
+        index = self.index
+        stats = {
+            artifact_type: {'entries': 0, 'bytes': 0, 'hits': 0, 'misses': 0, 'hit rate': None}
+            for artifact_type in list(artifact_types.values()) + ['other']
+        }
+        for artifact_type, entries, size in index.execute('SELECT type, COUNT(*), SUM(size) FROM artifacts GROUP BY type'):
+            stats[artifact_type]['entries'], stats[artifact_type]['bytes'] = entries, size
+        for artifact_type, hits, misses in index.execute('SELECT type, hits, misses FROM accesses'):
+            stats[artifact_type]['hits'], stats[artifact_type]['misses'] = hits, misses
+            stats[artifact_type]['hit rate'] = hits / (hits + misses) if hits + misses else None
+        return stats
 
     @property
     def size(self):
-        cache_files = list(map(lambda f : os.path.join(self.cachedir, f), os.listdir(self.cachedir)))
-        return sum(os.path.getsize(f) for f in cache_files if os.path.isfile(f))
+        '''
+        The total size of the artifacts in the cache, in bytes (as tracked by the index)
+        '''
+        return self.index.execute("SELECT value FROM totals WHERE key = 'size'").fetchone()[0]
 
     def clear(self):
+        self.close_index()
         for filename in os.listdir(self.cachedir):
             file_path = os.path.join(self.cachedir, filename)
             try:
@@ -32,92 +389,251 @@ class CachedFiles:
             except Exception as e:
                 print('Failed to delete %s. Reason: %s' % (file_path, e))
 
-    def get_name_of_instrumented_file(self, filename):
-        return os.path.join(self.cachedir, 'instr_' + os.path.basename(filename))
+    def get_name_of_instrumented_file(self, filename, kernel=None):
+        '''
+        Returns the name under which the instrumented version of the provided file (or of the provided kernel of it)
+        is cached. It depends on the content of the file and on the versions of the tools that instrument it only
+        (see `instrumentation_digest`), so that files with the same name never share an entry, while identical files
+        in different paths do
+        '''
+        return os.path.join(self.cachedir, f'instr_{self.instrumentation_digest(filename)}' + (f'_{kernel}' if kernel else '') + '.cl')
 
-    def get_name_of_kernels_file(self, filename):
-        return os.path.join(self.cachedir, os.path.basename(filename) + '.kernels')
+    def get_name_of_parsed_unit_file(self, digest):
+        return os.path.join(self.cachedir, f"unit_{digest.replace(':', '_')}.pickle")
 
-    def get_name_of_digest_file(self, filename):
-        return os.path.join(self.cachedir, os.path.basename(filename) + '.digest')
+    def get_name_of_device_profile_file(self, key):
+        return os.path.join(self.cachedir, f'device_{key}.json')
 
-    def md5(self, filename):
+    def get_device_profile(self, key, max_age):
         '''
-        Returns the md5 hex digest of the provided file
+        Returns the cached profile of the device with the provided key as a dict
+        with its `timestamp` and the `profile` itself, or None if the device has not
+        been profiled in the past or if its profile is older than `max_age` seconds
         '''
-        hash_md5 = hashlib.md5()
-        with open(filename, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b''):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        profile_file = self.get_name_of_device_profile_file(key)
+        try:
+            with open(self.find_artifact(profile_file) or profile_file, 'r') as f:
+                cached_profile = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            cached_profile = None
+        if cached_profile is not None and time() - cached_profile['timestamp'] > max_age:
+            cached_profile = None
+        self.record_access(profile_file, cached_profile is not None)
+        return cached_profile
+
+    def store_device_profile(self, key, profile, timestamp=None):
+        '''
+        Caches the profile of the device with the provided key
+        '''
+        self.store_artifact(
+            self.get_name_of_device_profile_file(key),
+            json.dumps({'timestamp': timestamp or time(), 'profile': profile}, indent=4)
+        )
 
-    def file_is_cached(self, filename):
+    def get_name_of_struct_layouts_file(self, digest, device_key):
+        return os.path.join(self.cachedir, f"structs_{digest.replace(':', '_')}_{device_key}.json")
+
+    def get_struct_layouts(self, digest, device_key):
         '''
-        Checks whether the provided file has been cached in the past
+        Returns the cached layouts of the structs of the file with the provided digest on the device
+        with the provided key, as a dict {<type name>: {'names': [...], 'offsets': [...], 'itemsize': ...}}
+        (empty if none of them has been resolved in the past)
         '''
-        cached_file = self.get_name_of_instrumented_file(filename)
-        infile_digest = self.md5(filename)
-        cached_file_digest_file = self.get_name_of_digest_file(filename)
+        layouts_file = self.get_name_of_struct_layouts_file(digest, device_key)
         try:
-            with open(cached_file_digest_file, 'r') as f:
-                cached_file_digest = f.read().strip()
-            return cached_file_digest == infile_digest
-        except FileNotFoundError:
-            return False
+            with open(self.find_artifact(layouts_file) or layouts_file, 'r') as f:
+                layouts = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            layouts = None
+        self.record_access(layouts_file, layouts is not None)
+        return layouts or {}
 
-    def get_file_kernels(self, filename):
+    def store_struct_layouts(self, digest, device_key, layouts):
         '''
-        Returns a list of the kernels present in the provided file
+        Caches the layouts of the structs of the file with the provided digest on the device with the provided key
         '''
-        kernels_file = self.get_name_of_kernels_file(filename)
-        cached_file = self.get_name_of_instrumented_file(filename)
+        self.store_artifact(self.get_name_of_struct_layouts_file(digest, device_key), json.dumps(layouts, indent=4))
 
-        # have we seen this file again?
-        # (we use file_is_cached to compare files with filecmp
-        #  to avoid same name issues)
-        if self.file_is_cached(filename) and os.path.exists(kernels_file):
-            with open(kernels_file, 'r') as f:
-                kernel_list = f.read().splitlines()
-        else:
-            # firstly, get the kernel list
+    def get_name_of_function_instrumentation_file(self, key):
+        return os.path.join(self.cachedir, f'function_{key}.json')
 
-            # remove instrumentation comments
-            cmdout = sp.run([self.commentRemover, filename], stdout=sp.PIPE, stderr=sp.PIPE)
-            cmdout = cmdout.stdout.decode('ascii')
+    def get_function_instrumentation(self, key):
+        '''
+        Returns the cached instrumentation of the function with the provided key (i.e. its instrumentation data
+        and its instrumented source code), or None if it has not been cached
+        '''
+        function_instrumentation_file = self.get_name_of_function_instrumentation_file(key)
+        try:
+            with open(self.find_artifact(function_instrumentation_file) or function_instrumentation_file, 'r') as f:
+                function_instrumentation = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            function_instrumentation = None
+        self.record_access(function_instrumentation_file, function_instrumentation is not None)
+        if function_instrumentation is None:
+            return None
+        function_instrumentation['instrumentation'] = [
+            [tuple(count) for count in bb] for bb in function_instrumentation['instrumentation']
+        ]
+        return function_instrumentation
 
-            src = ''.join(filter(lambda line : line.strip() and not line.startswith('#'), cmdout.splitlines(keepends=True)))
+    def store_function_instrumentation(self, key, function_instrumentation):
+        '''
+        Caches the instrumentation of the function with the provided key
+        '''
+        self.store_artifact(self.get_name_of_function_instrumentation_file(key), json.dumps(function_instrumentation))
 
-            parser = OpenCLCParser()
-            ast = parser.parse(src)
+    def get_name_of_profiling_result_file(self, key):
+        return os.path.join(self.cachedir, f'result_{key}.pickle')
 
-            kernel_list = []
-            for f in filter(lambda x : isinstance(x, FuncDef), ast):
-                if any(x.endswith('kernel') for x in f.decl.funcspec):
-                    kernel_list.append(f.decl.name)
+    def get_result_key(self, filename, kernel, run_config):
+        '''
+        Returns the key under which the results of a run of the provided kernel of the provided file are cached,
+        i.e. a digest of the content of the file and of the versions of the tools that instrument it
+        (see `instrumentation_digest`), of the version of the generator of the arguments, of the kernel and
+        of the configuration of the run (a dict with e.g. the NDRange, the device, the seed and the number of samples)
+        '''
+        key = json.dumps(
+            [self.instrumentation_digest(filename), argument_generator_version, kernel, run_config], sort_keys=True
+        )
+        return hashlib.md5(key.encode()).hexdigest()
 
-            # secondly, cache the kernel list
-            with open(kernels_file, 'w') as f:
-                for kernel in kernel_list:
-                    f.write(kernel + '\n')
+    def get_profiling_result(self, key, max_age=None):
+        '''
+        Returns the cached results of the run with the provided key as a dict with their `timestamp` and
+        the `result` itself, or None if the run has not been cached or if its results are older than `max_age`
+        seconds (timings go stale, unlike instruction counts, which only depend on the inputs of the run)
+        '''
+        result_file = self.get_name_of_profiling_result_file(key)
+        try:
+            # pickles are never loaded from the shared directories, as unpickling may execute arbitrary code
+            with open(result_file, 'rb') as f:
+                cached_result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            cached_result = None
+        if cached_result is not None and max_age is not None and time() - cached_result['timestamp'] > max_age:
+            cached_result = None
+        self.record_access(result_file, cached_result is not None)
+        return cached_result
 
-        return kernel_list
+    def store_profiling_result(self, key, result, timestamp=None):
+        '''
+        Caches the results of the run with the provided key
+        '''
+        self.store_artifact(
+            self.get_name_of_profiling_result_file(key),
+            pickle.dumps({'timestamp': timestamp or time(), 'result': result})
+        )
 
-    def copy_file_to_cache(self, filename):
+    def md5(self, filename):
         '''
-        Copies the input file `filename` to the cache, in order for
-        the instrumentation phase to edit it
+        Returns the md5 hex digest of the provided file. The digest recorded in the index is trusted as long as
+        the mtime and the size of the file do not change; only then is the file hashed (and recorded) again
         '''
-        cached_file = self.get_name_of_instrumented_file(filename)
-        kernels_file = self.get_name_of_kernels_file(filename)
-        infile_digest_file = self.get_name_of_digest_file(filename)
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        recorded = self.index.execute(
+            'SELECT md5 FROM sources WHERE path = ? AND mtime = ? AND size = ?', (path, stat.st_mtime_ns, stat.st_size)
+        ).fetchone()
+        if recorded:
+            return recorded[0]
+
+        hash_md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                hash_md5.update(chunk)
+        md5 = hash_md5.hexdigest()
 
-        copyfile(filename, cached_file)
-        infile_digest = self.md5(filename)
-        with open(infile_digest_file, 'w') as f:
-            f.write(infile_digest + '\n')
+        # a file modified within the last couple of seconds may be modified again without its mtime changing
+        # (depending on the resolution of the timestamps of the file system), so it is not recorded yet
+        if time() - stat.st_mtime_ns * 1e-9 > 2:
+            self.index.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (path, stat.st_mtime_ns, stat.st_size, md5))
+        return md5
 
-        # remove previous kernel file
-        try:
-            os.remove(kernels_file)
-        except:
-            pass
+    def digest(self, filename):
+        '''
+        Returns the digest under which the parsed unit of the provided file (and what is derived from it,
+        e.g. the layouts of its structs) is cached, i.e. its md5 hex digest stamped with the instrumentation version
+        '''
+        return f'{self.md5(filename)}:{instrumentation_version}'
+
+    def instrumentation_digest(self, filename):
+        '''
+        Returns the digest under which the instrumentation of the provided file is cached,
+        i.e. a digest of its content and of the versions of the tools that instrument it (see `get_toolchain_version`)
+        '''
+        return hashlib.md5(f'{self.md5(filename)}:{get_toolchain_version()}'.encode()).hexdigest()
+
+    def file_is_cached(self, filename, kernel=None):
+        '''
+        Checks whether the instrumented version of the provided file (or of the provided kernel of it) has been cached,
+        i.e. whether it has been written to any directory of the cache (which happens atomically, after a successful
+        instrumentation)
+        '''
+        return self.find_artifact(self.get_name_of_instrumented_file(filename, kernel)) is not None
+
+    def get_file_kernels(self, filename):
+        '''
+        Returns a list of the kernels present in the provided file. Unless the current process has already parsed it,
+        the file is only scanned for them (see `scan_kernels`), as parsing a large file may take longer than running
+        its kernels; it is parsed (and its parsed unit cached) only if the scanner is unsure
+        '''
+        digest = self.digest(filename)
+        if digest not in self.parsed_units:
+            source = preprocess_file(filename)
+            # kept, so that the file is not preprocessed again if it is parsed next
+            CachedFiles.scanned_source = (digest, source)
+            kernels = scan_kernels(source)
+            if kernels is not None:
+                return kernels
+        return self.get_parsed_unit(filename)['kernels']
+
+    def get_parsed_unit(self, filename, use_cache=True):
+        '''
+        Returns the parsed unit of the provided file (see `parse_unit`). Each file is preprocessed and parsed
+        only once, as its parsed unit is cached (by digest) both on disk and in the memory of the current process.
+        Every call returns a new copy of the parsed unit, which the caller is free to edit (e.g. its AST)
+        '''
+        digest = self.digest(filename)
+        unit_file = self.get_name_of_parsed_unit_file(digest)
+
+        def read_unit():
+            try:
+                # pickles are never loaded from the shared directories, as unpickling may execute arbitrary code
+                with open(unit_file, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+        def parse_and_store_unit():
+            scanned_digest, scanned_source = CachedFiles.scanned_source
+            unit = parse_unit(filename, scanned_source if scanned_digest == digest else None)
+            try:
+                pickled_unit = pickle.dumps(unit)
+            except RecursionError:
+                # (very) deeply nested source code; it will just be parsed again next time
+                return unit, None
+            self.store_artifact(unit_file, pickled_unit)
+            return unit, pickled_unit
+
+        if not use_cache:
+            unit, pickled_unit = parse_and_store_unit()
+            if pickled_unit is None:
+                return unit
+        else:
+            pickled_unit = self.parsed_units.get(digest)
+            if pickled_unit is None:
+                pickled_unit = read_unit()
+                is_cached = pickled_unit is not None
+                if not is_cached:
+                    # another process may already be parsing the same file; wait for it instead of parsing it again
+                    with self.lock(unit_file):
+                        pickled_unit = read_unit()
+                        is_cached = pickled_unit is not None
+                        if not is_cached:
+                            unit, pickled_unit = parse_and_store_unit()
+                self.record_access(unit_file, is_cached)
+                if pickled_unit is None:
+                    return unit
+
+        self.parsed_units[digest] = pickled_unit
+        return pickle.loads(pickled_unit)
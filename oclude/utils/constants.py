@@ -1,5 +1,4 @@
 import os
-from tempfile import gettempdir
 
 ########################
 ### OCLUDE CONSTANTS ###
@@ -20,11 +19,53 @@ llvm_instructions = [
     'landingpad', 'catchpad', 'cleanuppad'
 ]
 
+# the load/store instructions, the bytes moved by which are also counted
+memory_instructions = [i for i in llvm_instructions if i.split()[0] in ['load', 'store']]
+memory_bytes_counters = [i + ' bytes' for i in memory_instructions]
+
+# float operations are counted per vector lane (fma/mad count as 2 per lane)
+float_ops_counter = 'float ops'
+
+# the hidden counters of an instrumented kernel:
+# the LLVM instructions, followed by the bytes moved and the float operations
+hidden_counters = llvm_instructions + memory_bytes_counters + [float_ops_counter]
+
+# the transfer sizes (in bytes) for which the bandwidth of a device is measured,
+# by default and in quick mode
+default_transfer_sizes = [1 << i for i in range(6, 31, 2)]
+quick_transfer_sizes = [1 << 10, 1 << 20, 1 << 26]
+
+# seconds after which a cached device profile is measured again (30 days)
+device_profile_max_age = 30 * 24 * 60 * 60
+
+# seconds after which the cached timings of a kernel run are measured again (1 day)
+profiling_result_max_age = 24 * 60 * 60
+
+# seconds after which a forked process that looks up (or profiles) the device is given up on (1 hour)
+forked_process_timeout = 60 * 60
+
+# the size (in MiB) that the artifacts of the cache may occupy before the least recently used ones are evicted
+default_cache_budget = 256
+
+# the size (in bytes) of the chunks in which input files are copied to devices without host unified memory
+input_chunk_size = 64 * 1024 * 1024
+
 preprocessor = 'cpp'
 
 bindir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
 
-templlvm = os.path.join(gettempdir(), '.oclude_tmp_instr_ll.ll')
+# the compiler of OpenCL C to LLVM bitcode and the parser of the instrumentation data out of it
+cl2llCompiler = 'clang'
+instrumentationGetter = os.path.join(bindir, 'instrumentation-parser')
 
 hidden_counter_name_local = 'ocludeHiddenCounterLocal'
 hidden_counter_name_global = 'ocludeHiddenCounterGlobal'
+hidden_counter_group_offset = 'OCLUDE_HIDDEN_GROUP_OFFSET'
+
+# must be bumped every time the instrumentation changes in a way
+# that makes previously cached instrumented files unusable
+instrumentation_version = 3
+
+# must be bumped every time the values that the arguments of a kernel get for a given seed change
+# (see `ArgumentGenerator`), as the results of the runs cached before are not reproducible anymore
+argument_generator_version = 2
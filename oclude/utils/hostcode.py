@@ -4,96 +4,272 @@ from pyopencl.tools import get_or_register_dtype, match_dtype_to_c_struct
 import pyopencl.characterize.performance as clperf
 
 from oclude.utils.interactor import Interactor
+from oclude.utils.cachedfiles import CachedFiles
+from oclude.utils.metrics import get_group_imbalance, get_memory_traffic_report
+from oclude.utils.microbenchmarks import get_device_microbenchmarks, is_failed_measurement, without_failed_measurements
+from oclude.utils.kernelargs import ArgumentGenerator, open_input
 from oclude.utils.constants import (
     llvm_instructions,
+    memory_instructions,
+    hidden_counters,
+    float_ops_counter,
     hidden_counter_name_local,
     hidden_counter_name_global,
-    preprocessor
+    hidden_counter_group_offset,
+    default_transfer_sizes,
+    quick_transfer_sizes,
+    device_profile_max_age,
+    input_chunk_size
 )
 
-from pycparserext.ext_c_parser import OpenCLCParser
-from pycparser.c_ast import *
-
-from rvg import NumPyRVG
 import numpy as np
 import os
+import hashlib
+import socket
 from tqdm import trange
 from time import time
 
-def create_struct_type(device, struct_name, struct):
+def create_struct_type(device, struct_name, fields, layout=None):
+    '''
+    Creates (and registers) the dtype of the provided struct, out of the dtypes of its fields
+    (a list of (name, dtype) or (name, dtype, number of elements) tuples). If the layout of the struct
+    on the device (its field names and offsets and its itemsize) is not provided, it is measured on the device
+    (which compiles and runs a probe kernel). Returns the dtype and the layout of the struct
+    '''
+    field_names = [field[0] for field in fields]
+    if layout is None or layout['names'] != field_names:
+        struct_dtype, _ = match_dtype_to_c_struct(device, struct_name, np.dtype(fields))
+        layout = {
+            'names':    field_names,
+            'offsets':  [struct_dtype.fields[name][1] for name in field_names],
+            'itemsize': struct_dtype.itemsize
+        }
+    else:
+        struct_dtype = np.dtype({
+            'names':    field_names,
+            'formats':  [np.dtype(field[1:]) if len(field) > 2 else field[1] for field in fields],
+            'offsets':  layout['offsets'],
+            'itemsize': layout['itemsize']
+        })
+    struct_dtype = get_or_register_dtype(struct_name, struct_dtype)
+    return struct_dtype, layout
 
-    def create_array_type(name, decl):
-        dtype = get_or_register_dtype(''.join(decl.type.type.type.names))
-        if isinstance(decl.type.dim, Constant):
-            dims = int(decl.type.dim.value)
-        elif isinstance(decl.type.dim, BinaryOp) and decl.type.dim.op == '+':
-            dims = int(decl.type.dim.left.value) + int(decl.type.dim.right.value)
+def resolve_struct_type(device, unit, typename, layouts, struct_types):
+    '''
+    Returns the dtype of the struct with the provided type name, out of the description of the struct in the
+    provided parsed unit. Its layout is taken out of `layouts` (the cached layouts of the structs of the unit
+    on the device), or else measured and added to `layouts`. The structs that it is made of are resolved first.
+    All the resolved dtypes are kept in `struct_types`, by type name
+    '''
+    if typename in struct_types:
+        return struct_types[typename]
+
+    struct = unit['structs'][typename]
+    fields = []
+    for field_name, field_type, dims in struct['fields']:
+        if field_type is None:
+            raise NotImplementedError(f'field `{field_name}` of struct `{struct["name"]}` has a type that can not be understood')
+        field_typename = unit['typedefs'].get(field_type, field_type)
+        if field_typename in unit['structs']:
+            field_dtype = resolve_struct_type(device, unit, field_typename, layouts, struct_types)
         else:
-            raise NotImplementedError
-        return name, dtype, dims
-
-    field_decls = struct.decls
-    struct_fields = []
-    # iterate over struct fields
-    for field_decl in field_decls:
-        field_name = field_decl.name
-        # field is a scalar
-        if isinstance(field_decl.type, TypeDecl):
-            type_name = ' '.join(field_decl.type.type.names)
-            field_type = type_name if type_name != 'bool' else 'char'
-            struct_fields.append((field_name, get_or_register_dtype(field_type)))
-        # field is an array with defined size
-        elif isinstance(field_decl.type, ArrayDecl):
-            struct_fields.append(create_array_type(field_name, field_decl))
+            field_dtype = get_or_register_dtype(field_type)
+        # field is a scalar or an array with defined size
+        fields.append((field_name, field_dtype) if dims is None else (field_name, field_dtype, dims))
+
+    struct_types[typename], layouts[typename] = create_struct_type(device, struct['name'], fields, layouts.get(typename))
+    return struct_types[typename]
+
+def device_has_host_unified_memory(device):
+    try:
+        return bool(device.get_info(cl.device_info.HOST_UNIFIED_MEMORY))
+    except cl.Error:
+        return False
+
+def get_buffer_sizes(device, kernel, args, arg_types, gsize, arg_sizes=None):
+    '''
+    Returns the number of elements of each buffer argument of the kernel: its size in `arg_sizes` (see `get_arg_sizes`),
+    if it has one, otherwise gsize. Local buffers without a size share the local memory that is left by the rest evenly
+    (up to gsize elements each), so that they fit in the local memory of the device
+    '''
+    arg_sizes = arg_sizes or {}
+    buffer_sizes = {}
+    auto_local_args = []
+    local_mem_left = device.local_mem_size - kernel.get_work_group_info(cl.kernel_work_group_info.LOCAL_MEM_SIZE, device)
+
+    for (argname, argtypename, argaddrqual), argtype in zip(args, arg_types.values()):
+        if argname == hidden_counter_name_local:
+            local_mem_left -= len(hidden_counters) * np.dtype(argtype).itemsize
+        if argname in [hidden_counter_name_local, hidden_counter_name_global] or len(argtypename.split('*')) == 1:
+            continue
+        if argname in arg_sizes:
+            buffer_sizes[argname] = arg_sizes[argname]
+            if argaddrqual == 'local':
+                local_mem_left -= arg_sizes[argname] * np.dtype(argtype).itemsize
+        elif argaddrqual == 'local':
+            auto_local_args.append((argname, argtype))
         else:
-            raise NotImplementedError(f'field `{field_name}` of struct `{struct_name}` has a type that can not be understood')
+            buffer_sizes[argname] = gsize
 
-    # register struct
-    struct_dtype = np.dtype(struct_fields)
-    struct_dtype, _ = match_dtype_to_c_struct(device, struct_name, struct_dtype)
-    struct_dtype = get_or_register_dtype(struct_name, struct_dtype)
-    return struct_dtype
+    for argname, argtype in auto_local_args:
+        buffer_sizes[argname] = max(min(gsize, local_mem_left // len(auto_local_args) // np.dtype(argtype).itemsize), 1)
 
-def init_kernel_arguments(context, args, arg_types, gsize):
+    return buffer_sizes
+
+def get_argument_specs(args, arg_types, buffer_sizes, inputs=()):
+    '''
+    Returns the (dtype, number of values) of each argument that needs random values (see `ArgumentGenerator`),
+    i.e. of each non local argument that is neither an oclude hidden buffer nor provided by the inputs
+    (None for the number of values of scalars)
+    '''
+    return [
+        (argtype, buffer_sizes.get(argname))
+        for (argname, argtypename, argaddrqual), argtype in zip(args, arg_types.values())
+        if argname not in [hidden_counter_name_local, hidden_counter_name_global, *inputs] and argaddrqual != 'local'
+    ]
 
+def create_input_buffer(context, queue, values, host_unified):
+    '''
+    Creates a buffer out of the (memory-mapped) values of an input file: devices with host unified memory
+    use the values in place, others get them copied in chunks, so that the file is never loaded as a whole
+    '''
+    if host_unified:
+        return cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.USE_HOST_PTR, hostbuf=values)
+    buf = cl.Buffer(context, cl.mem_flags.READ_WRITE, size=values.nbytes)
+    chunk = max(input_chunk_size // values.itemsize, 1)
+    for start in range(0, len(values), chunk):
+        cl.enqueue_copy(queue, buf, values[start:start + chunk], dst_offset=start * values.itemsize)
+    return buf
+
+def get_host_buffer(context, host_buffers, argname, size):
+    '''
+    Returns the host allocated buffer of the provided argument, creating it on first use
+    '''
+    if argname not in host_buffers:
+        host_buffers[argname] = cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR, size=size)
+    return host_buffers[argname]
+
+def map_buffer(queue, buf, flags, dtype):
+    '''
+    Maps the whole of the provided buffer to a host array of the provided type (without a copy, on devices
+    with host unified memory); the mapping must be released (`array.base.release()`) before the buffer is used
+    '''
+    dtype = np.dtype(dtype)
+    array, _ = cl.enqueue_map_buffer(queue, buf, flags, 0, (buf.size // dtype.itemsize,), dtype)
+    return array
+
+def init_kernel_arguments(context, queue, args, arg_types, buffer_sizes, generator, sample, inputs=None, n_groups=1, host_buffers=None):
+    '''
+    Creates the arguments of the kernel for the provided sample, with buffers of `buffer_sizes` elements (see
+    `get_buffer_sizes`): the random values of the arguments described by `get_argument_specs` come from `generator`,
+    and the rest from `inputs` (see `load_inputs`).
+    On devices with host unified memory, `host_buffers` are the host allocated buffers of the arguments,
+    which are reused by all samples and filled in place through a mapping, instead of being copied
+    '''
     arg_bufs, which_are_scalar = [], []
     hidden_global_hostbuf, hidden_global_buf = None, None
     mem_flags = cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR
-    rand = NumPyRVG(limit=gsize)
+    inputs = inputs or {}
+    host_unified = host_buffers is not None
+    # the positions of the arguments with random values and their mappings (if they are mapped)
+    random_args, mapped_values = [], []
 
     for (argname, argtypename, argaddrqual), argtype in zip(args, arg_types.values()):
 
         # special handling of oclude hidden buffers
         if argname == hidden_counter_name_local:
             which_are_scalar.append(None)
-            arg_bufs.append(cl.LocalMemory(len(llvm_instructions) * argtype(0).itemsize))
+            arg_bufs.append(cl.LocalMemory(len(hidden_counters) * argtype(0).itemsize))
             continue
         if argname == hidden_counter_name_global:
             which_are_scalar.append(None)
-            hidden_global_hostbuf = np.zeros(len(llvm_instructions), dtype=argtype)
-            hidden_global_buf = cl.Buffer(context, mem_flags, hostbuf=hidden_global_hostbuf)
+            # one slice of counters per work group (if requested)
+            if host_unified:
+                hidden_global_buf = get_host_buffer(
+                    context, host_buffers, argname, n_groups * len(hidden_counters) * np.dtype(argtype).itemsize
+                )
+                counters = map_buffer(queue, hidden_global_buf, cl.map_flags.WRITE, argtype)
+                counters[...] = 0
+                counters.base.release(queue)
+            else:
+                hidden_global_hostbuf = np.zeros(n_groups * len(hidden_counters), dtype=argtype)
+                hidden_global_buf = cl.Buffer(context, mem_flags, hostbuf=hidden_global_hostbuf)
             arg_bufs.append(hidden_global_buf)
             continue
 
         argtypename_split = argtypename.split('*')
-        argtypename_base = argtypename_split[0]
         arg_is_local = argaddrqual == 'local'
         # argument is scalar
         if len(argtypename_split) == 1:
             which_are_scalar.append(argtype)
-            val = rand(argtype)
-            arg_bufs.append(val if not arg_is_local else cl.LocalMemory(val.itemsize))
+            if argname in inputs:
+                arg_bufs.append(open_input(inputs[argname], argtype)[0])
+            elif arg_is_local:
+                arg_bufs.append(cl.LocalMemory(np.dtype(argtype).itemsize))
+            else:
+                random_args.append(len(arg_bufs))
+                mapped_values.append(None)
+                arg_bufs.append(None)
         # argument is buffer
         else:
             which_are_scalar.append(None)
-            val = rand(argtype, gsize)
-            arg_bufs.append(
-                cl.Buffer(context, mem_flags, hostbuf=val) if not arg_is_local else cl.LocalMemory(len(val) * val.dtype.itemsize)
-            )
+            if argname in inputs:
+                arg_bufs.append(create_input_buffer(context, queue, open_input(inputs[argname], argtype), host_unified))
+            elif arg_is_local:
+                arg_bufs.append(cl.LocalMemory(buffer_sizes[argname] * np.dtype(argtype).itemsize))
+            elif host_unified:
+                buf = get_host_buffer(context, host_buffers, argname, buffer_sizes[argname] * np.dtype(argtype).itemsize)
+                random_args.append(len(arg_bufs))
+                mapped_values.append(map_buffer(queue, buf, cl.map_flags.WRITE, argtype))
+                arg_bufs.append(buf)
+            else:
+                random_args.append(len(arg_bufs))
+                mapped_values.append(None)
+                arg_bufs.append(None)
+
+    # the random values are generated in place, into the mapped buffers (if any)
+    values = generator.generate(sample, mapped_values)
+    for arg_idx, value, mapped in zip(random_args, values, mapped_values):
+        if mapped is not None:
+            mapped.base.release(queue)
+        elif which_are_scalar[arg_idx] is not None:
+            arg_bufs[arg_idx] = value
+        else:
+            arg_bufs[arg_idx] = cl.Buffer(context, mem_flags, hostbuf=value)
 
     return arg_bufs, which_are_scalar, hidden_global_hostbuf, hidden_global_buf
 
-def profile_opencl_device(platform_id=0, device_id=0, verbose=False):
+def get_device_profile_key(device):
+    '''
+    Returns the key under which the profile of the provided device is cached, i.e. a digest
+    of its platform, its name and its driver version, as well as of the host it is attached to
+    '''
+    key = '|'.join([device.platform.name, device.name, device.driver_version, socket.gethostname()])
+    return hashlib.md5(key.encode()).hexdigest()
+
+def get_selected_device_info(platform_id=0, device_id=0):
+    '''
+    Returns the name of the selected device, the name of its platform and its key (see `get_device_profile_key`)
+    '''
+    device = cl.get_platforms()[platform_id].get_devices()[device_id]
+    return {
+        'platform': device.platform.name,
+        'device':   device.name,
+        'key':      get_device_profile_key(device)
+    }
+
+def get_cached_device_profile(platform_id=0, device_id=0, max_age=device_profile_max_age):
+    '''
+    Returns the cached profile of the selected device (without measuring anything),
+    or None if there is no (recent enough) cached profile
+    '''
+    device = cl.get_platforms()[platform_id].get_devices()[device_id]
+    cached_profile = CachedFiles().get_device_profile(get_device_profile_key(device), max_age)
+    return cached_profile['profile'] if cached_profile else None
+
+def profile_opencl_device(platform_id=0, device_id=0, verbose=False,
+                          quick=False, transfer_sizes=None,
+                          refresh=False, max_age=device_profile_max_age):
 
     interact = Interactor(__file__.split(os.sep)[-1])
     interact.set_verbosity(verbose)
@@ -103,51 +279,127 @@ def profile_opencl_device(platform_id=0, device_id=0, verbose=False):
     context = cl.Context([device])
     queue = cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
 
-    interact('Collecting profiling info for the following device:')
-    interact('Platform:\t' + platform.name)
-    interact('Device:\t' + device.name)
-    interact('Version:\t' + device.version.strip())
-    interact('Please wait, this may take a while...')
-    prof_overhead, latency = clperf.get_profiling_overhead(context)
-    h2d_latency = clperf.transfer_latency(queue, clperf.HostToDeviceTransfer) * 1000
-    d2h_latency = clperf.transfer_latency(queue, clperf.DeviceToHostTransfer) * 1000
-    d2d_latency = clperf.transfer_latency(queue, clperf.DeviceToDeviceTransfer) * 1000
-
-    device_profile = {
-        'profiling overhead (time)': prof_overhead * 1000,
-        'profiling overhead (percentage)': f'{(100 * prof_overhead / latency):.2f}%',
-        'command latency': latency * 1000,
-        'host-to-device transfer latency': h2d_latency,
-        'device-to-host transfer latency': d2h_latency,
-        'device-to-device transfer latency': d2d_latency
-    }
-
-    for tx_type, tx_type_name in zip(
-                [clperf.HostToDeviceTransfer, clperf.DeviceToHostTransfer, clperf.DeviceToDeviceTransfer],
-                ['host-device', 'device-host', 'device-device']
-            ):
+    if transfer_sizes is None:
+        transfer_sizes = quick_transfer_sizes if quick else default_transfer_sizes
+
+    cache = CachedFiles()
+    key = get_device_profile_key(device)
+    # measurements of the same device by concurrent processes would disturb each other, so only one process
+    # at a time profiles it; the rest wait for it and reuse its (cached) profile
+    with cache.lock(cache.get_name_of_device_profile_file(key)):
+        # only measure what has not been measured (recently) for this device
+        cached_profile = None if refresh else cache.get_device_profile(key, max_age)
+        if cached_profile is not None:
+            interact('INFO: Using cached profiling info for the selected device (use `--refresh` to measure again)')
+            # (profiles cached by older versions may hold failed measurements, which are measured again)
+            device_profile, timestamp = without_failed_measurements(cached_profile['profile']), cached_profile['timestamp']
+        else:
+            device_profile, timestamp = {}, None
+
+        measured = False
+
+        def notify_measuring():
+            nonlocal measured
+            if not measured:
+                interact('Collecting profiling info for the following device:')
+                interact('Platform:\t' + platform.name)
+                interact('Device:\t' + device.name)
+                interact('Version:\t' + device.version.strip())
+                interact('Please wait, this may take a while...')
+            measured = True
+
+        if 'command latency' not in device_profile:
+            notify_measuring()
+            prof_overhead, latency = clperf.get_profiling_overhead(context)
+            h2d_latency = clperf.transfer_latency(queue, clperf.HostToDeviceTransfer) * 1000
+            d2h_latency = clperf.transfer_latency(queue, clperf.DeviceToHostTransfer) * 1000
+            d2d_latency = clperf.transfer_latency(queue, clperf.DeviceToDeviceTransfer) * 1000
+
+            device_profile.update({
+                'profiling overhead (time)': prof_overhead * 1000,
+                'profiling overhead (percentage)': f'{(100 * prof_overhead / latency):.2f}%',
+                'command latency': latency * 1000,
+                'host-to-device transfer latency': h2d_latency,
+                'device-to-host transfer latency': d2h_latency,
+                'device-to-device transfer latency': d2d_latency
+            })
+
+        for tx_type, tx_type_name in zip(
+                    [clperf.HostToDeviceTransfer, clperf.DeviceToHostTransfer, clperf.DeviceToDeviceTransfer],
+                    ['host-device', 'device-host', 'device-device']
+                ):
+            tx_type_bw = tx_type_name + ' bandwidth'
+            device_profile.setdefault(tx_type_bw, {})
+            for bs in transfer_sizes:
+                if f'{bs} bytes' in device_profile[tx_type_bw]:
+                    continue
+                notify_measuring()
+                try:
+                    bw = str(clperf.transfer_bandwidth(queue, tx_type, bs)/1e9) + ' GB/s'
+                except Exception as e:
+                    bw = 'exception: ' + e.__class__.__name__
+                device_profile[tx_type_bw][f'{bs} bytes'] = bw
+
+        # on-device compute and memory microbenchmarks
+        device_profile.update(get_device_microbenchmarks(context, queue, device_profile, notify_measuring))
+
+        # failed measurements are not cached, so that they are measured again next time
+        if measured:
+            cache.store_device_profile(key, without_failed_measurements(device_profile), timestamp)
+
+    # report only the requested transfer sizes (the cache may hold more)
+    device_profile = dict(device_profile)
+    for tx_type_name in ['host-device', 'device-host', 'device-device']:
         tx_type_bw = tx_type_name + ' bandwidth'
-        device_profile[tx_type_bw] = {}
-        for i in range(6, 31, 2):
-            bs = 1 << i
-            try:
-                bw = str(clperf.transfer_bandwidth(queue, tx_type, bs)/1e9) + ' GB/s'
-            except Exception as e:
-                bw = 'exception: ' + e.__class__.__name__
-            device_profile[tx_type_bw][f'{bs} bytes'] = bw
+        device_profile[tx_type_bw] = dict((f'{bs} bytes', device_profile[tx_type_bw][f'{bs} bytes']) for bs in transfer_sizes)
 
     return device_profile
 
+def get_device_peaks(platform_id=0, device_id=0, verbose=False):
+    '''
+    Returns the peaks of the selected device that define its roofline, i.e. its peak float
+    throughput (in GFLOP/s) and its peak global memory bandwidth (in GB/s), out of
+    its (cached, if possible) profile. Raises a ValueError if either of them could not be measured
+    '''
+    device_profile = profile_opencl_device(platform_id, device_id, verbose, transfer_sizes=[])
+
+    def value(measurement):
+        return float(measurement.split()[0])
+
+    float_ops = device_profile['arithmetic throughput']['float']
+    bandwidths = [value(v) for v in device_profile['global memory bandwidth'].values() if not is_failed_measurement(v)]
+    if is_failed_measurement(float_ops) or not bandwidths:
+        raise ValueError(
+            'the peak float throughput or global memory bandwidth of the selected device could not be measured '
+            f"(float throughput: {float_ops}, global memory bandwidth: {device_profile['global memory bandwidth']})"
+        )
+
+    return {
+        'peak float ops':        value(float_ops),
+        'peak global bandwidth': max(bandwidths)
+    }
+
 def run_kernel(kernel_file_path, kernel_name,
                gsize, lsize,
                platform_id, device_id,
                samples,
                instcounts, timeit,
-               verbose):
+               verbose,
+               pergroup=False,
+               source_file_path=None,
+               seed=None,
+               inputs=None,
+               arg_sizes=None):
     '''
     The hostcode wrapper function
     Essentially, it is nothing more than an OpenCL template hostcode,
-    but it is the heart of oclude
+    but it is the heart of oclude.
+    The types of struct arguments are resolved out of the (parsed unit of the)
+    source file that the kernel comes from, which defaults to the kernel file itself.
+    The random inputs of the kernel (and thus its results) are reproducible for a given `seed`;
+    if none is provided, a fresh one is used (and reported).
+    The arguments that are found in `inputs` (see `load_inputs`) get their real inputs instead.
+    Buffers are sized by `arg_sizes` (see `get_buffer_sizes`)
     '''
 
     interact = Interactor(__file__.split(os.sep)[-1])
@@ -172,7 +424,20 @@ def run_kernel(kernel_file_path, kernel_name,
     context = cl.Context([device])
     with open(kernel_file_path, 'r') as kernel_file:
         kernel_source = '#pragma OPENCL EXTENSION cl_khr_int64_base_atomics : enable\n' + kernel_file.read()
-    program = cl.Program(context, kernel_source).build()
+
+    # each work group gets its own slice of the global hidden counter
+    n_groups = 1
+    if instcounts and pergroup:
+        if hidden_counter_group_offset not in kernel_source:
+            interact('ERROR: The instrumented file does not support per work group instruction counts.')
+            interact('       Please run oclude with `--ignore-cache` or `--clear-cache` to instrument it again.')
+            exit(1)
+        n_groups = (gsize + lsize - 1) // lsize
+        kernel_source = (
+            f'#define {hidden_counter_group_offset} (get_group_id(0) * {len(hidden_counters)})\n' + kernel_source
+        )
+    # kernel arg info is only guaranteed to be available if explicitly requested at build time
+    program = cl.Program(context, kernel_source).build(options=['-cl-kernel-arg-info'])
 
     if timeit:
         queue = cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
@@ -202,10 +467,8 @@ def run_kernel(kernel_file_path, kernel_name,
 
     ### step 3: collect arg types ###
     arg_types = {}
-    parser = None
-    ast = None
-    typedefs = {}
-    structs = {}
+    unit = None
+    struct_types = {}
 
     for kernel_arg_name, kernel_arg_type_name, _ in args:
 
@@ -216,41 +479,73 @@ def run_kernel(kernel_file_path, kernel_name,
             arg_types[kernel_arg_name] = eval('cltypes.' + argtype_base)
 
         except AttributeError:
-            # it is a struct (lazy evaluation of structs)
-            if parser is None:
-                parser = OpenCLCParser()
-                cmdout, _ = interact.run_command(None, preprocessor, kernel_file_path)
-                kernel_source = '\n'.join(filter(lambda line : line.strip() and not line.startswith('#'), cmdout.splitlines()))
-                ast = parser.parse(kernel_source)
-
-                for ext in ast.ext:
-
-                    ### typedefs ###
-                    if isinstance(ext, Typedef):
-                        if isinstance(ext.type.type, Struct):
-                            # typedefed struct (new)
-                            if ext.type.type.decls is not None:
-                                typedefs[ext.name] = create_struct_type(device, ext.name, ext.type.type)
-                            # typedefed struct (already seen it)
-                            else:
-                                previous_name = 'struct ' + ext.type.type.name
-                                new_name = ext.name
-                                typedefs[new_name] = structs[previous_name]
-                        # simple typedef (not a struct)
-                        else:
-                            previous_name = ' '.join(ext.type.type.names)
-                            new_name = ext.name
-                            typedefs[new_name] = ext.type
-
-                    ### struct declarations ###
-                    elif isinstance(ext, Decl) and isinstance(ext.type, Struct):
-                        name = 'struct ' + ext.type.name
-                        structs[name] = create_struct_type(device, ext.type.name, ext.type)
-
-            try:
-                arg_types[kernel_arg_name] = structs[argtype_base]
-            except KeyError:
-                arg_types[kernel_arg_name] = typedefs[argtype_base]
+            # it is a struct (lazy evaluation of the structs used by the arguments only, out of the
+            # parsed unit of the source file and the layouts of its structs cached for this device)
+            if unit is None:
+                cache = CachedFiles()
+                struct_source_file_path = source_file_path or kernel_file_path
+                struct_layouts_key = (cache.digest(struct_source_file_path), get_device_profile_key(device))
+                unit = cache.get_parsed_unit(struct_source_file_path)
+                struct_layouts = cache.get_struct_layouts(*struct_layouts_key)
+                cached_struct_layouts = dict(struct_layouts)
+
+            typename = unit['typedefs'].get(argtype_base, argtype_base)
+            if typename in unit['structs']:
+                arg_types[kernel_arg_name] = resolve_struct_type(device, unit, typename, struct_layouts, struct_types)
+            else:
+                arg_types[kernel_arg_name] = get_or_register_dtype(typename)
+
+    if unit is not None and struct_layouts != cached_struct_layouts:
+        cache.store_struct_layouts(*struct_layouts_key, struct_layouts)
+
+    # the explicit sizes of buffers replace gsize (while local buffers are sized to fit in local memory)
+    arg_sizes = arg_sizes or {}
+    unknown_arg_sizes = set(arg_sizes) - set(argname for argname, _, _ in args)
+    if unknown_arg_sizes:
+        interact(f"ERROR: Kernel '{kernel_name}' has no argument named {', '.join(sorted(unknown_arg_sizes))}")
+        exit(1)
+    buffer_sizes = get_buffer_sizes(device, kernel, args, arg_types, gsize, arg_sizes)
+    for argname in arg_sizes:
+        if argname not in buffer_sizes:
+            interact(f"ERROR: Argument '{argname}' is not a buffer, so it can not have a size")
+            exit(1)
+    for argname, size in buffer_sizes.items():
+        if size != gsize:
+            interact(f"Argument '{argname}' is a buffer of {size} element{'s' if size > 1 else ''}")
+
+    # the real inputs replace the random values of their arguments
+    inputs = inputs or {}
+    host_unified = device_has_host_unified_memory(device)
+    for argname, argtypename, argaddrqual in args:
+        if argname not in inputs:
+            continue
+        if argaddrqual == 'local':
+            interact(f"ERROR: Argument '{argname}' is local, so it can not have an input")
+            exit(1)
+        try:
+            n_values = len(open_input(inputs[argname], arg_types[argname]))
+        except (OSError, ValueError) as e:
+            interact(f"ERROR: Invalid input of argument '{argname}': {e}")
+            exit(1)
+        interact(f"Argument '{argname}' gets its {n_values} value{'s' if n_values > 1 else ''} out of its input")
+        # the kernel would read (and write) past the end of the input
+        if argname in buffer_sizes and n_values < buffer_sizes[argname]:
+            interact(f"ERROR: The input of argument '{argname}' has fewer values ({n_values}) than its size "
+                     f"({buffer_sizes[argname]}); select a smaller size with `--arg-size`")
+            exit(1)
+    unknown_inputs = set(inputs) - set(argname for argname, _, _ in args)
+    if unknown_inputs:
+        interact(f"ERROR: Kernel '{kernel_name}' has no argument named {', '.join(sorted(unknown_inputs))}")
+        exit(1)
+
+    # the arrays of the random arguments are allocated once and refilled by each sample
+    generator = ArgumentGenerator(get_argument_specs(args, arg_types, buffer_sizes, inputs), gsize, seed)
+    interact(f'Seed of the kernel arguments: {generator.seed}')
+
+    # the arguments of devices with host unified memory are allocated once, on the host
+    host_buffers = {} if host_unified else None
+    if host_unified:
+        interact('The device has host unified memory; the buffer arguments are filled in place')
 
     ### run the kernel as many times are requested by the user ###
     interact(f'About to execute kernel with Global NDRange = {gsize}' + (f' and Local NDRange = {lsize}' if lsize else ''))
@@ -259,7 +554,7 @@ def run_kernel(kernel_file_path, kernel_name,
     n_executions = trange(samples, unit=' kernel executions') if samples > 1 else range(1)
     results = []
 
-    for _ in n_executions:
+    for sample in n_executions:
 
         ### step 4: create argument buffers ###
         (
@@ -267,7 +562,9 @@ def run_kernel(kernel_file_path, kernel_name,
             which_are_scalar,
             hidden_global_hostbuf,
             hidden_global_buf
-        ) = init_kernel_arguments(context, args, arg_types, gsize)
+        ) = init_kernel_arguments(
+            context, queue, args, arg_types, buffer_sizes, generator, sample, inputs, n_groups, host_buffers
+        )
 
         ### step 5: set kernel arguments and run it!
         kernel.set_scalar_arg_dtypes(which_are_scalar)
@@ -294,9 +591,25 @@ def run_kernel(kernel_file_path, kernel_name,
         if instcounts:
             if not samples > 1:
                 interact('Collecting instruction counts...')
-            global_counter = np.empty_like(hidden_global_hostbuf)
-            cl.enqueue_copy(queue, global_counter, hidden_global_buf)
-            this_run_results['instcounts'] = dict(zip(llvm_instructions, global_counter.tolist()))
+            if host_unified:
+                counters = map_buffer(queue, hidden_global_buf, cl.map_flags.READ, arg_types[hidden_counter_name_global])
+                global_counter = counters.copy()
+                counters.base.release(queue)
+            else:
+                global_counter = np.empty_like(hidden_global_hostbuf)
+                cl.enqueue_copy(queue, global_counter, hidden_global_buf)
+            if pergroup:
+                group_counters = global_counter.reshape(n_groups, len(hidden_counters))[:, :len(llvm_instructions)]
+                this_run_results['group instcounts'] = group_counters.tolist()
+                this_run_results['group imbalance'] = get_group_imbalance(group_counters)
+                global_counter = global_counter.reshape(n_groups, len(hidden_counters)).sum(axis=0)
+            global_counter = global_counter.tolist()
+            this_run_results['instcounts'] = dict(zip(llvm_instructions, global_counter))
+            # the bytes moved by each type of load/store instruction
+            this_run_results['memory traffic'] = dict(
+                zip(memory_instructions, global_counter[len(llvm_instructions):len(llvm_instructions) + len(memory_instructions)])
+            )
+            this_run_results[float_ops_counter] = global_counter[hidden_counters.index(float_ops_counter)]
 
         if timeit:
             if not samples > 1:
@@ -309,6 +622,13 @@ def run_kernel(kernel_file_path, kernel_name,
                 'transfer': hostcode_time_elapsed - device_time_elapsed
             }
 
+        if instcounts:
+            this_run_results['memory report'] = get_memory_traffic_report(
+                this_run_results['memory traffic'],
+                this_run_results[float_ops_counter],
+                this_run_results['timeit']['device'] if timeit else None
+            )
+
         if this_run_results:
             results.append(this_run_results)
 
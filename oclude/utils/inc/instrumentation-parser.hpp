@@ -2,20 +2,31 @@
 #define __IP_HPP__
 
 #include <iostream>
+#include <sstream>
 #include <string>
 #include <vector>
+#include <map>
 
 #include <llvm/IR/Module.h>
 #include <llvm/IR/Instructions.h>
+#include <llvm/IR/Intrinsics.h>
 #include <llvm/IR/Operator.h>
 #include <llvm/IR/DebugInfoMetadata.h>
 #include <llvm/IRReader/IRReader.h>
 #include <llvm/Support/SourceMgr.h>
+#include <llvm/Support/MemoryBuffer.h>
 #include <llvm/Support/Casting.h>
+#include <llvm/Config/llvm-config.h>
 
 #include "message-printer.hpp"
 
-MessagePrinter print_message(__FILE__, "<.ll or .bc file>");
+MessagePrinter print_message(__FILE__, "[--json] <.ll or .bc file> [<.ll or .bc file> ...] | --stream | --version");
+
+/*
+ * the version of the instrumentation data that this parser reports;
+ * it must be bumped every time they change, as oclude keys its cache by it
+ */
+#define INSTRUMENTATION_PARSER_VERSION "1"
 
 /*
  * OpenCL address spaces, as per the documentation here:
@@ -32,6 +43,7 @@ typedef std::map<std::string, bb_instrumentation_t> instrumentation_t;
 
 inline void parse_input_file(std::string filename) {
     llvm::SMDiagnostic error;
+    m.reset();
     m = parseIRFile(filename, error, context);
     if(!m) {
         print_message("problem occured while parsing IR file " + filename + ": " + error.getMessage().str());
@@ -40,6 +52,18 @@ inline void parse_input_file(std::string filename) {
     return;
 }
 
+/* parses the provided in-memory IR; returns an empty string on success, the error message otherwise */
+inline std::string parse_input_buffer(const std::string &ir, std::string name) {
+    llvm::SMDiagnostic error;
+    m.reset();
+    m = llvm::parseIR(llvm::MemoryBufferRef(ir, name), error, context);
+    if(!m) {
+        std::string message = error.getMessage().str();
+        return message.empty() ? "unknown error" : message;
+    }
+    return "";
+}
+
 inline std::vector<std::string> find_kernel_functions_in_module() {
     std::vector<std::string> kernels;
     for (auto it = m->getFunctionList().begin(); it != m->getFunctionList().end(); it++)
@@ -62,6 +86,33 @@ inline std::string resolve_memop(auto instr, bool is_kernel) {
     return "callee";
 }
 
+/* the number of bytes that a load/store of the provided type moves (e.g. 16 for a float4) */
+inline std::string resolve_memop_size(llvm::Type *type) {
+    return std::to_string(m->getDataLayout().getTypeStoreSize(type).getFixedSize());
+}
+
+/* the number of lanes of the provided type (e.g. 4 for a float4, 1 for a scalar) */
+inline unsigned get_lanes(llvm::Type *type) {
+    if (auto vtype = llvm::dyn_cast<llvm::FixedVectorType>(type)) return vtype->getNumElements();
+    return 1;
+}
+
+/* whether the provided call is a call to the fma/mad OpenCL builtins or to the llvm.fma/llvm.fmuladd
+   intrinsics that the compiler emits for them and for contracted a * b + c (one multiply and one add per lane) */
+inline bool is_fused_multiply_add(const llvm::CallInst *call) {
+    const llvm::Function *callee = call->getCalledFunction();
+    if (!callee || !call->getType()->isFPOrFPVectorTy()) return false;
+    llvm::Intrinsic::ID id = callee->getIntrinsicID();
+    if (id == llvm::Intrinsic::fma || id == llvm::Intrinsic::fmuladd) return true;
+    std::string name = callee->getName().str();
+    return name.rfind("_Z3fma", 0) == 0 || name.rfind("_Z3mad", 0) == 0;
+}
+
+/* the float operations performed by the provided instruction, as "float ops/<count>" */
+inline std::string resolve_float_ops(const llvm::Instruction &instr, unsigned ops_per_lane) {
+    return "float ops/" + std::to_string(ops_per_lane * get_lanes(instr.getType()));
+}
+
 inline instrumentation_t get_instrumentation_info_from_module() {
 
     /* the map that will hold all the instrumentation info that will be gathered */
@@ -92,18 +143,32 @@ inline instrumentation_t get_instrumentation_info_from_module() {
                                              : "";
                 print_message("\t\tinstruction " + (std::string)instr.getOpcodeName() + extra_info);
                 if (!loc || loc.getLine() != 0) {
-                    /* special handling for load/store operations */
-                    if (llvm::isa<llvm::LoadInst>(&instr))
-                        bb_instrumentation.push_back("load " + resolve_memop(llvm::cast<llvm::LoadInst>(&instr), is_kernel));
-                    else if (llvm::isa<llvm::StoreInst>(&instr))
-                        bb_instrumentation.push_back("store " + resolve_memop(llvm::cast<llvm::StoreInst>(&instr), is_kernel));
+                    /* special handling for load/store operations: "<load|store> <address space>/<bytes>" */
+                    if (llvm::isa<llvm::LoadInst>(&instr)) {
+                        auto load = llvm::cast<llvm::LoadInst>(&instr);
+                        bb_instrumentation.push_back("load " + resolve_memop(load, is_kernel) + '/' +
+                                                     resolve_memop_size(load->getType()));
+                    }
+                    else if (llvm::isa<llvm::StoreInst>(&instr)) {
+                        auto store = llvm::cast<llvm::StoreInst>(&instr);
+                        bb_instrumentation.push_back("store " + resolve_memop(store, is_kernel) + '/' +
+                                                     resolve_memop_size(store->getValueOperand()->getType()));
+                    }
                     else if (llvm::isa<llvm::CallInst>(&instr)) {
                         /* we discard unlocalized calls as internal to LLVM */
-                        if (loc)
+                        if (loc) {
                             bb_instrumentation.push_back(std::to_string(loc.getLine()) + ':' + "call");
+                            if (is_fused_multiply_add(llvm::cast<llvm::CallInst>(&instr)))
+                                bb_instrumentation.push_back(resolve_float_ops(instr, 2));
+                        }
                     }
-                    else
+                    else {
                         bb_instrumentation.push_back(instr.getOpcodeName());
+                        /* float arithmetic is also counted per vector lane: "float ops/<lanes>" */
+                        if ((llvm::isa<llvm::BinaryOperator>(&instr) || llvm::isa<llvm::UnaryOperator>(&instr)) &&
+                            instr.getType()->isFPOrFPVectorTy())
+                            bb_instrumentation.push_back(resolve_float_ops(instr, 1));
+                    }
                 }
             }
 
@@ -117,6 +182,82 @@ inline instrumentation_t get_instrumentation_info_from_module() {
     return instrumentation;
 }
 
+inline std::string json_string(const std::string &s) {
+    std::string escaped = "\"";
+    for (char c : s) {
+        if (c == '"' || c == '\\') escaped += '\\';
+        if (c == '\n') { escaped += "\\n"; continue; }
+        escaped += c;
+    }
+    return escaped + '"';
+}
+
+/*
+ * dumps the instrumentation info of a module as a single JSON line:
+ * {"module": <name>, "functions": {<function>: [<BB>, ...]}} where the BBs are in order and each BB is
+ * {"counts": [[<counter>, <count>], ...], "calls": [<source line of each call>, ...]}, e.g. a "load global/16"
+ * contributes 1 to the "load global" counter and 16 to the "load global bytes" counter
+ */
+inline void dump_instrumentation_info_json(instrumentation_t instrumentation, std::string module_name) {
+
+    /* the BBs of each function, in order (the keys of the instrumentation are "<function>:<BB index>") */
+    std::map<std::string, std::map<unsigned, bb_instrumentation_t>> functions;
+    for (auto bb_instrumentation : instrumentation) {
+        std::string key = bb_instrumentation.first;
+        size_t colon = key.find_last_of(':');
+        functions[key.substr(0, colon)][std::stoul(key.substr(colon + 1))] = bb_instrumentation.second;
+    }
+
+    std::ostringstream out;
+    out << "{\"module\": " << json_string(module_name) << ", \"functions\": {";
+    bool first_function = true;
+    for (auto function : functions) {
+        out << (first_function ? "" : ", ") << json_string(function.first) << ": [";
+        first_function = false;
+        bool first_bb = true;
+        for (auto bb : function.second) {
+            std::vector<std::pair<std::string, unsigned long>> counts;
+            std::vector<std::string> calls;
+            auto count = [&counts](std::string counter, unsigned long n) {
+                for (auto &c : counts)
+                    if (c.first == counter) { c.second += n; return; }
+                counts.push_back({counter, n});
+            };
+            for (std::string token : bb.second) {
+                size_t slash = token.find('/'), colon = token.find(':');
+                if (slash != std::string::npos) {
+                    std::string counter = token.substr(0, slash);
+                    unsigned long n = std::stoul(token.substr(slash + 1));
+                    if (counter == "float ops") count(counter, n);
+                    else { count(counter, 1); count(counter + " bytes", n); }
+                }
+                else if (colon != std::string::npos) {
+                    count(token.substr(colon + 1), 1);
+                    calls.push_back(token.substr(0, colon));
+                }
+                else count(token, 1);
+            }
+            out << (first_bb ? "" : ", ") << "{\"counts\": [";
+            first_bb = false;
+            for (size_t i = 0; i < counts.size(); i++)
+                out << (i ? ", " : "") << '[' << json_string(counts[i].first) << ", " << counts[i].second << ']';
+            out << "], \"calls\": [";
+            for (size_t i = 0; i < calls.size(); i++)
+                out << (i ? ", " : "") << calls[i];
+            out << "]}";
+        }
+        out << ']';
+    }
+    out << "}}";
+    std::cout << out.str() << std::endl;
+    return;
+}
+
+inline void dump_instrumentation_error_json(std::string error, std::string module_name) {
+    std::cout << "{\"module\": " << json_string(module_name) << ", \"error\": " << json_string(error) << '}' << std::endl;
+    return;
+}
+
 inline void dump_instrumentation_info(instrumentation_t instrumentation) {
     std::string funcname_bbline;
     for (auto bb_instrumentation : instrumentation) {
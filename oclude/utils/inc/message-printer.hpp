@@ -12,6 +12,9 @@ private:
 
 public:
 
+    /* when quiet, no messages are printed (e.g. when STDERR is not consumed by anyone) */
+    bool quiet = false;
+
     MessagePrinter(std::string sourcefile, std::string _usagestr) : usagestr(_usagestr) {
         appname = sourcefile.substr(sourcefile.find_last_of("/") + 1, sourcefile.size() - 1);
         appname = appname.substr(0, appname.find_last_of("."));
@@ -19,6 +22,7 @@ public:
     }
 
     void operator()(std::string message, bool nl=true) {
+        if (quiet) return;
         std::cerr << prompt << message;
         if (nl) std::cerr << std::endl;
     }
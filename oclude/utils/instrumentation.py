@@ -1,51 +1,263 @@
 import os
+import json
+import atexit
+import hashlib
+import subprocess as sp
+from time import time
 
 from oclude.utils.interactor import Interactor
 from oclude.utils.constants import *
 from oclude.utils.formatter import OcludeFormatter
-from oclude.utils.instrumentor import add_instrumentation_data_to_file
+from oclude.utils.instrumentor import load_instrumentation_data, instrument_functions, instrumented_file_header
+from oclude.utils.cachedfiles import CachedFiles, write_atomically, get_toolchain_version
 
 from pycparserext.ext_c_parser import OpenCLCParser
 from pycparserext.ext_c_generator import OpenCLCGenerator
-from pycparser.c_ast import Decl, PtrDecl, TypeDecl, IdentifierType, ID, FuncDef
+from pycparser.c_ast import Decl, PtrDecl, TypeDecl, IdentifierType, ID, FuncDef, FileAST, Pragma, NodeVisitor
 
 interact = Interactor(__file__.split(os.sep)[-1])
 
-### 1st pass tools (preprocessor) ###
-preprocessor = 'cpp'
-
 ### 2nd pass tools ###
-instrumentationGetter = os.path.join(bindir, 'instrumentation-parser')
+class InstrumentationParser(object):
+    '''
+    The instrumentation parser, running as a persistent co-process of the current oclude process
+    (so that LLVM is loaded once for all the files that are instrumented): LLVM bitcode is written
+    to its STDIN as "<number of bytes>\\n<bitcode>" and the instrumentation data are read back as JSON lines
+    '''
+    def __init__(self):
+        self.process = None
+        self.pid = None
+
+    def __call__(self, llvm_bitcode):
+        # a (forked) child process must not share the co-process of its parent
+        if self.process is None or self.process.poll() is not None or self.pid != os.getpid():
+            self.process = sp.Popen([instrumentationGetter, '--stream'], stdin=sp.PIPE, stdout=sp.PIPE)
+            self.pid = os.getpid()
+        data = llvm_bitcode.encode('utf-8')
+        self.process.stdin.write(f'{len(data)}\n'.encode('ascii') + data)
+        self.process.stdin.flush()
+        record = self.process.stdout.readline()
+        if not record:
+            interact(f'Error while running {instrumentationGetter} (return code: {self.process.wait()})')
+            self.process = None
+            exit(1)
+        record = json.loads(record)
+        if 'error' in record:
+            interact(f"Error while parsing LLVM bitcode: {record['error']}")
+            exit(1)
+        return record
+
+    def close(self):
+        if self.process is not None and self.pid == os.getpid():
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+instrumentation_parser = InstrumentationParser()
+atexit.register(instrumentation_parser.close)
 
 ### 3rd pass tools ###
-cl2llCompiler = 'clang'
+# the source code is fed to the STDIN of the compiler and the LLVM bitcode is read from its STDOUT
 cl2llCompilerFlags = ['-g', '-c', '-x', 'cl', '-emit-llvm', '-S', '-cl-std=CL2.0',
                       '-target', 'spir64',
                       '-Xclang', '-finclude-default-header', '-fno-discard-value-names']
-
-def instrument_file(file, verbose, static_features=False):
-
+cl2llCompilerStdio = ['-o', '-', '-']
+
+class FuncCallCollector(NodeVisitor):
+    '''
+    Collects the names of the functions called in the visited AST
+    '''
+    def __init__(self):
+        self.called = set()
+
+    def visit_FuncCall(self, n):
+        if isinstance(n.name, ID):
+            self.called.add(n.name.name)
+        self.generic_visit(n)
+
+def get_call_graph(ast):
+    '''
+    Returns a dict with the functions defined in the provided AST that each function defined in it calls
+    '''
+    functions = dict((ext.decl.name, ext) for ext in ast.ext if isinstance(ext, FuncDef))
+    call_graph = {}
+    for name, function in functions.items():
+        collector = FuncCallCollector()
+        collector.visit(function.body)
+        call_graph[name] = sorted(f for f in collector.called if f in functions and f != name)
+    return call_graph
+
+def prune_ast(ast, roots):
+    '''
+    Removes from the provided AST every function definition that is neither one of the provided
+    functions nor (transitively) called by them; everything else (types, globals, declarations) is kept
+    '''
+    call_graph = get_call_graph(ast)
+
+    # traverse the call graph of the roots
+    reachable, to_visit = set(), list(roots)
+    while to_visit:
+        function = to_visit.pop()
+        if function in reachable:
+            continue
+        reachable.add(function)
+        to_visit += call_graph[function]
+
+    ast.ext = [ext for ext in ast.ext if not isinstance(ext, FuncDef) or ext.decl.name in reachable]
+    return ast
+
+def prune_ast_to_kernel(ast, kernel):
+    '''
+    Keeps only the provided kernel and the functions it (transitively) calls in the provided AST
+    '''
+    if kernel not in (ext.decl.name for ext in ast.ext if isinstance(ext, FuncDef)):
+        interact(f"Error: No kernel function named '{kernel}' exists")
+        exit(1)
+    return prune_ast(ast, [kernel])
+
+def get_function_keys(ast):
+    '''
+    Returns the key under which the instrumentation of each function defined in the provided AST is cached:
+    a digest of its (normalized) source code, of everything but the functions in the file (types, globals etc),
+    of the keys of the functions it calls (as their changes can change its instrumentation, e.g. due to inlining)
+    and of the versions of the tools that instrument it (see `get_toolchain_version`)
+    '''
+    toolchain_version = get_toolchain_version()
+    generator = OpenCLCGenerator()
+    prelude = ''.join(generator.visit(ext) + '\n' for ext in ast.ext if not isinstance(ext, FuncDef))
+    sources = dict((ext.decl.name, generator.visit(ext)) for ext in ast.ext if isinstance(ext, FuncDef))
+    call_graph = get_call_graph(ast)
+
+    keys = {}
+    def get_key(name):
+        if name not in keys:
+            digest = hashlib.md5(f'{toolchain_version}\n{prelude}\n{sources[name]}'.encode())
+            for callee in call_graph[name]:
+                digest.update(get_key(callee).encode())
+            keys[name] = digest.hexdigest()
+        return keys[name]
+
+    for name in sources:
+        get_key(name)
+    return keys
+
+def warm_up_parser():
+    '''
+    Builds the OpenCL C parser once, so that its (cached) parsing tables exist
+    before many processes instantiate it concurrently
+    '''
+    OpenCLCParser()
+
+def instrument_file(file, verbose, static_features=False, output_file=None, timings=None, kernel=None, use_cache=True):
+    '''
+    Instruments the OpenCL source file `file`. The source code and its AST are kept in memory
+    between the stages of the instrumentation and the instrumented source code is written
+    once, to `output_file` (by default, `file` itself is overwritten).
+    If a `kernel` is provided, only that kernel and the functions it (transitively) calls are kept and instrumented.
+    The instrumentation of each function is cached (see `get_function_keys`), so that only the functions that
+    changed since the last time (and the functions that call them) are instrumented, unless `use_cache` is False.
+    If `static_features` is True, nothing is written; the instrumentation data of each function are returned instead.
+    If a `timings` dict is provided, the time (in seconds) spent in each stage is recorded in it
+    '''
     if not os.path.exists(file):
         interact(f'Error: {file} is not a file')
         exit(1)
 
     interact.set_verbosity(verbose)
 
-    ########################################
-    # step 1: remove comments / preprocess #
-    ########################################
-    cmdout, _ = interact.run_command('Preprocessing source file', preprocessor, file)
-    with open(file, 'w') as f:
-        f.writelines(filter(lambda line : line.strip() and not line.startswith('#'), cmdout.splitlines(keepends=True)))
+    if timings is None:
+        timings = {}
+    stage_start = time()
+
+    def stage_done(stage):
+        nonlocal stage_start
+        timings[stage] = timings.get(stage, 0) + time() - stage_start
+        stage_start = time()
+
+    ##############################################################
+    # step 1: remove comments / preprocess and parse (or reuse the #
+    #         parsed unit of the file, if it has been parsed)      #
+    ##############################################################
+    cache = CachedFiles()
+    interact('Preprocessing and parsing source file')
+    ast = cache.get_parsed_unit(file, use_cache)['ast']
+    if kernel is not None:
+        prune_ast_to_kernel(ast, kernel)
+    stage_done('preprocessing and parsing')
+
+    ##################################################################
+    # step 2: look up the (cached) instrumentation of each function #
+    ##################################################################
+    function_keys = get_function_keys(ast)
+    function_instrumentation = dict(
+        (name, cache.get_function_instrumentation(key) if use_cache else None) for name, key in function_keys.items()
+    )
+    changed_functions = [name for name, instrumentation in function_instrumentation.items() if instrumentation is None]
+    if use_cache and len(changed_functions) < len(function_keys):
+        interact(f'INFO: Using cached instrumentation for {len(function_keys) - len(changed_functions)} '
+                 f'out of {len(function_keys)} functions')
+    stage_done('function cache lookup')
+
+    # only the changed functions, along with the functions they call, go through the rest of the steps
+    if changed_functions:
+        unit = prune_ast(FileAST(ext=list(ast.ext)), changed_functions)
+        instrumentation_per_function, instrumented_functions = instrument_unit(
+            unit, changed_functions, verbose, stage_done
+        )
+        for name in changed_functions:
+            function_instrumentation[name] = {
+                'instrumentation': instrumentation_per_function[name],
+                'source': instrumented_functions[name]
+            }
+            cache.store_function_instrumentation(function_keys[name], function_instrumentation[name])
+
+    # instrumentation data are ready! Congrats!
+    if static_features:
+        return dict((name, instrumentation['instrumentation']) for name, instrumentation in function_instrumentation.items())
+
+    # assemble the instrumented source code, function by function
+    generator = OpenCLCGenerator()
+    src = instrumented_file_header + ''.join(
+        function_instrumentation[ext.decl.name]['source'] if isinstance(ext, FuncDef)
+        else generator.visit(ext) + ('\n' if isinstance(ext, Pragma) else ';\n')
+        for ext in ast.ext
+    )
 
-    ############################################################################
-    # step 2: add hidden counter arguments in kernels and missing curly braces #
-    ############################################################################
-    parser = OpenCLCParser()
+    # store a prettified (i.e. easier to read/inspect) format in the cache
+    lines = src.splitlines()
+    for i, line in enumerate(lines):
+        if f'atom_add(& {hidden_counter_name_local}' in line or f'atom_sub(& {hidden_counter_name_local}' in line:
+            instr_idx = int(line.split('[')[1].split(']')[0])
+            lines[i] = line + f' /* {hidden_counters[instr_idx]} */'
+    src = '\n'.join(lines) + '\n'
+
+    write_atomically(output_file or file, src)
+    stage_done('writing')
 
-    with open(file, 'r') as f:
-        ast = parser.parse(f.read())
+    if verbose:
+
+        interact('Final instrumented source code for inspection:')
+        interact('============================================================================', nl=False)
+        interact('============================================================================', prompt=False)
+
+        for line in src.splitlines(keepends=True):
+            interact(line, prompt=False, nl=False)
+
+        interact('============================================================================', nl=False)
+        interact('============================================================================', prompt=False)
+
+    interact('Intrumentation completed successfully')
 
+def instrument_unit(ast, functions, verbose, stage_done):
+    '''
+    Instruments the provided functions of the provided AST, which must also contain the functions they call.
+    Returns the instrumentation data of every function of the AST, as well as the instrumented source code of
+    each of the provided functions
+    '''
+
+    ############################################################################
+    # step 3: add hidden counter arguments in kernels and missing curly braces #
+    ############################################################################
     ASTfunctions = list(filter(lambda x : isinstance(x, FuncDef), ast))
     funcCallsToEdit, kernelFuncs = [], []
 
@@ -60,80 +272,50 @@ def instrument_file(file, verbose, static_features=False):
             func.decl.funcspec = [x for x in func.decl.funcspec if x != 'inline']
             inlinedFuncs.append(func.decl.name)
 
-    # our generator adds hidden arguments and missing curly braces
+    # our generator adds hidden arguments and missing curly braces;
+    # note that it does so by editing the AST itself, so the AST now matches the formatted source code
     gen = OcludeFormatter(funcCallsToEdit, kernelFuncs)
-
-    with open(file, 'w') as f:
-        f.write(gen.visit(ast))
+    src = gen.visit(ast)
+    stage_done('formatting')
 
     #########################################################################
-    # step 3: instrument source code with counter incrementing where needed #
+    # step 4: instrument source code with counter incrementing where needed #
     #########################################################################
 
     # first take the instrumentation data from the respective tool
     # after compiling source to LLVM bitcode
     # WITHOUT allowing function inlining (to get pure data for each function)
 
-    interact.run_command(
-        'Compiling source to LLVM bitcode (1/2)', cl2llCompiler, *cl2llCompilerFlags, '-O0', '-o', templlvm, file
+    llvm_bitcode, _ = interact.run_command(
+        'Compiling source to LLVM bitcode (1/2)', cl2llCompiler, *cl2llCompilerFlags, '-O0', *cl2llCompilerStdio,
+        input=src
     )
+    stage_done('compilation (1/2)')
 
-    instrumentation_data, _ = interact.run_command(
-        'Retrieving instrumentation data from LLVM bitcode', instrumentationGetter, templlvm
-    )
+    interact('Retrieving instrumentation data from LLVM bitcode' + (f': {instrumentationGetter} --stream' if verbose else ''))
+    instrumentation_data = instrumentation_parser(llvm_bitcode)
+    stage_done('instrumentation data retrieval')
 
     ### there may be a need to restore the "inline" function attribute in some functions at this point ###
     if inlinedFuncs:
-        with open(file, 'r') as f:
-            ast = parser.parse(f.read())
         for ext in filter(lambda x : isinstance(x, FuncDef) and x.decl.name in inlinedFuncs, ast.ext):
             ext.decl.funcspec = ['inline'] + ext.decl.funcspec
-        gen = OpenCLCGenerator()
-        with open(file, 'w') as f:
-            f.write(gen.visit(ast))
+        src = OpenCLCGenerator().visit(ast)
     ### "inline" function attribute restored at this point, if it was needed to ###
 
     _, inliner_report = interact.run_command(
-        'Compiling source to LLVM bitcode (2/2)', cl2llCompiler, *cl2llCompilerFlags, '-Rpass=inline', '-o', templlvm, file
+        'Compiling source to LLVM bitcode (2/2)', cl2llCompiler, *cl2llCompilerFlags, '-Rpass=inline', *cl2llCompilerStdio,
+        input=src
     )
-    os.remove(templlvm)
+    stage_done('compilation (2/2)')
 
     # for each inlined function, replace the "call" with a negative "ret"
     # that means that each inlined function leads to 1 less "call" and 1 less "ret"
-    inline_lines = [x.split()[0].split(':')[-3] for x in filter(lambda y : 'remark' in y, inliner_report.splitlines())]
-    for inline_line in inline_lines:
-        instrumentation_data = instrumentation_data.replace('|' + inline_line + ':call', '|retNOT', 1)
+    inline_lines = [int(x.split()[0].split(':')[-3]) for x in filter(lambda y : 'remark' in y, inliner_report.splitlines())]
+    instrumentation_per_function = load_instrumentation_data(instrumentation_data, inline_lines)
 
-    # now add them to the source file, eventually instrumenting it
-    instrumentation_per_function = add_instrumentation_data_to_file(
-        file, kernelFuncs, instrumentation_data, parser
-    )
+    # now add them to the source code of the requested functions, eventually instrumenting them
+    instrumented_functions = instrument_functions(ast, kernelFuncs, instrumentation_per_function, functions)
+    stage_done('instrumentation')
 
-    # instrumentation is done! Congrats!
-    if static_features:
-        return instrumentation_per_function
-
-    # store a prettified (i.e. easier to read/inspect) format in the cache
-    with open(file, 'r') as f:
-        src = f.read()
-    with open(file, 'w') as f:
-        for line in src.splitlines():
-            if f'atom_add(& {hidden_counter_name_local}' in line or f'atom_sub(& {hidden_counter_name_local}' in line:
-                instr_idx = int(line.split('[')[1].split(']')[0])
-                line += f' /* {llvm_instructions[instr_idx]} */'
-            f.write(line + '\n')
-
-    if verbose:
-
-        interact('Final instrumented source code for inspection:')
-        interact('============================================================================', nl=False)
-        interact('============================================================================', prompt=False)
-
-        with open(file, 'r') as f:
-            for line in f.readlines():
-                interact(line, prompt=False, nl=False)
-
-        interact('============================================================================', nl=False)
-        interact('============================================================================', prompt=False)
-
-    interact('Intrumentation completed successfully')
+    return instrumentation_per_function, instrumented_functions
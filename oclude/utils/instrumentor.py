@@ -1,13 +1,82 @@
 from pycparserext.ext_c_generator import OpenCLCGenerator
 from pycparser.c_ast import *
 from oclude.utils.constants import (
-    llvm_instructions,
+    hidden_counters,
+    float_ops_counter,
     hidden_counter_name_local,
-    hidden_counter_name_global
+    hidden_counter_name_global,
+    hidden_counter_group_offset
 )
 
 from itertools import count, filterfalse
 
+# the index of each hidden counter (a negative "ret" is subtracted from the "ret" counter)
+hidden_counter_index = dict((counter, idx) for idx, counter in enumerate(hidden_counters))
+hidden_counter_index['retNOT'] = hidden_counter_index['ret']
+
+# the prologue and the epilogue below are shared by all the instrumented kernels
+# (the generator only reads the AST nodes, so they do not need to be copied)
+
+# the prologue of the instrumentation of every kernel in OpenCL
+# (initialization of the local hidden counter to zero):
+#
+# if (get_local_id(0) == 0)
+#     for (int i = 0; i < <len(hidden_counters)>; i++)
+#         <hidden_counter_name_local>[i] = 0;
+# barrier(CLK_GLOBAL_MEM_FENCE);
+#
+# and this is its AST:
+kernel_prologue = [
+    If(cond=BinaryOp(op='==',
+                     left=FuncCall(name=ID('get_local_id'),
+                                   args=ExprList(exprs=[Constant(type='int', value='0')])),
+                     right=Constant(type='int', value='0')),
+       iftrue=For(init=DeclList(decls=[Decl(name='i', quals=[], storage=[], funcspec=[],
+                                type=TypeDecl(declname='i', quals=[], type=IdentifierType(names=['int'])),
+                                init=Constant(type='int', value='0'), bitsize=None)]),
+                  cond=BinaryOp(op='<', left=ID('i'), right=Constant(type='int', value=str(len(hidden_counters)))),
+                  next=UnaryOp(op='p++', expr=ID('i')),
+                  stmt=Assignment(op='=', lvalue=ArrayRef(name=ID(hidden_counter_name_local), subscript=ID('i')),
+                                          rvalue=Constant(type='int', value='0'))),
+       iffalse=None),
+    FuncCall(name=ID('barrier'), args=ExprList(exprs=[ID('CLK_GLOBAL_MEM_FENCE')]))
+]
+
+# the epilogue of the instrumentation of every kernel in OpenCL
+# (add the group statistics to the global hidden counter):
+#
+# barrier(CLK_GLOBAL_MEM_FENCE);
+# if (get_local_id(0) == 0)
+#     for (int i = 0; i < <len(hidden_counters)>; i++)
+#         atom_add(&<hidden_counter_name_global>[<hidden_counter_group_offset> + i], <hidden_counter_name_local>[i]);
+#
+# where <hidden_counter_group_offset> is a macro that defaults to 0 (all groups
+# accumulate into the same counters) and is redefined by the hostcode to
+# get_group_id(0) * <len(hidden_counters)> when per work-group counters are requested
+#
+# and this is its AST:
+kernel_epilogue = [
+    FuncCall(name=ID('barrier'), args=ExprList(exprs=[ID('CLK_GLOBAL_MEM_FENCE')])),
+    If(cond=BinaryOp(op='==',
+                     left=FuncCall(name=ID('get_local_id'),
+                                   args=ExprList(exprs=[Constant(type='int', value='0')])),
+                     right=Constant(type='int', value='0')),
+       iftrue=For(init=DeclList(decls=[Decl(name='i', quals=[], storage=[], funcspec=[],
+                                type=TypeDecl(declname='i', quals=[], type=IdentifierType(names=['int'])),
+                                init=Constant(type='int', value='0'), bitsize=None)]),
+                  cond=BinaryOp(op='<', left=ID('i'), right=Constant(type='int', value=str(len(hidden_counters)))),
+                  next=UnaryOp(op='p++', expr=ID('i')),
+                  stmt=FuncCall(name=ID('atom_add'),
+                                args=ExprList(exprs=[
+                                                UnaryOp(op='&', expr=ArrayRef(name=ID(hidden_counter_name_global),
+                                                         subscript=BinaryOp(op='+',
+                                                                            left=ID(hidden_counter_group_offset),
+                                                                            right=ID('i')))),
+                                                ArrayRef(name=ID(hidden_counter_name_local),
+                                                         subscript=ID('i'))]))),
+       iffalse=None)
+]
+
 class OcludeInstrumentor(OpenCLCGenerator):
     '''
     Responsible to add instrumentation code
@@ -26,89 +95,50 @@ class OcludeInstrumentor(OpenCLCGenerator):
 
         self.kernelFuncs = kernelFuncs
 
-        # this is the prologue of the instrumentation of every kernel in OpenCL
-        # (initialization of the local hidden counter to zero):
-        #
-        # if (get_local_id(0) == 0)
-        #     for (int i = 0; i < <len(llvm_instructions)>; i++)
-        #         <hidden_counter_name_local>[i] = 0;
-        # barrier(CLK_GLOBAL_MEM_FENCE);
-        #
-        # and this is its AST:
-        self.prologue = [
-            If(cond=BinaryOp(op='==',
-                             left=FuncCall(name=ID('get_local_id'),
-                                           args=ExprList(exprs=[Constant(type='int', value='0')])),
-                             right=Constant(type='int', value='0')),
-               iftrue=For(init=DeclList(decls=[Decl(name='i', quals=[], storage=[], funcspec=[],
-                                        type=TypeDecl(declname='i', quals=[], type=IdentifierType(names=['int'])),
-                                        init=Constant(type='int', value='0'), bitsize=None)]),
-                          cond=BinaryOp(op='<', left=ID('i'), right=Constant(type='int', value=str(len(llvm_instructions)))),
-                          next=UnaryOp(op='p++', expr=ID('i')),
-                          stmt=Assignment(op='=', lvalue=ArrayRef(name=ID(hidden_counter_name_local), subscript=ID('i')),
-                                                  rvalue=Constant(type='int', value='0'))),
-               iffalse=None),
-            FuncCall(name=ID('barrier'), args=ExprList(exprs=[ID('CLK_GLOBAL_MEM_FENCE')]))
-        ]
-
-        # this is the epilogue of the instrumentation of every kernel in OpenCL
-        # (add the group statistics to the global hidden counter):
-        #
-        # barrier(CLK_GLOBAL_MEM_FENCE);
-        # if (get_local_id(0) == 0)
-        #     for (int i = 0; i < <len(llvm_instructions)>; i++)
-        #         atom_add(&hidden_counter_name_global>[i], <hidden_counter_name_local>[i]);
-        #
-        # and this is its AST:
-        self.epilogue = [
-            FuncCall(name=ID('barrier'), args=ExprList(exprs=[ID('CLK_GLOBAL_MEM_FENCE')])),
-            If(cond=BinaryOp(op='==',
-                             left=FuncCall(name=ID('get_local_id'),
-                                           args=ExprList(exprs=[Constant(type='int', value='0')])),
-                             right=Constant(type='int', value='0')),
-               iftrue=For(init=DeclList(decls=[Decl(name='i', quals=[], storage=[], funcspec=[],
-                                        type=TypeDecl(declname='i', quals=[], type=IdentifierType(names=['int'])),
-                                        init=Constant(type='int', value='0'), bitsize=None)]),
-                          cond=BinaryOp(op='<', left=ID('i'), right=Constant(type='int', value=str(len(llvm_instructions)))),
-                          next=UnaryOp(op='p++', expr=ID('i')),
-                          stmt=FuncCall(name=ID('atom_add'),
-                                        args=ExprList(exprs=[
-                                                        UnaryOp(op='&', expr=ArrayRef(name=ID(hidden_counter_name_global),
-                                                                 subscript=ID('i'))),
-                                                        ArrayRef(name=ID(hidden_counter_name_local),
-                                                                 subscript=ID('i'))]))),
-               iffalse=None)
-        ]
+        # the (shared) AST nodes of the counter updates, by (hidden counter name, count)
+        self.counter_updates = {}
+        self.hidden_counter_local = ID(hidden_counter_name_local)
+
+        # the visit method of each AST node class (see `visit`)
+        self.visit_methods = {}
+
+    def visit(self, node):
+        '''
+        Overrides visit to look the visit method of each AST node class up once, instead of once per node
+        '''
+        method = self.visit_methods.get(node.__class__)
+        if method is None:
+            method = getattr(self, 'visit_' + node.__class__.__name__, self.generic_visit)
+            self.visit_methods[node.__class__] = method
+        return method(node)
+
+    def _get_counter_update(self, instr_name, instr_cnt):
+        '''
+        Returns the AST representation of the command "atom_{add,sub}(&<hidden_local_counter>[instr_idx], instr_cnt);"
+        for the provided hidden counter and count. Each command is created once per instrumentor and then shared
+        '''
+        key = (instr_name, instr_cnt)
+        counter_update = self.counter_updates.get(key)
+        if counter_update is None:
+            counter_update = FuncCall(name=ID('atom_sub' if instr_name.startswith('retNOT') else 'atom_add'),
+                                      args=ExprList(exprs=[
+                                                        UnaryOp(op='&', expr=ArrayRef(name=self.hidden_counter_local,
+                                                                subscript=Constant(type='int', value=str(hidden_counter_index[instr_name])))),
+                                                        Constant(type='int', value=str(instr_cnt))
+                                                    ]
+                                           )
+                             )
+            self.counter_updates[key] = counter_update
+        return counter_update
 
     def _get_bb_instrumentation(self, idx):
         '''
         idx points to an entry of self.function_instrumentation_data, which is
         a list of tuples (instr_idx, instr_cnt), and creates the AST representation of the command
         "atom_{add,sub}(&<hidden_local_counter>[instr_idx], instr_cnt);" for each tuple.
-        Returns the list of these representations (i.e. AST nodes)
+        Returns a (new) list of these representations (i.e. AST nodes)
         '''
-        instr = []
-        for instr_name, instr_cnt in self.function_instrumentation_data[idx]:
-
-            if instr_name.startswith('retNOT'):
-                atomic_func_name = 'atom_sub'
-                instr_index = str(llvm_instructions.index('ret'))
-            else:
-                atomic_func_name = 'atom_add'
-                instr_index = str(llvm_instructions.index(instr_name))
-
-            instr.append(
-                FuncCall(name=ID(atomic_func_name),
-                         args=ExprList(exprs=[
-                                           UnaryOp(op='&', expr=ArrayRef(name=ID(hidden_counter_name_local),
-                                                   subscript=Constant(type='int', value=instr_index))),
-                                           Constant(type='int', value=str(instr_cnt))
-                                       ]
-                              )
-                )
-            )
-
-        return instr
+        return [self._get_counter_update(instr_name, instr_cnt) for instr_name, instr_cnt in self.function_instrumentation_data[idx]]
 
     def _unroll_cond_level(self, cond):
         '''
@@ -159,7 +189,8 @@ class OcludeInstrumentor(OpenCLCGenerator):
         operand, operand_block = self._unroll_cond_level(operands.pop())
         blocks_to_append = [assign(var_name, operand)]
         if operand_block is not None:
-            blocks_to_append = operand_block + blocks_to_append
+            operand_block.extend(blocks_to_append)
+            blocks_to_append = operand_block
 
         while operands:
             operand, operand_block = self._unroll_cond_level(operands.pop())
@@ -185,7 +216,8 @@ class OcludeInstrumentor(OpenCLCGenerator):
             )]
 
             if operand_block is not None:
-                blocks_to_append = operand_block + blocks_to_append
+                operand_block.extend(blocks_to_append)
+                blocks_to_append = operand_block
 
         return ID(var_name), [var_decl] + blocks_to_append
 
@@ -210,14 +242,38 @@ class OcludeInstrumentor(OpenCLCGenerator):
                 instr_iffalse = self._get_bb_instrumentation(idx)
                 idx += 1
                 instr_iffalse_block, idx = self._process_unrolled_cond(cond_block.iffalse.block_items, idx)
-                cond_block.iffalse.block_items = instr_iffalse + instr_iffalse_block
+                instr_iffalse.extend(instr_iffalse_block)
+                cond_block.iffalse.block_items = instr_iffalse
             instr_cond_blocks.append(cond_block)
 
         return instr_cond_blocks, idx
 
 
     def _process_block(self, block, idx):
-
+        '''
+        Instruments the provided block, the BBs of which start from idx.
+        Returns the new idx and the instrumented block.
+        The nested blocks are processed through an explicit stack (see `_process_block_items`)
+        instead of recursively, so that deeply nested source code does not add a call per nesting level
+        '''
+        stack = [self._process_block_items(block, idx)]
+        result = None
+        while True:
+            try:
+                # a nested block to process first, along with its first idx
+                stack.append(self._process_block_items(*stack[-1].send(result)))
+                result = None
+            except StopIteration as processed:
+                stack.pop()
+                result = processed.value
+                if not stack:
+                    return result
+
+    def _process_block_items(self, block, idx):
+        '''
+        Generator that instruments the items of the provided block. Each nested block is yielded
+        (along with its first idx) to `_process_block`, which sends back the new idx and the instrumented nested block
+        '''
         if block is None:
             return idx, block
         if block.block_items is None:
@@ -274,17 +330,17 @@ class OcludeInstrumentor(OpenCLCGenerator):
                 # iftrue instrumentation
                 iftrue_instrumentation = self._get_bb_instrumentation(idx)
                 idx += 1
-                idx, processed_iftrue = self._process_block(block_item.iftrue, idx)
-                instrumented_iftrue = iftrue_instrumentation + processed_iftrue.block_items
-                block_item.iftrue = Compound(instrumented_iftrue)
+                idx, processed_iftrue = yield block_item.iftrue, idx
+                iftrue_instrumentation.extend(processed_iftrue.block_items)
+                block_item.iftrue = Compound(iftrue_instrumentation)
 
                 # iffalse instrumentation
                 if block_item.iffalse is not None:
                     iffalse_instrumentation = self._get_bb_instrumentation(idx)
                     idx += 1
-                    idx, processed_iffalse = self._process_block(block_item.iffalse, idx)
-                    instrumented_iffalse = iffalse_instrumentation + processed_iffalse.block_items
-                    block_item.iffalse = Compound(instrumented_iffalse)
+                    idx, processed_iffalse = yield block_item.iffalse, idx
+                    iffalse_instrumentation.extend(processed_iffalse.block_items)
+                    block_item.iffalse = Compound(iffalse_instrumentation)
 
                 instr_block_items.append(block_item)
 
@@ -321,12 +377,14 @@ class OcludeInstrumentor(OpenCLCGenerator):
                 # body BB
                 body_instr = self._get_bb_instrumentation(idx)
                 idx += 1
-                idx, processed_body = self._process_block(block_item.stmt, idx)
+                idx, processed_body = yield block_item.stmt, idx
                 # inc BB at the end of for
                 body_instr += self._get_bb_instrumentation(idx)
                 idx += 1
+                body_instr.extend(processed_body.block_items)
                 # add cond BB(s) at the end of for
-                for_body = [Compound(body_instr + processed_body.block_items)] + cond_instr_block_list
+                for_body = [Compound(body_instr)]
+                for_body.extend(cond_instr_block_list)
                 block_item.stmt.block_items = for_body
                 instr_block_items.append(block_item)
 
@@ -354,7 +412,7 @@ class OcludeInstrumentor(OpenCLCGenerator):
                 # body BB
                 body_instr = self._get_bb_instrumentation(idx)
                 idx += 1
-                idx, processed_body = self._process_block(block_item.stmt, idx)
+                idx, processed_body = yield block_item.stmt, idx
                 # add cond BB(s) at the end of while
                 # remove the declaration of the master bool var first
                 cond_instr_block_list = list(
@@ -362,7 +420,9 @@ class OcludeInstrumentor(OpenCLCGenerator):
                         isinstance(x, Decl) and next(c) < 1, cond_instr_block_list
                     )
                 )
-                while_body = [Compound(body_instr + processed_body.block_items)] + cond_instr_block_list
+                body_instr.extend(processed_body.block_items)
+                while_body = [Compound(body_instr)]
+                while_body.extend(cond_instr_block_list)
                 block_item.stmt.block_items = while_body
                 instr_block_items.append(block_item)
 
@@ -376,7 +436,7 @@ class OcludeInstrumentor(OpenCLCGenerator):
                 # body BB
                 body_instr = self._get_bb_instrumentation(idx)
                 idx += 1
-                idx, processed_body = self._process_block(block_item.stmt, idx)
+                idx, processed_body = yield block_item.stmt, idx
 
                 # surely there is one cond BB
                 cond_instr_block_list = self._get_bb_instrumentation(idx)
@@ -401,7 +461,9 @@ class OcludeInstrumentor(OpenCLCGenerator):
                         isinstance(x, Decl) and next(c) < 1, cond_instr_block_list
                     )
                 )
-                while_body = [Compound(body_instr + processed_body.block_items)] + cond_instr_block_list
+                body_instr.extend(processed_body.block_items)
+                while_body = [Compound(body_instr)]
+                while_body.extend(cond_instr_block_list)
                 block_item.stmt.block_items = while_body
                 if master_bool_var_decl is not None:
                     instr_block_items.append(master_bool_var_decl)
@@ -417,8 +479,9 @@ class OcludeInstrumentor(OpenCLCGenerator):
                 for case in block_item.stmt.block_items:
                     case_instrumentation = self._get_bb_instrumentation(idx)
                     idx += 1
-                    idx, instr_case = self._process_block(Compound(case.stmts), idx)
-                    case.stmts = case_instrumentation + instr_case.block_items
+                    idx, instr_case = yield Compound(case.stmts), idx
+                    case_instrumentation.extend(instr_case.block_items)
+                    case.stmts = case_instrumentation
                     instr_cases.append(case)
                 block_item.stmt.block_items = instr_cases
                 instr_block_items.append(block_item)
@@ -577,7 +640,7 @@ class OcludeInstrumentor(OpenCLCGenerator):
         ### step 1: add instrumentation instructions ###
         first_func_instr = self._get_bb_instrumentation(0)
         bbs, n.body = self._process_block(n.body, 1)
-        n.body.block_items = first_func_instr + n.body.block_items
+        n.body.block_items[0:0] = first_func_instr
         # add missing return bb at the end of function if multiple return statements were found
         # or if the last statement was a compound one
         if self.return_bb is not None:
@@ -589,12 +652,12 @@ class OcludeInstrumentor(OpenCLCGenerator):
                     n.body.block_items += self.return_bb
         if n.decl.name in self.kernelFuncs:
             ### step 2: add prologue ###
-            n.body.block_items = self.prologue + n.body.block_items
+            n.body.block_items[0:0] = kernel_prologue
             ### step 3: add epilogue ###
             if isinstance(n.body.block_items[-1], Return):
-                n.body.block_items = n.body.block_items[:-1] + self.epilogue + n.body.block_items[-1:]
+                n.body.block_items[-1:-1] = kernel_epilogue
             else:
-                n.body.block_items += self.epilogue
+                n.body.block_items.extend(kernel_epilogue)
 
         # the following assertion means that the way we mapped the source code
         # to BBs led us to counting the correct number of BBs
@@ -605,26 +668,43 @@ class OcludeInstrumentor(OpenCLCGenerator):
         return super().visit_FuncDef(n)
 
 
-def add_instrumentation_data_to_file(filename, kernels, instr_data_raw, parser):
-
-    # parse instrumentation data
-    from itertools import groupby
-    from collections import Counter
-
-    instrumentation_per_function = {}
-    for funcname, g in groupby(instr_data_raw.strip().splitlines(), lambda line : line.split('|')[0].split(':')[0]):
-        func_bbs = sorted(g, key=lambda x : int(x.split(':')[1].split('|')[0]))
-        instrs_per_bb = list(map(lambda x : list(map(lambda y : y.split(':')[-1], x.split('|')[1:]))[:-1], func_bbs))
-        instrs_per_bb = list(map(lambda x : list(Counter(x).items()), instrs_per_bb))
-        instrumentation_per_function[funcname] = instrs_per_bb
-
-    # parsing done, time to add instrumentation to source code
-    with open(filename, 'r') as f:
-        ast = parser.parse(f.read())
+def load_instrumentation_data(record, inline_lines=()):
+    '''
+    Loads the instrumentation data of a module, as reported by the instrumentation parser, i.e.
+    a dict {"functions": {<function>: [{"counts": [[<counter>, <count>], ...], "calls": [<line>, ...]}, ...]}}
+    Each call that was inlined (i.e. each call from a source code line in `inline_lines`) leads to 1 less
+    "call" and 1 less "ret", so it is replaced with a "retNOT" (a negative "ret").
+    Returns a dict with a list of the instrumentation of each BB of each function, as tuples (hidden counter name, count)
+    '''
+    functions = record['functions']
+
+    for inline_line in inline_lines:
+        for bb in (bb for bbs in functions.values() for bb in bbs):
+            if inline_line in bb['calls']:
+                bb['calls'].remove(inline_line)
+                counts = dict(bb['counts'])
+                counts['call'] -= 1
+                counts['retNOT'] = counts.get('retNOT', 0) + 1
+                bb['counts'] = [[counter, count] for counter, count in counts.items() if count != 0]
+                break
+
+    return dict(
+        (funcname, [[tuple(count) for count in bb['counts']] for bb in bbs]) for funcname, bbs in functions.items()
+    )
+
+# by default, all work groups add their counters to the same global counters
+instrumented_file_header = (
+    f'#ifndef {hidden_counter_group_offset}\n'
+    f'#define {hidden_counter_group_offset} 0\n'
+    '#endif\n'
+)
 
+def instrument_functions(ast, kernels, instrumentation_per_function, functions):
+    '''
+    Adds the instrumentation to the provided functions of the provided AST (which must have been formatted,
+    i.e. must contain all the curly braces and hidden arguments) and returns the instrumented source code of each of them
+    '''
     instrumentor = OcludeInstrumentor(kernels, instrumentation_per_function)
-    with open(filename, 'w') as f:
-        f.write(instrumentor.visit(ast))
-
-    # return instrumentation dict to facilitate static feature extraction
-    return instrumentation_per_function
+    return dict(
+        (ext.decl.name, instrumentor.visit(ext)) for ext in ast.ext if isinstance(ext, FuncDef) and ext.decl.name in functions
+    )
@@ -20,13 +20,19 @@ class Interactor(object):
     def set_verbosity(self, verbose):
         self.verbose = verbose
 
-    def run_command(self, text, utility, *rest):
+    def run_command(self, text, utility, *rest, input=None):
+        '''
+        Runs the provided command and returns its STDOUT and STDERR.
+        If `input` is provided, it is fed to the STDIN of the command
+        '''
         command = ' '.join([utility, *rest]) if rest else utility
         if text is not None:
             self(text + (f': {command}' if self.verbose else ''))
-        cmdout = sp.run(command.split(), stdout=sp.PIPE, stderr=sp.PIPE)
+        cmdout = sp.run(
+            command.split(), stdout=sp.PIPE, stderr=sp.PIPE, input=input.encode('utf-8') if input is not None else None
+        )
         if (cmdout.returncode != 0):
             self(f'Error while running {utility} (return code: {cmdout.returncode}). STDERR of command follows:')
-            self(cmdout.stderr.decode("ascii"), prompt=False)
+            self(cmdout.stderr.decode('utf-8', errors='replace'), prompt=False)
             exit(cmdout.returncode)
-        return cmdout.stdout.decode('ascii'), cmdout.stderr.decode('ascii')
+        return cmdout.stdout.decode('utf-8', errors='replace'), cmdout.stderr.decode('utf-8', errors='replace')
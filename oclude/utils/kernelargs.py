@@ -0,0 +1,204 @@
+import os
+import ast
+import json
+import pickle
+import operator
+import numpy as np
+
+class ArgumentGenerator:
+    '''
+    Generates the random values of the (non local) arguments of a kernel, i.e. a value for each scalar
+    and `count` values for each buffer, uniformly distributed in (-limit, limit) (in [0, limit) if unsigned,
+    within the limits of each type). Every sample of every argument gets its own stream of random numbers,
+    derived from a single seed by its (sample, argument) position, so that each sample is reproducible
+    on its own (and independently of the other arguments) for a given seed.
+    The values are generated in place, in arrays that are allocated once and reused by all samples
+    (or in arrays provided by the caller, see `generate`)
+    '''
+
+    def __init__(self, arg_specs, limit, seed=None):
+        '''
+        `arg_specs` is a list of (argument dtype, number of values or None for scalars).
+        If no seed is provided, a fresh one is drawn from the OS (see `seed`)
+        '''
+        self.limit = limit
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.arg_specs = [(np.dtype(dtype), count) for dtype, count in arg_specs]
+        # allocated on first use, as the values of buffers may be generated directly into them (see `generate`)
+        self.values = [None] * len(arg_specs)
+
+    def get_values(self, arg_idx):
+        if self.values[arg_idx] is None:
+            dtype, count = self.arg_specs[arg_idx]
+            # zeros, so that the padding of structs is deterministic as well
+            self.values[arg_idx] = np.zeros(count or 1, dtype=dtype)
+        return self.values[arg_idx]
+
+    def get_rng(self, sample, arg_idx):
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence(self.seed, spawn_key=(sample, arg_idx))))
+
+    def fill(self, rng, target):
+        dtype = target.dtype
+        if dtype.names:
+            # structs (and vector types) are filled field by field; the subarray fields
+            # of structs are expanded by NumPy to extra dimensions of `target[name]`
+            for name in dtype.names:
+                self.fill(rng, target[name])
+        elif dtype.kind in 'iu':
+            type_limits = np.iinfo(dtype)
+            low = max(-self.limit if dtype.kind == 'i' else 0, type_limits.min)
+            high = min(self.limit, type_limits.max)
+            target[...] = rng.integers(low, high, target.shape, dtype=dtype)
+        elif dtype.kind == 'f':
+            # single precision randoms suffice for half and float values
+            uniform = rng.random(target.shape, dtype=np.float64 if dtype.itemsize > 4 else np.float32)
+            uniform *= 2 * self.limit
+            uniform -= self.limit
+            target[...] = uniform
+        else:
+            raise TypeError(f'random values of arguments of type {dtype} can not be generated')
+
+    def generate(self, sample, out=None):
+        '''
+        Fills the arrays of the arguments with the values of the provided sample and returns them
+        (the value itself for scalars). The arrays are overwritten by the next call. The values of
+        an argument are generated into its array in `out` instead (e.g. a mapped buffer), if it is not None
+        '''
+        out = out or [None] * len(self.arg_specs)
+        generated = []
+        for arg_idx, ((dtype, count), out_values) in enumerate(zip(self.arg_specs, out)):
+            values = out_values if out_values is not None else self.get_values(arg_idx)
+            if out_values is not None and dtype.names:
+                # unlike the arrays of the generator, the padding of structs in `out` is not zeroed
+                values.view(np.uint8)[...] = 0
+            self.fill(self.get_rng(sample, arg_idx), values)
+            generated.append(values if count is not None else values[0])
+        return generated
+
+def load_inputs(inputs):
+    '''
+    Loads the real inputs of a kernel, i.e. a mapping (a dict, or the path of a JSON file) from the names of
+    (some of) its arguments to the paths of .npy files or of raw files with values of the type of the argument
+    (relative to the JSON file), or to numbers (for scalars). Returns the mapping, with absolute paths
+    '''
+    basedir = os.getcwd()
+    if isinstance(inputs, str):
+        basedir = os.path.dirname(os.path.abspath(inputs))
+        with open(inputs, 'r') as f:
+            inputs = json.load(f)
+    if not isinstance(inputs, dict):
+        raise ValueError('the inputs must map the names of the arguments of the kernel to their values')
+
+    loaded_inputs = {}
+    for argname, value in inputs.items():
+        if isinstance(value, str):
+            value = os.path.join(basedir, os.path.expanduser(value))
+            if not os.path.isfile(value):
+                raise ValueError(f"the input file of argument '{argname}' ({value}) does not exist")
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"the input of argument '{argname}' must be the path of a file or a number")
+        loaded_inputs[argname] = value
+    return loaded_inputs
+
+def get_inputs_fingerprint(inputs):
+    '''
+    Identifies the provided inputs (see `load_inputs`) by the path, the size and the modification time
+    of their files, as hashing the contents of multi-GB inputs would take as long as a run
+    '''
+    return {
+        argname: [value, os.stat(value).st_size, os.stat(value).st_mtime_ns] if isinstance(value, str) else value
+        for argname, value in sorted(inputs.items())
+    }
+
+def open_input(value, dtype):
+    '''
+    Returns the values of an argument of the provided type out of its input (see `load_inputs`).
+    Input files are memory-mapped rather than loaded, copy-on-write, so that neither the file
+    nor the mappings of the next samples see what the kernel writes to the argument
+    '''
+    dtype = np.dtype(dtype)
+    if not isinstance(value, str):
+        return np.array([value], dtype=dtype)
+    if value.endswith('.npy'):
+        try:
+            values = np.load(value, mmap_mode='c')
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            # e.g. a corrupt or truncated file
+            raise ValueError(f'{value} is not a valid .npy file ({e})')
+        if values.dtype != dtype:
+            raise ValueError(f'{value} holds values of type {values.dtype} instead of {dtype}')
+        # flattened in memory order, so that no copy is needed
+        return values.reshape(-1, order='A')
+    return np.memmap(value, dtype=dtype, mode='c')
+
+def size_power(base, exponent):
+    # large exponents would take forever to evaluate, and no buffer needs them anyway
+    if abs(exponent) > 64:
+        raise ValueError(f'the exponent {exponent} is too large')
+    return base ** exponent
+
+# the operators and the functions that buffer size expressions may use (see `evaluate_size`)
+size_operators = {
+    ast.Add:      operator.add,
+    ast.Sub:      operator.sub,
+    ast.Mult:     operator.mul,
+    ast.Div:      operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod:      operator.mod,
+    ast.Pow:      size_power,
+    ast.USub:     operator.neg,
+    ast.UAdd:     operator.pos
+}
+size_functions = {'min': min, 'max': max}
+
+def evaluate_size(expression, **names):
+    '''
+    Safely evaluates a buffer size expression, i.e. an arithmetic expression of integers,
+    of the provided names (e.g. gsize and lsize) and of `min`/`max`, e.g. `gsize * gsize`,
+    to a positive number of elements. Anything else (e.g. attributes or other calls) is a ValueError
+    '''
+    def evaluate(node):
+        if isinstance(node, ast.Expression):
+            return evaluate(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, int) and not isinstance(node.value, bool):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id not in names:
+                raise ValueError(f"unknown name '{node.id}' (use one of: {', '.join(names)})")
+            if names[node.id] is None:
+                raise ValueError(f"'{node.id}' is not set")
+            return names[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in size_operators:
+            return size_operators[type(node.op)](evaluate(node.left), evaluate(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in size_operators:
+            return size_operators[type(node.op)](evaluate(node.operand))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in size_functions \
+                and node.args and not node.keywords:
+            return size_functions[node.func.id](*map(evaluate, node.args))
+        raise ValueError(f"unsupported expression '{ast.unparse(node)}'" if hasattr(ast, 'unparse') else 'unsupported expression')
+
+    try:
+        size = evaluate(ast.parse(str(expression).strip(), mode='eval'))
+    except (SyntaxError, ZeroDivisionError, OverflowError) as e:
+        raise ValueError(f"invalid expression '{expression}' ({e})")
+    if size != int(size) or size < 1:
+        raise ValueError(f"'{expression}' is not a positive number of elements ({size})")
+    return int(size)
+
+def get_arg_sizes(arg_sizes, gsize, lsize=None):
+    '''
+    Returns the number of elements of each buffer argument that has an explicit size, out of a dict that maps
+    the names of the arguments to size expressions (see `evaluate_size`) or of a list of `name=expression`
+    '''
+    if not isinstance(arg_sizes, dict):
+        pairs = [arg_size.split('=', 1) for arg_size in arg_sizes]
+        if any(len(pair) != 2 for pair in pairs):
+            raise ValueError('the sizes of the arguments must be of the form `name=expression`')
+        arg_sizes = {argname.strip(): expression for argname, expression in pairs}
+    sizes = {}
+    for argname, expression in arg_sizes.items():
+        try:
+            sizes[argname] = evaluate_size(expression, gsize=gsize, lsize=lsize)
+        except ValueError as e:
+            raise ValueError(f"the size of argument '{argname}': {e}")
+    return sizes
@@ -0,0 +1,98 @@
+import numpy as np
+
+address_spaces = ['private', 'global', 'constant', 'local', 'callee']
+
+def get_group_imbalance(group_instcounts, slowest=5):
+    '''
+    Computes load imbalance statistics out of the per work-group instruction counts,
+    i.e. an array of shape (number of work groups, len(llvm_instructions)).
+    The work of each group is taken to be the total number of instructions it executed
+    '''
+    group_instcounts = np.asarray(group_instcounts, dtype=np.float64)
+    work = group_instcounts.sum(axis=1)
+    n_groups = len(work)
+    mean = work.mean() if n_groups else 0.0
+    total = work.sum()
+
+    # Gini coefficient of the work distribution:
+    # 0 means perfect balance, (n - 1) / n means that a single group did all the work
+    if total > 0:
+        sorted_work = np.sort(work)
+        ranks = np.arange(1, n_groups + 1)
+        gini = 2 * np.sum(ranks * sorted_work) / (n_groups * total) - (n_groups + 1) / n_groups
+    else:
+        gini = 0.0
+
+    slowest_groups = np.argsort(work, kind='stable')[::-1][:slowest]
+
+    return {
+        'work groups':    n_groups,
+        'mean':           float(mean),
+        'min':            float(work.min()) if n_groups else 0.0,
+        'max':            float(work.max()) if n_groups else 0.0,
+        'max/mean ratio': float(work.max() / mean) if mean > 0 else 1.0,
+        'gini':           float(gini),
+        'slowest groups': [(int(g), int(work[g])) for g in slowest_groups]
+    }
+
+def get_memory_traffic_report(memory_traffic, float_ops, device_time=None):
+    '''
+    Aggregates the bytes moved by each type of load/store instruction per address space
+    and computes the arithmetic intensity of the kernel, i.e. the float operations (per vector lane)
+    executed per byte of global memory traffic. If the device execution time (in milliseconds)
+    is provided, the achieved global memory bandwidth (in GB/s) is computed as well
+    '''
+    bytes_per_address_space = dict(
+        (address_space, sum(v for k, v in memory_traffic.items() if k.split()[1] == address_space))
+        for address_space in address_spaces
+    )
+    global_bytes = bytes_per_address_space['global']
+
+    report = {
+        'bytes per address space': bytes_per_address_space,
+        'total bytes':             sum(bytes_per_address_space.values()),
+        'global bytes':            global_bytes,
+        'float ops':               float_ops,
+        'arithmetic intensity':    float_ops / global_bytes if global_bytes else None
+    }
+
+    if device_time is not None:
+        report['achieved bandwidth'] = global_bytes / (device_time * 1e6) if device_time > 0 else None
+
+    return report
+
+def get_roofline(float_ops, global_bytes, device_time, peak_float_ops, peak_global_bandwidth):
+    '''
+    Places a kernel on the roofline of a device, given the float operations it performed,
+    the bytes of global memory it moved, its execution time (in milliseconds)
+    and the peaks of the device (in GFLOP/s and GB/s, respectively).
+    Returns the bound that applies to the kernel (memory or compute) and how far from it the kernel is.
+    The achieved values (and the efficiency) are None if the execution time is zero (e.g. below the resolution
+    of the device timer), and the ridge point is None if the peak global memory bandwidth is zero
+    '''
+    seconds = device_time * 1e-3
+    achieved_float_ops = float_ops / seconds / 1e9 if seconds > 0 else None
+    achieved_bandwidth = global_bytes / seconds / 1e9 if seconds > 0 else None
+    intensity = float_ops / global_bytes if global_bytes else float('inf')
+    ridge_point = peak_float_ops / peak_global_bandwidth if peak_global_bandwidth > 0 else None
+
+    if intensity < (ridge_point if ridge_point is not None else float('inf')):
+        bound = 'memory'
+        attainable_float_ops = intensity * peak_global_bandwidth
+        achieved, peak = achieved_bandwidth, peak_global_bandwidth
+    else:
+        bound = 'compute'
+        attainable_float_ops = peak_float_ops
+        achieved, peak = achieved_float_ops, peak_float_ops
+    efficiency = achieved / peak if achieved is not None and peak > 0 else None
+
+    return {
+        'arithmetic intensity':  intensity if global_bytes else None,
+        'ridge point':           ridge_point,
+        'achieved float ops':    achieved_float_ops,
+        'achieved bandwidth':    achieved_bandwidth,
+        'attainable float ops':  attainable_float_ops,
+        'bound':                 bound,
+        'efficiency':            efficiency,
+        'headroom':              1 / efficiency if efficiency else None
+    }
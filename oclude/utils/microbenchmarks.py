@@ -0,0 +1,277 @@
+import pyopencl as cl
+import pyopencl.cltypes as cltypes
+import numpy as np
+
+# number of independent multiply-add chains per work item (to expose instruction level parallelism)
+# and number of iterations of each chain
+fma_chains = 8
+fma_iterations = 256
+
+# number of iterations of the local memory, atomic and barrier benchmarks
+loop_iterations = 256
+
+fma_kernel_template = '''
+{pragma}
+__kernel void fma_chain(__global {type} *out, {type} a, {type} b) {{
+    {type} x[{chains}];
+    for (int c = 0; c < {chains}; c++)
+        x[c] = ({type})(get_global_id(0) + c);
+    for (int i = 0; i < {iterations}; i++) {{
+        #pragma unroll
+        for (int c = 0; c < {chains}; c++)
+            x[c] = x[c] * a + b;
+    }}
+    {type} sum = 0;
+    for (int c = 0; c < {chains}; c++)
+        sum += x[c];
+    out[get_global_id(0)] = sum;
+}}
+'''
+
+# (kernel source, number of arrays accessed) for each global memory streaming benchmark
+streaming_kernel_sources = {
+    'copy': ('''
+__kernel void copy(__global const float4 *a, __global float4 *b, __global const float4 *c, float q) {
+    int i = get_global_id(0);
+    b[i] = a[i];
+}
+''', 2),
+    'scale': ('''
+__kernel void scale(__global const float4 *a, __global float4 *b, __global const float4 *c, float q) {
+    int i = get_global_id(0);
+    b[i] = q * a[i];
+}
+''', 2),
+    'triad': ('''
+__kernel void triad(__global const float4 *a, __global float4 *b, __global const float4 *c, float q) {
+    int i = get_global_id(0);
+    b[i] = a[i] + q * c[i];
+}
+''', 3)
+}
+
+local_bandwidth_kernel_source = f'''
+__kernel void local_bandwidth(__global float4 *out, __local float4 *buf) {{
+    int lid = get_local_id(0), lsize = get_local_size(0);
+    buf[lid] = (float4)(lid);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    float4 sum = 0;
+    for (int i = 0; i < {loop_iterations}; i++)
+        sum += buf[(lid + i) % lsize];
+    out[get_global_id(0)] = sum;
+}}
+'''
+
+atomic_kernel_sources = {
+    'global': f'''
+__kernel void atomics(__global int *counters) {{
+    __global int *counter = counters + get_group_id(0);
+    for (int i = 0; i < {loop_iterations}; i++)
+        atomic_inc(counter);
+}}
+''',
+    'local': f'''
+__kernel void atomics(__global int *counters) {{
+    __local int counter;
+    if (get_local_id(0) == 0)
+        counter = 0;
+    barrier(CLK_LOCAL_MEM_FENCE);
+    for (int i = 0; i < {loop_iterations}; i++)
+        atomic_inc(&counter);
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (get_local_id(0) == 0)
+        counters[get_group_id(0)] = counter;
+}}
+'''
+}
+
+barrier_kernel_template = '''
+__kernel void barriers(__global int *out) {{
+    int x = get_local_id(0);
+    for (int i = 0; i < {iterations}; i++) {{
+        x += i;
+        {barrier}
+    }}
+    out[get_global_id(0)] = x;
+}}
+'''
+
+def get_kernel_times(queue, kernel, gsize, args, lsize=None, repeats=5):
+    '''
+    Runs the provided kernel `repeats` times (after a warmup run)
+    and returns the device execution time of each run, in seconds
+    '''
+    lsize = (lsize,) if lsize else None
+    kernel(queue, (gsize,), lsize, *args).wait()
+    times = []
+    for _ in range(repeats):
+        event = kernel(queue, (gsize,), lsize, *args)
+        event.wait()
+        times.append((event.profile.end - event.profile.start) * 1e-9)
+    return times
+
+def time_kernel(queue, kernel, gsize, args, lsize=None, repeats=5):
+    '''
+    Runs the provided kernel `repeats` times (after a warmup run)
+    and returns the best device execution time, in seconds
+    '''
+    return min(get_kernel_times(queue, kernel, gsize, args, lsize, repeats))
+
+def get_compute_gsize(device, lsize):
+    '''
+    Returns a global NDRange (multiple of lsize) large enough to keep every compute unit of the device busy
+    '''
+    return device.max_compute_units * lsize * 8
+
+def get_benchmark_lsize(device):
+    '''
+    Returns the local NDRange used by the benchmarks that need one
+    '''
+    return min(device.max_work_group_size, 256)
+
+def measure_arithmetic_throughput(context, queue, typename='float'):
+    '''
+    Measures the peak throughput of the device (in Gop/s) for the provided type (float, double or int)
+    through chains of dependent multiply-adds (2 operations each)
+    '''
+    device = queue.device
+    lsize = get_benchmark_lsize(device)
+    gsize = get_compute_gsize(device, lsize)
+    dtype = {'float': np.float32, 'double': np.float64, 'int': np.int32}[typename]
+    source = fma_kernel_template.format(
+        pragma='#pragma OPENCL EXTENSION cl_khr_fp64 : enable' if typename == 'double' else '',
+        type=typename,
+        chains=fma_chains,
+        iterations=fma_iterations
+    )
+    program = cl.Program(context, source).build(options=['-cl-mad-enable'])
+    out = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, gsize * np.dtype(dtype).itemsize)
+    a, b = (dtype(0.999), dtype(0.001)) if typename != 'int' else (dtype(3), dtype(1))
+    elapsed = time_kernel(queue, program.fma_chain, gsize, [out, a, b], lsize)
+    return 2 * fma_chains * fma_iterations * gsize / elapsed / 1e9
+
+def measure_float_throughput(context, queue):
+    '''
+    Measures the peak single precision throughput of the device (in GFLOP/s)
+    '''
+    return measure_arithmetic_throughput(context, queue, 'float')
+
+def measure_global_bandwidth(context, queue, benchmark='copy'):
+    '''
+    Measures the global memory bandwidth of the device (in GB/s)
+    through the provided streaming benchmark (copy, scale or triad)
+    '''
+    device = queue.device
+    source, arrays = streaming_kernel_sources[benchmark]
+    nbytes = min(64 * 1024 * 1024, device.max_mem_alloc_size // 4)
+    gsize = nbytes // np.dtype(cltypes.float4).itemsize
+    program = cl.Program(context, source).build()
+    a = cl.Buffer(context, cl.mem_flags.READ_ONLY, nbytes)
+    b = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, nbytes)
+    c = cl.Buffer(context, cl.mem_flags.READ_ONLY, nbytes)
+    elapsed = time_kernel(queue, getattr(program, benchmark), gsize, [a, b, c, np.float32(3)])
+    # every element of every array is either read or written exactly once
+    return arrays * nbytes / elapsed / 1e9
+
+def measure_local_bandwidth(context, queue):
+    '''
+    Measures the local memory bandwidth of the device (in GB/s)
+    through repeated reads of a local buffer
+    '''
+    device = queue.device
+    lsize = get_benchmark_lsize(device)
+    gsize = get_compute_gsize(device, lsize)
+    itemsize = np.dtype(cltypes.float4).itemsize
+    program = cl.Program(context, local_bandwidth_kernel_source).build()
+    out = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, gsize * itemsize)
+    elapsed = time_kernel(queue, program.local_bandwidth, gsize, [out, cl.LocalMemory(lsize * itemsize)], lsize)
+    return loop_iterations * gsize * itemsize / elapsed / 1e9
+
+def measure_atomic_throughput(context, queue, address_space='global'):
+    '''
+    Measures the throughput (in Gop/s) of atomic increments on the global or local
+    memory of the device, with all the work items of a work group contending for the same counter
+    '''
+    device = queue.device
+    lsize = get_benchmark_lsize(device)
+    gsize = get_compute_gsize(device, lsize)
+    program = cl.Program(context, atomic_kernel_sources[address_space]).build()
+    # zeroed, so that the counters start from a known value (and do not overflow) in every run
+    counters = cl.Buffer(context, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR,
+                         hostbuf=np.zeros(gsize // lsize, dtype=np.int32))
+    elapsed = time_kernel(queue, program.atomics, gsize, [counters], lsize)
+    return loop_iterations * gsize / elapsed / 1e9
+
+def measure_barrier_cost(context, queue, repeats=5):
+    '''
+    Measures the cost of a work group barrier on the device (in nanoseconds), as the median
+    of the differences between repeated runs of a loop with and without a barrier per iteration
+    '''
+    device = queue.device
+    lsize = get_benchmark_lsize(device)
+    gsize = get_compute_gsize(device, lsize)
+    out = cl.Buffer(context, cl.mem_flags.WRITE_ONLY, gsize * np.dtype(np.int32).itemsize)
+    elapsed = {}
+    for barrier in ['barrier(CLK_LOCAL_MEM_FENCE);', '']:
+        source = barrier_kernel_template.format(iterations=loop_iterations, barrier=barrier)
+        program = cl.Program(context, source).build()
+        elapsed[barrier] = np.array(get_kernel_times(queue, program.barriers, gsize, [out], lsize, repeats))
+    difference = np.median(elapsed['barrier(CLK_LOCAL_MEM_FENCE);'] - elapsed[''])
+    return max(float(difference), 0) / loop_iterations * 1e9
+
+def device_supports_doubles(device):
+    return 'cl_khr_fp64' in device.extensions or device.double_fp_config != 0
+
+def get_device_microbenchmarks(context, queue, measured=None, on_measure=None):
+    '''
+    Runs all the microbenchmarks on the device of the provided queue, except for those
+    already in `measured` (a previous result of this function), calling `on_measure` (if provided)
+    before each of them. Returns a dict of the results, formatted like the rest of the device profile
+    (i.e. the value of each benchmark is a string with its unit, or the exception it failed with)
+    '''
+    measured = measured or {}
+
+    def run(path, benchmark, unit, *args):
+        previous = measured
+        for name in path:
+            previous = previous.get(name) if isinstance(previous, dict) else None
+        if previous is not None:
+            return previous
+        if on_measure is not None:
+            on_measure()
+        try:
+            return f'{benchmark(context, queue, *args)} {unit}'
+        except Exception as e:
+            return 'exception: ' + e.__class__.__name__
+
+    typenames = ['float', 'double', 'int'] if device_supports_doubles(queue.device) else ['float', 'int']
+
+    return {
+        'arithmetic throughput': dict(
+            (typename, run(('arithmetic throughput', typename), measure_arithmetic_throughput, 'Gop/s', typename))
+            for typename in typenames
+        ),
+        'global memory bandwidth': dict(
+            (benchmark, run(('global memory bandwidth', benchmark), measure_global_bandwidth, 'GB/s', benchmark))
+            for benchmark in streaming_kernel_sources
+        ),
+        'local memory bandwidth': run(('local memory bandwidth',), measure_local_bandwidth, 'GB/s'),
+        'atomic throughput': dict(
+            (address_space, run(('atomic throughput', address_space), measure_atomic_throughput, 'Gop/s', address_space))
+            for address_space in atomic_kernel_sources
+        ),
+        'barrier cost': run(('barrier cost',), measure_barrier_cost, 'ns')
+    }
+
+def is_failed_measurement(measurement):
+    return isinstance(measurement, str) and measurement.startswith('exception: ')
+
+def without_failed_measurements(profile):
+    '''
+    Returns a copy of the provided (device) profile without the measurements that failed,
+    e.g. so that they are not cached, but measured again
+    '''
+    return dict(
+        (name, without_failed_measurements(value) if isinstance(value, dict) else value)
+        for name, value in profile.items() if not is_failed_measurement(value)
+    )
@@ -0,0 +1,166 @@
+import re
+import subprocess as sp
+
+from pycparserext.ext_c_parser import OpenCLCParser
+from pycparser.c_ast import FuncDef, Typedef, Decl, Struct, TypeDecl, ArrayDecl, Constant, BinaryOp
+
+from oclude.utils.constants import preprocessor
+
+def preprocess_file(filename):
+    '''
+    Runs the preprocessor on the provided file and returns the resulting
+    source code, without empty lines and preprocessor line markers
+    '''
+    cmdout = sp.run([preprocessor, filename], stdout=sp.PIPE, stderr=sp.PIPE)
+    cmdout = cmdout.stdout.decode('ascii')
+    return ''.join(filter(lambda line : line.strip() and not line.startswith('#'), cmdout.splitlines(keepends=True)))
+
+def get_kernels(ast):
+    '''
+    Returns a list of the names of the kernels defined in the provided AST
+    '''
+    return [
+        f.decl.name for f in filter(lambda x : isinstance(x, FuncDef), ast)
+        if any(x.endswith('kernel') for x in f.decl.funcspec)
+    ]
+
+# the tokens of (preprocessed) OpenCL C that matter to `scan_kernels`: identifiers, string and character
+# literals (so that the braces and parentheses in them are not counted) and single punctuation characters
+token_regex = re.compile(r'''[A-Za-z_]\w*|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[^\s\w]''')
+
+def scan_kernels(source):
+    '''
+    Returns a list of the names of the kernels defined in the provided (preprocessed) source code, as `get_kernels`
+    does, but by scanning its tokens instead of parsing it: a kernel is a `kernel`/`__kernel` qualifier at file scope
+    followed (possibly after attributes) by a function declarator and a body.
+    Returns None if the scanner is unsure (e.g. `kernel` used in an unexpected way or unbalanced braces),
+    in which case the source code must be parsed instead
+    '''
+    tokens = token_regex.findall(source)
+    kernels = []
+    depth = 0
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif depth == 0 and token in ('kernel', '__kernel'):
+
+            ### find the name of the function: the identifier right before its parameter list ###
+            i += 1
+            name = None
+            while i < len(tokens) and tokens[i] != '(':
+                if tokens[i] in ('__attribute__', '__attribute'):
+                    # skip the (balanced) parentheses of the attribute
+                    i += 1
+                    parens = 0
+                    while i < len(tokens):
+                        parens += {'(': 1, ')': -1}.get(tokens[i], 0)
+                        if parens == 0:
+                            break
+                        i += 1
+                elif tokens[i] in (';', '{', '}', '=', ','):
+                    return None
+                else:
+                    name = tokens[i]
+                i += 1
+            if name is None or not name.isidentifier() or i == len(tokens):
+                return None
+
+            ### skip the parameter list; a body must follow (or a `;`, for a prototype that is not a definition) ###
+            parens = 0
+            while i < len(tokens):
+                parens += {'(': 1, ')': -1}.get(tokens[i], 0)
+                if parens == 0:
+                    break
+                if tokens[i] in ('{', '}', ';'):
+                    return None
+                i += 1
+            i += 1
+            if i == len(tokens) or tokens[i] not in ('{', ';'):
+                return None
+            if tokens[i] == '{':
+                kernels.append(name)
+                continue
+        i += 1
+
+    return kernels if depth == 0 else None
+
+def describe_struct_fields(struct):
+    '''
+    Returns a list of the fields of the provided struct as lists [name, type, number of elements],
+    where the number of elements is None for scalar fields and the type is None for fields
+    with a type that can not be understood (e.g. pointers)
+    '''
+    fields = []
+    for field_decl in struct.decls:
+        field_name = field_decl.name
+        # field is a scalar
+        if isinstance(field_decl.type, TypeDecl) and hasattr(field_decl.type.type, 'names'):
+            type_name = ' '.join(field_decl.type.type.names)
+            fields.append([field_name, type_name if type_name != 'bool' else 'char', None])
+        # field is an array with defined size
+        elif isinstance(field_decl.type, ArrayDecl) and hasattr(field_decl.type.type.type, 'names'):
+            dim = field_decl.type.dim
+            if isinstance(dim, Constant):
+                dims = int(dim.value)
+            elif isinstance(dim, BinaryOp) and dim.op == '+':
+                dims = int(dim.left.value) + int(dim.right.value)
+            else:
+                dims = None
+            fields.append([field_name, ' '.join(field_decl.type.type.type.names) if dims else None, dims])
+        else:
+            fields.append([field_name, None, None])
+    return fields
+
+def describe_structs(ast):
+    '''
+    Returns the descriptions of the structs and of the typedefs declared in the provided AST:
+    a dict {<type name>: {'name': <name of the struct in C>, 'fields': <see `describe_struct_fields`>}},
+    where the type name is either "struct <name>" or the name of a typedefed struct, and a dict
+    {<typedef name>: <name of the type it stands for>}
+    '''
+    structs, typedefs = {}, {}
+
+    for ext in ast.ext:
+
+        ### typedefs ###
+        if isinstance(ext, Typedef):
+            if isinstance(ext.type.type, Struct):
+                # typedefed struct (new)
+                if ext.type.type.decls is not None:
+                    structs[ext.name] = {'name': ext.name, 'fields': describe_struct_fields(ext.type.type)}
+                # typedefed struct (already seen it)
+                else:
+                    typedefs[ext.name] = 'struct ' + ext.type.type.name
+            # simple typedef (not a struct)
+            elif hasattr(ext.type.type, 'names'):
+                typedefs[ext.name] = ' '.join(ext.type.type.names)
+
+        ### struct declarations ###
+        elif isinstance(ext, Decl) and isinstance(ext.type, Struct) and ext.type.decls is not None:
+            structs['struct ' + ext.type.name] = {'name': ext.type.name, 'fields': describe_struct_fields(ext.type)}
+
+    return structs, typedefs
+
+def parse_unit(filename, source=None):
+    '''
+    Preprocesses and parses the provided OpenCL file once, for all the stages of oclude that need it
+    (it is not preprocessed again if its preprocessed source code is provided).
+    Returns a dict with the preprocessed source code, its AST, the kernels that it defines and
+    the descriptions of its structs and typedefs (see `describe_structs`)
+    '''
+    source = source if source is not None else preprocess_file(filename)
+    ast = OpenCLCParser().parse(source)
+    structs, typedefs = describe_structs(ast)
+    return {
+        'source':   source,
+        'ast':      ast,
+        'kernels':  get_kernels(ast),
+        'structs':  structs,
+        'typedefs': typedefs
+    }
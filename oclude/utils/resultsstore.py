@@ -0,0 +1,216 @@
+import os
+import sqlite3
+from time import time
+
+import numpy as np
+
+from oclude.utils.constants import llvm_instructions, memory_instructions, memory_bytes_counters, float_ops_counter
+from oclude.utils.cachedfiles import get_oclude_version
+
+def get_results_db():
+    '''
+    Returns the default path of the results store: $OCLUDE_RESULTS_DB if it is set, otherwise
+    `oclude/results.sqlite` under $XDG_DATA_HOME (by default, ~/.local/share)
+    '''
+    if os.environ.get('OCLUDE_RESULTS_DB'):
+        return os.path.abspath(os.path.expanduser(os.environ['OCLUDE_RESULTS_DB']))
+    data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(data_home, 'oclude', 'results.sqlite')
+
+# the columns of the runs table: the configuration of each run, the versions it ran with and its aggregates
+run_columns = [
+    ('id',                 'INTEGER PRIMARY KEY'),
+    ('timestamp',          'REAL'),
+    ('file',               'TEXT'),
+    ('digest',             'TEXT'),
+    ('kernel',             'TEXT'),
+    ('gsize',              'INTEGER'),
+    ('lsize',              'INTEGER'),
+    ('platform',           'TEXT'),
+    ('device',             'TEXT'),
+    ('device key',         'TEXT'),
+    ('seed',               'TEXT'),
+    ('samples',            'INTEGER'),
+    ('instcounts',         'INTEGER'),
+    ('timeit',             'INTEGER'),
+    ('pergroup',           'INTEGER'),
+    ('oclude version',     'TEXT'),
+    ('profiling overhead', 'REAL'),
+    ('mean device time',   'REAL'),
+    ('std device time',    'REAL'),
+    ('min device time',    'REAL'),
+    ('mean hostcode time', 'REAL'),
+    ('mean instructions',  'REAL'),
+    ('mean float ops',     'REAL')
+]
+
+# the columns of the samples table: the measurements of each sample of each run,
+# named after the keys of the results of `profile_opencl_kernel`
+sample_columns = [
+    ('run',           'INTEGER'),
+    ('sample',        'INTEGER'),
+    ('hostcode time', 'REAL'),
+    ('device time',   'REAL'),
+    ('transfer time', 'REAL'),
+    (float_ops_counter, 'INTEGER')
+] + [(instruction, 'INTEGER') for instruction in llvm_instructions] \
+  + [(bytes_counter, 'INTEGER') for bytes_counter in memory_bytes_counters]
+
+# the columns of the runs table that queries may filter on
+filter_columns = ['kernel', 'file', 'device', 'gsize', 'lsize', 'seed']
+
+def quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+def get_sample_row(run_id, sample, sample_results):
+    '''
+    Flattens the results of a sample (see `run_kernel`) to a row of the samples table
+    '''
+    timeit = sample_results.get('timeit', {})
+    instcounts = sample_results.get('instcounts', {})
+    memory_traffic = sample_results.get('memory traffic', {})
+    return (
+        run_id, sample,
+        timeit.get('hostcode'), timeit.get('device'), timeit.get('transfer'),
+        sample_results.get(float_ops_counter),
+        *(instcounts.get(instruction) for instruction in llvm_instructions),
+        *(memory_traffic.get(instruction) for instruction in memory_instructions)
+    )
+
+class ResultsStore:
+    '''
+    An (opt-in) SQLite database of profiling runs, i.e. of the configuration, the device,
+    the version of oclude, the per sample measurements and the aggregates of every run
+    of `profile_opencl_kernel` that is recorded in it (see `record_run` and `query`)
+    '''
+
+    def __init__(self, path=None):
+        self.path = path if isinstance(path, str) else get_results_db()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(f'''
+            CREATE TABLE IF NOT EXISTS runs ({', '.join(f'{quote(c)} {t}' for c, t in run_columns)});
+            CREATE TABLE IF NOT EXISTS samples ({', '.join(f'{quote(c)} {t}' for c, t in sample_columns)});
+            CREATE INDEX IF NOT EXISTS runs_by_kernel ON runs (kernel);
+            CREATE INDEX IF NOT EXISTS runs_by_device ON runs (device);
+            CREATE INDEX IF NOT EXISTS runs_by_gsize ON runs (gsize);
+            CREATE INDEX IF NOT EXISTS samples_by_run ON samples (run, sample);
+        ''')
+
+    def close(self):
+        self.connection.close()
+
+    def record_run(self, config, result, timestamp=None):
+        '''
+        Records a run of `profile_opencl_kernel`, i.e. its configuration (a dict with the file, its digest,
+        the NDRange, the device, the seed etc, named after the columns of the runs table) and its result.
+        Returns the id of the run
+        '''
+        samples = result['results'] or []
+        device_times = [s['timeit']['device'] for s in samples if 'timeit' in s]
+        hostcode_times = [s['timeit']['hostcode'] for s in samples if 'timeit' in s]
+        instructions = [sum(s['instcounts'].values()) for s in samples if 'instcounts' in s]
+        float_ops = [s[float_ops_counter] for s in samples if float_ops_counter in s]
+
+        def mean(values):
+            return float(np.mean(values)) if values else None
+
+        run = dict(config, **{
+            'timestamp':          timestamp or time(),
+            'kernel':             result['kernel'],
+            'oclude version':     get_oclude_version(),
+            'profiling overhead': result['profiling overhead'],
+            'mean device time':   mean(device_times),
+            'std device time':    float(np.std(device_times)) if device_times else None,
+            'min device time':    float(np.min(device_times)) if device_times else None,
+            'mean hostcode time': mean(hostcode_times),
+            'mean instructions':  mean(instructions),
+            'mean float ops':     mean(float_ops)
+        })
+        columns = [c for c, _ in run_columns[1:] if c in run]
+        # e.g. seeds, which may not fit in an SQLite INTEGER (see `ArgumentGenerator`)
+        text_columns = set(c for c, t in run_columns if t == 'TEXT')
+
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            run_id = self.connection.execute(
+                f"INSERT INTO runs ({', '.join(map(quote, columns))}) VALUES ({', '.join('?' * len(columns))})",
+                [str(run[c]) if c in text_columns and run[c] is not None else run[c] for c in columns]
+            ).lastrowid
+            self.connection.executemany(
+                f"INSERT INTO samples VALUES ({', '.join('?' * len(sample_columns))})",
+                (get_sample_row(run_id, i, s) for i, s in enumerate(samples))
+            )
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+        return run_id
+
+    def query(self, per_sample=False, frame='numpy', **filters):
+        '''
+        Returns the recorded runs (or, if `per_sample` is True, their samples, along with the configuration
+        of their runs) that match the provided filters, e.g. `kernel='vadd', gsize=(1024, 4096)`.
+        Each filter (see `filter_columns`) is either a value, a list of values or a (min, max) tuple.
+        The result is a NumPy structured array (`frame='numpy'`), a pandas DataFrame (`frame='pandas'`) or
+        a list of dicts (`frame='records'`), with a column (field, key) for each column of the runs (or samples) table
+        '''
+        where, params = [], []
+        for column, value in filters.items():
+            if column not in filter_columns:
+                raise ValueError(f"can not filter on '{column}' (filter on one of: {', '.join(filter_columns)})")
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                where.append(f'runs.{quote(column)} BETWEEN ? AND ?')
+                params += list(value)
+            elif isinstance(value, list):
+                where.append(f"runs.{quote(column)} IN ({', '.join('?' * len(value))})")
+                params += value
+            else:
+                where.append(f'runs.{quote(column)} = ?')
+                params.append(value)
+
+        if per_sample:
+            columns = [('run', 'INTEGER')] + [c for c in run_columns[1:] if c[0] in ['timestamp'] + filter_columns] + sample_columns[1:]
+            select = ', '.join(
+                ('samples.' if column in dict(sample_columns) else 'runs.') + quote(column) for column, _ in columns
+            )
+            sql = f'SELECT {select} FROM samples JOIN runs ON samples.run = runs.id'
+            order = ' ORDER BY samples.run, samples.sample'
+        else:
+            columns = run_columns
+            sql = f"SELECT {', '.join('runs.' + quote(column) for column, _ in columns)} FROM runs"
+            order = ' ORDER BY runs.id'
+        sql += (' WHERE ' + ' AND '.join(where) if where else '') + order
+
+        rows = self.connection.execute(sql, params).fetchall()
+        names = [column for column, _ in columns]
+
+        if frame == 'records':
+            return [dict(zip(names, row)) for row in rows]
+        if frame == 'pandas':
+            import pandas as pd
+            return pd.DataFrame.from_records(rows, columns=names)
+        if frame != 'numpy':
+            raise ValueError("the frame must be one of 'numpy', 'pandas' and 'records'")
+        # text columns are kept as objects and numeric ones as floats, so that missing measurements are NaN
+        dtype = [(column, object if column_type == 'TEXT' else np.float64) for column, column_type in columns]
+        array = np.empty(len(rows), dtype=dtype)
+        for i, (column, column_type) in enumerate(columns):
+            values = [row[i] for row in rows]
+            array[column] = values if column_type == 'TEXT' else [np.nan if v is None else v for v in values]
+        return array
+
+def query_results(path=None, per_sample=False, frame='numpy', **filters):
+    '''
+    Returns the runs (or the samples) recorded in the results store at `path` (by default, see `get_results_db`)
+    that match the provided filters (see `ResultsStore.query`)
+    '''
+    store = ResultsStore(path)
+    try:
+        return store.query(per_sample, frame, **filters)
+    finally:
+        store.close()
@@ -1,5 +1,48 @@
+#include <cerrno>
+#include <cctype>
+#include <cstdlib>
+
 #include "instrumentation-parser.hpp"
 
+/* the largest record accepted, so that a corrupt header does not make the parser allocate an arbitrary amount of memory */
+const unsigned long ir_size_limit = 1ul << 32;
+
+/*
+ * co-process mode: reads records "<number of bytes>\n<IR>" from STDIN until EOF and, for each of them,
+ * writes a single JSON line with its instrumentation info (or the error that occured) to STDOUT
+ */
+int stream() {
+
+    print_message.quiet = true;
+
+    unsigned long record = 0, size;
+    std::string header;
+    while (std::getline(std::cin, header)) {
+        if (header.empty()) continue;
+        std::string name = "record " + std::to_string(record++);
+        /* a malformed header is reported as the error of its record, and the next line is read as a header
+           (it is not parsed by std::stoul, as its exceptions can not be caught: LLVM builds with -fno-exceptions) */
+        char *end;
+        errno = 0;
+        size = std::strtoul(header.c_str(), &end, 10);
+        if (!std::isdigit(static_cast<unsigned char>(header[0])) || *end != '\0') {
+            dump_instrumentation_error_json("invalid record header: " + header, name);
+            continue;
+        }
+        if (errno == ERANGE || size > ir_size_limit) {
+            dump_instrumentation_error_json("record size out of range: " + header, name);
+            continue;
+        }
+        std::string ir(size, '\0');
+        std::cin.read(&ir[0], size);
+        std::string error = parse_input_buffer(ir, name);
+        if (!error.empty()) dump_instrumentation_error_json(error, name);
+        else                dump_instrumentation_info_json(get_instrumentation_info_from_module(), name);
+    }
+
+    return 0;
+}
+
 int main(int argc, char const *argv[]) {
 
     if (argc < 2) {
@@ -7,16 +50,35 @@ int main(int argc, char const *argv[]) {
         exit(EXIT_FAILURE);
     }
 
-    parse_input_file(argv[1]);
+    std::string mode = argv[1];
+    if (mode == "--stream") return stream();
+    if (mode == "--version") {
+        std::cout << "instrumentation-parser " << INSTRUMENTATION_PARSER_VERSION << " (LLVM " << LLVM_VERSION_STRING << ")" << std::endl;
+        return 0;
+    }
+
+    bool json = mode == "--json";
+    if (json && argc < 3) {
+        print_message.usage();
+        exit(EXIT_FAILURE);
+    }
 
-    /* the structure that will hold the instrumentation for all the functions of the module */
-    instrumentation_t instrumentation;
+    /* batch mode: the input files are handled one after the other, in the same process */
+    for (int i = json ? 2 : 1; i < argc; i++) {
 
-    /* the following function iterates over module functions, then basic blocks, then instructions */
-    instrumentation = get_instrumentation_info_from_module();
+        parse_input_file(argv[i]);
 
-    /* instrumentation info gathered; dump it in a python - friendly way for parsing */
-    dump_instrumentation_info(instrumentation);
+        /* the structure that will hold the instrumentation for all the functions of the module */
+        instrumentation_t instrumentation;
+
+        /* the following function iterates over module functions, then basic blocks, then instructions */
+        instrumentation = get_instrumentation_info_from_module();
+
+        /* instrumentation info gathered; dump it in a python - friendly way for parsing */
+        if (json) dump_instrumentation_info_json(instrumentation, argv[i]);
+        else      dump_instrumentation_info(instrumentation);
+
+    }
 
     return 0;
 }
@@ -12,7 +12,8 @@ setup(
     author_email =     'sot.niarchos@gmail.com',
     url =              'https://github.com/zehanort/oclude',
 
-    install_requires = ['pycparserext>=2020.1', 'pyopencl>=2020.1', 'rvg', 'timeout-decorator', 'tqdm'],
+    install_requires = ['pycparserext>=2020.1', 'pyopencl>=2020.1', 'numpy>=1.17', 'timeout-decorator', 'tqdm'],
+    extras_require =   { 'pandas': ['pandas'] },
     python_requires =  '>=3.6',
     entry_points =     { 'console_scripts': ['oclude=oclude.oclude:run'] },
     packages =         ['oclude']
@@ -0,0 +1,18 @@
+import pytest
+import os
+
+@pytest.fixture(scope='session', autouse=True)
+def oclude_cache_dir(tmp_path_factory):
+
+    # the tests run on a cache of their own (which the oclude processes they start inherit),
+    # so that the cache of the user is never touched
+    cache_dir_before = os.environ.get('OCLUDE_CACHE_DIR')
+    cachedir = str(tmp_path_factory.mktemp('oclude_cache'))
+    os.environ['OCLUDE_CACHE_DIR'] = cachedir
+
+    yield cachedir # run test session #
+
+    if cache_dir_before is None:
+        del os.environ['OCLUDE_CACHE_DIR']
+    else:
+        os.environ['OCLUDE_CACHE_DIR'] = cache_dir_before
@@ -1,10 +1,10 @@
 import pytest
 import os
 import shutil
-from tempfile import gettempdir
 from testutils import *
 
-cachedir = os.path.join(os.path.split(os.path.dirname(os.path.abspath(__file__)))[0], 'oclude', 'utils', '.cache')
+# the cache of the test session (see `oclude_cache_dir` in conftest.py)
+cachedir = None
 
 src1 = '''
 __kernel void vadd(__global float* a, __constant float* b, __global float* c, const unsigned int count)
@@ -26,36 +26,10 @@ tmptestdir2 = os.path.join(testdir, 'tmptestdir2')
 kernel1 = os.path.join(tmptestdir1, 'same_name.cl')
 kernel2 = os.path.join(tmptestdir2, 'same_name.cl')
 
-@pytest.yield_fixture(scope='session', autouse=True)
-def ensure_consistent_cache_state():
-
-    tmpdir = gettempdir()
-    files_moved = []
-    for filename in os.listdir(cachedir):
-        file_path_from = os.path.join(cachedir, filename)
-        file_path_to = os.path.join(tmpdir, filename)
-        try:
-            shutil.move(file_path_from, file_path_to)
-        except Exception as e:
-            print('Failed to move %s to %s. Reason: %s' % (file_path_from, file_path_to, e))
-        files_moved.append((file_path_to, file_path_from))
-
-    yield # run test session #
-
-    # clear cache
-    for filename in os.listdir(cachedir):
-        file_path = os.path.join(cachedir, filename)
-        try:
-            os.unlink(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
-
-    # restore previous cache files
-    for file_path_from, file_path_to in files_moved:
-        try:
-            shutil.move(file_path_from, file_path_to)
-        except Exception as e:
-            print('Failed to move %s to %s. Reason: %s' % (file_path_from, file_path_to, e))
+@pytest.fixture(scope='session', autouse=True)
+def ensure_consistent_cache_state(oclude_cache_dir):
+    global cachedir
+    cachedir = oclude_cache_dir
 
 @pytest.yield_fixture(autouse=True)
 def handle_test_files():
@@ -73,14 +47,19 @@ def handle_test_files():
     with open(kernel2, 'w') as f:
         f.write(src2)
 
+    # the cache is content-addressed, so what the test adds to it is told apart by name only
+    from oclude.utils import CachedFiles
+    cached_before_test = set(os.listdir(cachedir))
+
     yield ### run test ###
 
     try:
         shutil.rmtree(tmptestdir1)
         shutil.rmtree(tmptestdir2)
-        os.remove(os.path.join(testdir, os.path.join(cachedir, 'instr_same_name.cl')))
-        os.remove(os.path.join(testdir, os.path.join(cachedir, 'same_name.cl.digest')))
-        os.remove(os.path.join(testdir, os.path.join(cachedir, 'same_name.cl.kernels')))
+        cache = CachedFiles()
+        for filename in set(os.listdir(cachedir)) - cached_before_test:
+            if os.path.isfile(os.path.join(cachedir, filename)) and not filename.startswith('index.sqlite'):
+                cache.remove_artifact(os.path.join(cachedir, filename))
     except:
         pass
 
@@ -99,6 +78,37 @@ def test_kernel_files_same_name():
     assert retcode2 == 0
     assert error2.splitlines()[0].strip().endswith('is not cached')
 
+def test_kernel_files_same_name_instcounts():
+
+    # instrument both files with the same name
+    _, error1, retcode1 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd -i")
+    _, error2, retcode2 = run_command(f"oclude -f {kernel2} -g {GSIZE} -l {LSIZE} -k vmul -i")
+
+    # the first one should still be cached
+    _, error3, retcode3 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd -i")
+
+    assert retcode1 == 0
+    assert error1.splitlines()[0].strip().endswith('is not cached')
+    assert retcode2 == 0
+    assert error2.splitlines()[0].strip().endswith('is not cached')
+    assert retcode3 == 0
+    assert error3.splitlines()[0].strip().endswith('is cached')
+
+def test_content_addressed_cache_names():
+
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    copy_of_kernel1 = os.path.join(tmptestdir2, 'copy_of_same_name.cl')
+    shutil.copy(kernel1, copy_of_kernel1)
+
+    # files with the same name but different content do not share an entry
+    assert cache.get_name_of_instrumented_file(kernel1) != cache.get_name_of_instrumented_file(kernel2)
+    # identical files in different paths do
+    assert cache.get_name_of_instrumented_file(kernel1) == cache.get_name_of_instrumented_file(copy_of_kernel1)
+    assert cache.get_name_of_instrumented_file(kernel1, 'vadd') == cache.get_name_of_instrumented_file(copy_of_kernel1, 'vadd')
+    assert cache.get_name_of_instrumented_file(kernel1, 'vadd') != cache.get_name_of_instrumented_file(kernel1)
+
 def test_same_kernel_file_twice_no_instcounts():
 
     # run first kernel
@@ -165,20 +175,342 @@ def test_ignore_cache_flag():
 
 def test_no_cache_warnings():
 
+    from oclude.utils import CachedFiles
+
+    # the size of the cache is tracked by its index, so the garbage must go through it
+    cache = CachedFiles()
     large_garbage = os.path.join(cachedir, 'large_garbage.txt')
-    with open(large_garbage, 'w') as f:
-        for _ in range(20_000_000):
-            f.write('A')
+    cache.store_artifact(large_garbage, 'A' * 20_000_000)
 
-    # dummy kernel to produce cache warning
-    _, error1, retcode1 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd")
+    # dummy kernel to produce cache warning (the garbage does not fit in the budget, so it is evicted)
+    _, error1, retcode1 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd --cache-budget 10")
+    garbage_evicted = not os.path.exists(large_garbage)
 
     # dummy kernel to suppress cache warning
-    _, error2, retcode2 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd --no-cache-warnings")
+    cache.store_artifact(large_garbage, 'A' * 20_000_000)
+    _, error2, retcode2 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd --cache-budget 10 --no-cache-warnings")
 
-    os.remove(large_garbage)
+    cache.remove_artifact(large_garbage)
 
     assert retcode1 == 0
     assert 'WARNING: Cache size exceeds' in error1.splitlines()[0]
+    assert garbage_evicted
     assert retcode2 == 0
     assert 'WARNING: Cache size exceeds' not in error2.splitlines()[0]
+
+def test_cache_entry_lock():
+
+    import sys
+    import subprocess
+    from time import sleep
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    entry = os.path.join(cachedir, 'function_test_lock.json')
+    marker = os.path.join(tmptestdir1, 'lock_acquired')
+
+    # another process that needs the same entry has to wait until it is released
+    with cache.lock(entry):
+        waiting = subprocess.Popen([sys.executable, '-c', (
+            'from oclude.utils import CachedFiles\n'
+            f'with CachedFiles().lock({entry!r}):\n'
+            f'    open({marker!r}, "w").close()\n'
+        )])
+        sleep(1)
+        acquired_while_locked = os.path.exists(marker)
+    retcode = waiting.wait(timeout=60)
+
+    assert retcode == 0
+    assert not acquired_while_locked
+    assert os.path.exists(marker)
+
+def test_cache_eviction_and_stats():
+
+    from time import sleep
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    size_before = cache.size
+    artifacts = [os.path.join(cachedir, f'function_test_eviction_{i}.json') for i in range(3)]
+    for artifact in artifacts:
+        cache.store_artifact(artifact, 'A' * 1000)
+        sleep(0.01)
+
+    # the first artifact is looked up again, so the second one is now the least recently used
+    cache.record_access(artifacts[0], True)
+    cache.record_access(artifacts[1], False)
+
+    # whatever was cached before the test is even less recently used
+    _, freed = cache.evict(cache.size - size_before - 1000)
+    artifacts_left = [os.path.exists(artifact) for artifact in artifacts]
+    stats = cache.stats()
+    output, _, retcode = run_command('oclude cache stats')
+
+    for artifact in artifacts:
+        cache.remove_artifact(artifact)
+
+    assert freed == size_before + 1000
+    assert artifacts_left == [True, False, True]
+    assert stats['function instrumentation']['hits'] >= 1
+    assert stats['function instrumentation']['misses'] >= 1
+    assert stats['function instrumentation']['entries'] >= 2
+    assert retcode == 0
+    assert 'function instrumentation - ' in output
+
+def test_cache_eviction_skips_locked_entries():
+
+    from time import sleep
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    size_before = cache.size
+    artifacts = [os.path.join(cachedir, f'function_test_locked_eviction_{i}.json') for i in range(3)]
+    for artifact in artifacts:
+        cache.store_artifact(artifact, 'A' * 1000)
+        sleep(0.01)
+
+    # the least recently used artifact is in use by another process, so the next one is evicted instead
+    with cache.lock(artifacts[0]):
+        evicted, freed = cache.evict(cache.size - size_before - 1000)
+    artifacts_left = [os.path.exists(artifact) for artifact in artifacts]
+
+    for artifact in artifacts:
+        cache.remove_artifact(artifact)
+
+    assert freed == size_before + 1000
+    assert artifacts_left == [True, False, True]
+
+def test_device_profile_cache():
+
+    from time import time
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    cache.store_device_profile('testdevice', {'command latency': 1.0}, timestamp=time() - 100)
+
+    recent = cache.get_device_profile('testdevice', max_age=1000)
+    stale = cache.get_device_profile('testdevice', max_age=10)
+    missing = cache.get_device_profile('missingdevice', max_age=1000)
+
+    os.remove(cache.get_name_of_device_profile_file('testdevice'))
+
+    assert recent['profile'] == {'command latency': 1.0}
+    assert stale is None
+    assert missing is None
+
+def test_instrument_command_fills_cache():
+
+    # instrument the whole directory in advance
+    output1, _, retcode1 = run_command(f"oclude instrument -f {tmptestdir1} -j 2")
+
+    # the kernel file should now be cached
+    _, error2, retcode2 = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd -i")
+
+    assert retcode1 == 0
+    assert 'Instrumented 1 out of 1 files' in output1
+    assert retcode2 == 0
+    assert error2.splitlines()[0].strip().endswith('is cached')
+
+def test_parsed_unit_cache():
+
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    structsfile = os.path.join(testdir, 'toy_kernels', 'structs.cl')
+    digest = cache.digest(structsfile)
+    unitfile = cache.get_name_of_parsed_unit_file(digest)
+
+    unit1 = cache.get_parsed_unit(structsfile)
+    # drop the in-process memo, so that the unit is loaded from the disk
+    CachedFiles.parsed_units.pop(digest, None)
+    unit2 = cache.get_parsed_unit(structsfile)
+
+    assert os.path.exists(unitfile)
+    os.remove(unitfile)
+
+    assert unit1['kernels'] == unit2['kernels'] == ['stest']
+    assert unit1['ast'] is not unit2['ast']
+    assert unit2['structs']['data_struct']['fields'][0] == ['u', 'uint', None]
+    assert unit2['structs']['struct damnyou_st']['fields'][0] == ['b', 'char', None]
+    assert unit2['typedefs']['reduce_struct'] == 'struct reduce_struct_t'
+    assert unit2['typedefs']['myint'] == 'int'
+
+def test_shared_cache_dirs(monkeypatch):
+
+    from oclude.utils import CachedFiles
+
+    # populate a shared cache, as CI would, by pointing the cache of oclude to it
+    shared_cachedir = os.path.join(tmptestdir2, 'shared_cache')
+    monkeypatch.setenv('OCLUDE_CACHE_DIR', shared_cachedir)
+    shared_cache = CachedFiles()
+    shared_cache.get_parsed_unit(kernel1)
+    unitfile = shared_cache.get_name_of_parsed_unit_file(shared_cache.digest(kernel1))
+    shared_cache.store_device_profile('shareddevice', {'command latency': 1.0})
+    profilefile = shared_cache.get_name_of_device_profile_file('shareddevice')
+    CachedFiles.parsed_units.clear()
+    shared_cache.close_index()
+
+    # the shared cache is looked up (but never written to) after the local one
+    monkeypatch.setenv('OCLUDE_CACHE_DIR', cachedir)
+    monkeypatch.setenv('OCLUDE_SHARED_CACHE_DIRS', os.pathsep.join([os.path.join(tmptestdir2, 'missing'), shared_cachedir]))
+    cache = CachedFiles()
+    found = cache.find_artifact(profilefile)
+    profile = cache.get_device_profile('shareddevice', max_age=1000)
+    # pickles (e.g. parsed units) are never loaded from the shared cache, so the file is parsed again locally
+    unit = cache.get_parsed_unit(kernel1)
+    unit_written_locally = os.path.exists(os.path.join(cachedir, os.path.basename(unitfile)))
+    profile_written_locally = os.path.exists(os.path.join(cachedir, os.path.basename(profilefile)))
+    output, _, retcode = run_command('oclude cache stats')
+
+    assert cache.cachedir == cachedir
+    assert found == os.path.join(shared_cachedir, os.path.basename(profilefile))
+    assert profile['profile'] == {'command latency': 1.0}
+    assert unit['kernels'] == ['vadd']
+    assert unit_written_locally
+    assert not profile_written_locally
+    assert retcode == 0
+    assert f'Shared cache (read-only) at {shared_cachedir}' in output
+
+def test_kernel_scanner():
+
+    from glob import glob
+    from pycparserext.ext_c_parser import OpenCLCParser
+    from oclude.utils.parsedunit import preprocess_file, scan_kernels, get_kernels
+
+    scanned = scan_kernels('''
+        kernel void prototype(global int *a);
+        typedef struct { int x; } S;
+        __kernel __attribute__((reqd_work_group_size(64, 1, 1))) void with_attribute(global S *s)
+        {
+            int kernel_count = 0;
+            if (s->x) { kernel_count = '}'; }
+        }
+        __kernel void prototype(global int *a) { a[0] = "}{"[0]; }
+        void helper(void) {}
+        kernel
+        void
+        multi_line (global float4 *x)
+        {
+        }
+    ''')
+
+    # the scanner finds the same kernels as the parser in every test kernel file
+    toy_kernels = sorted(glob(os.path.join(testdir, 'toy_kernels', '*.cl')))
+    mismatches = [
+        file for file in toy_kernels
+        if scan_kernels(preprocess_file(file)) != get_kernels(OpenCLCParser().parse(preprocess_file(file)))
+    ]
+    output, _, retcode = run_command(f"oclude list -f {os.path.join(testdir, 'toy_kernels')} -j 2")
+
+    assert scanned == ['with_attribute', 'prototype', 'multi_line']
+    # unsure cases, which are left to the parser
+    assert scan_kernels('int kernel; kernel void k(void) {}') is None
+    assert scan_kernels('kernel void k(void) {') is None
+    assert not mismatches
+    assert retcode == 0
+    assert f"{os.path.join(testdir, 'toy_kernels', 'structs.cl')}: stest" in output.splitlines()
+
+def test_scanned_file_is_preprocessed_once(monkeypatch):
+
+    import oclude.utils.cachedfiles
+    import oclude.utils.parsedunit
+    from oclude.utils import CachedFiles
+
+    preprocessed = []
+    original_preprocess_file = oclude.utils.parsedunit.preprocess_file
+    def preprocess_file(filename):
+        preprocessed.append(filename)
+        return original_preprocess_file(filename)
+    monkeypatch.setattr(oclude.utils.cachedfiles, 'preprocess_file', preprocess_file)
+    monkeypatch.setattr(oclude.utils.parsedunit, 'preprocess_file', preprocess_file)
+
+    # the file is scanned for its kernels and then parsed, out of the same preprocessed source code
+    cache = CachedFiles()
+    kernels = cache.get_file_kernels(kernel1)
+    unit = cache.get_parsed_unit(kernel1, use_cache=False)
+
+    assert kernels == unit['kernels'] == ['vadd']
+    assert preprocessed == [kernel1]
+
+def test_result_cache():
+
+    from oclude import profile_opencl_kernel
+
+    def profile(**kwargs):
+        return profile_opencl_kernel(file=kernel1, kernel='vadd', gsize=GSIZE, lsize=LSIZE, timeit=True, **kwargs)
+
+    first = profile(seed=42, use_result_cache=True)
+    cached = profile(seed=42, use_result_cache=True)
+    other_seed = profile(seed=43, use_result_cache=True)
+    stale = profile(seed=42, use_result_cache=True, result_max_age=0)
+    unseeded = profile(use_result_cache=True)
+
+    # the cached timings are returned as they were measured (no run ever measures the exact same times)
+    assert cached == first
+    assert other_seed['results'] != first['results']
+    assert stale['results'] != first['results']
+    assert unseeded['results'] != first['results']
+
+    _, error, retcode = run_command(f"oclude -f {kernel1} -g {GSIZE} -l {LSIZE} -k vadd -t --seed 42 --use-result-cache")
+
+    assert retcode == 0
+    assert 'INFO: Using the cached results of an identical run' in error
+
+def test_struct_layouts_cache():
+
+    from glob import glob
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+    structsfile = os.path.join(testdir, 'toy_kernels', 'structs.cl')
+    digest = cache.digest(structsfile)
+    command = f'oclude kernel -f {structsfile} -k stest -g {GSIZE} -l {LSIZE}'
+
+    _, _, retcode1 = run_command(command)
+    layouts_files = glob(cache.get_name_of_struct_layouts_file(digest, '*'))
+    layouts = cache.get_struct_layouts(digest, layouts_files[0].split('_')[-1][:-len('.json')])
+    # the second run should use the cached layouts
+    _, _, retcode2 = run_command(command)
+
+    for f in layouts_files:
+        os.remove(f)
+    os.remove(cache.get_name_of_parsed_unit_file(digest))
+
+    assert retcode1 == 0
+    assert retcode2 == 0
+    assert len(layouts_files) == 1
+    # only the structs used by the arguments of the kernel are resolved
+    assert sorted(layouts) == ['data_struct', 'struct reduce_struct_t']
+    assert layouts['data_struct']['itemsize'] == 16
+
+def test_cache_index():
+
+    from time import time
+    from oclude.utils import CachedFiles
+
+    cache = CachedFiles()
+
+    # the size of the cache is tracked incrementally
+    size = cache.size
+    garbage = os.path.join(cachedir, 'garbage.txt')
+    cache.store_artifact(garbage, 'A' * 1000)
+    size_with_garbage = cache.size
+    cache.remove_artifact(garbage)
+
+    # the digest of a file is recorded along with its mtime and size
+    old_mtime = time() - 100
+    os.utime(kernel1, (old_mtime, old_mtime))
+    digest1 = cache.md5(kernel1)
+    recorded = cache.index.execute('SELECT md5 FROM sources WHERE path = ?', (os.path.abspath(kernel1),)).fetchone()
+
+    # and the file is hashed again when they change
+    with open(kernel1, 'w') as f:
+        f.write(src1 + '\n')
+    os.utime(kernel1, (old_mtime, old_mtime))
+    digest2 = cache.md5(kernel1)
+
+    assert size_with_garbage == size + 1000
+    assert cache.size == size
+    assert not os.path.exists(garbage)
+    assert recorded == (digest1,)
+    assert digest1 != digest2
@@ -1,5 +1,6 @@
 import pytest
-from testutils import run_kernel, run_kernel_from_module
+import os
+from testutils import run_kernel, run_kernel_from_module, run_command, testdir, GSIZE, LSIZE
 
 @pytest.mark.parametrize(
     'kernelfile,kernel',
@@ -34,3 +35,17 @@ def test_kernel(kernelfile, kernel):
 )
 def test_kernel_from_module(kernelfile, kernel):
     run_kernel_from_module(kernelfile, kernel)
+
+@pytest.mark.parametrize(
+    'kernelfile,kernel',
+    [
+        ('toy_kernels/simplevec.cl', 'vecadd'),
+        ('toy_kernels/stress.cl', 'muchiftest'),
+    ]
+)
+def test_kernel_per_work_group(kernelfile, kernel):
+    kernelfilepath = os.path.join(testdir, kernelfile)
+    output, _, retcode = run_command(f'oclude kernel -f {kernelfilepath} -k {kernel} -g {GSIZE} -l {LSIZE} -w')
+    assert retcode == 0
+    assert 'Work group load imbalance' in output
+    assert f'{GSIZE // LSIZE:16} - work groups' in output
@@ -0,0 +1,124 @@
+import pytest
+import os
+import json
+import numpy as np
+import pyopencl.cltypes as cltypes
+from oclude.utils.kernelargs import ArgumentGenerator, open_input
+from testutils import *
+
+specs = [(cltypes.float, 1000), (cltypes.int, None), (cltypes.uint, 1000), (cltypes.char, 1000), (cltypes.float4, 100)]
+
+def generate(seed, sample):
+    return [np.copy(values) for values in ArgumentGenerator(specs, 1000, seed).generate(sample)]
+
+def test_seeded_arguments_are_reproducible():
+    first, again = generate(42, 3), generate(42, 3)
+    other_seed, other_sample = generate(43, 3), generate(42, 4)
+    assert all(np.array_equal(a, b) for a, b in zip(first, again))
+    assert not np.array_equal(first[0], other_seed[0])
+    assert not np.array_equal(first[0], other_sample[0])
+    # each sample depends on the seed only, not on the samples generated before it
+    generator = ArgumentGenerator(specs, 1000, 42)
+    for sample in range(3):
+        generator.generate(sample)
+    assert all(np.array_equal(a, b) for a, b in zip(first, generator.generate(3)))
+
+def test_unseeded_arguments_report_their_seed():
+    generator = ArgumentGenerator(specs, 1000)
+    values = [np.copy(v) for v in generator.generate(0)]
+    assert all(np.array_equal(a, b) for a, b in zip(values, generate(generator.seed, 0)))
+
+def test_argument_values():
+    floats, scalar, uints, chars, vectors = ArgumentGenerator(specs, 1000, 0).generate(0)
+    assert floats.dtype == np.float32 and floats.shape == (1000,)
+    assert -1000 <= floats.min() and floats.max() < 1000
+    assert isinstance(scalar, np.int32) and -1000 <= scalar < 1000
+    assert 0 <= uints.min() and uints.max() < 1000
+    # the values are limited by their type as well
+    assert chars.min() >= -128 and chars.max() <= 127 and chars.max() > 100
+    assert vectors.shape == (100,)
+    assert all((vectors[field] != 0).any() for field in 'xyzw')
+
+def test_unsupported_argument_type():
+    with pytest.raises(TypeError, match='bool'):
+        ArgumentGenerator([(np.bool_, 10)], 1000, 0).generate(0)
+
+def test_inputs(tmp_path):
+
+    from oclude import profile_opencl_kernel
+    from oclude.utils import load_inputs, get_inputs_fingerprint
+
+    a = np.zeros(GSIZE, dtype=cltypes.float4)
+    a['x'] = np.arange(GSIZE) + 1
+    np.save(tmp_path / 'a.npy', a)
+    np.ones(GSIZE, dtype=cltypes.float4).tofile(tmp_path / 'b.raw')
+    np.zeros(GSIZE, dtype=cltypes.float4).tofile(tmp_path / 'c.raw')
+    with open(tmp_path / 'args.json', 'w') as f:
+        json.dump({'a': 'a.npy', 'b': str(tmp_path / 'b.raw'), 'c': 'c.raw'}, f)
+
+    inputs = load_inputs(str(tmp_path / 'args.json'))
+    assert inputs['a'] == str(tmp_path / 'a.npy')
+    assert np.array_equal(open_input(inputs['a'], cltypes.float4), a)
+    assert isinstance(open_input(inputs['b'], cltypes.float4), np.memmap)
+    assert open_input(3, cltypes.int)[0] == 3
+    with pytest.raises(ValueError):
+        open_input(inputs['a'], cltypes.float)
+    with pytest.raises(ValueError):
+        load_inputs({'a': 'missing.npy'})
+    # e.g. a truncated file
+    (tmp_path / 'empty.npy').touch()
+    with pytest.raises(ValueError):
+        open_input(str(tmp_path / 'empty.npy'), cltypes.float4)
+
+    # the kernel writes to c, but its input file is not modified
+    fingerprint = get_inputs_fingerprint(inputs)
+    result = profile_opencl_kernel(
+        file=os.path.join(testdir, 'toy_kernels', 'simplevec.cl'), kernel='vecadd',
+        gsize=GSIZE, lsize=LSIZE, timeit=True, samples=2, inputs=str(tmp_path / 'args.json')
+    )
+    assert len(result['results']) == 2
+    assert get_inputs_fingerprint(inputs) == fingerprint
+    assert not np.fromfile(tmp_path / 'c.raw', dtype=cltypes.float4)['x'].any()
+
+    # an input with fewer values than its buffer is an error
+    np.ones(GSIZE // 2, dtype=cltypes.float4).tofile(tmp_path / 'short.raw')
+    with open(tmp_path / 'short.json', 'w') as f:
+        json.dump({'b': 'short.raw'}, f)
+    kernelfile = os.path.join(testdir, 'toy_kernels', 'simplevec.cl')
+    _, error, retcode = run_command(f"oclude -f {kernelfile} -k vecadd -g {GSIZE} -l {LSIZE} --inputs {tmp_path / 'short.json'}")
+    assert retcode != 0
+    assert 'fewer values' in error
+
+def test_arguments_generated_in_place():
+    # e.g. into the mapped buffers of a device with host unified memory
+    out = [np.full(1000, 7, dtype=cltypes.float), None, np.empty(1000, dtype=cltypes.uint), None, np.empty(100, dtype=cltypes.float4)]
+    values = ArgumentGenerator(specs, 1000, 42).generate(3, out)
+    assert values[0] is out[0] and values[4] is out[4]
+    assert all(np.array_equal(a, b) for a, b in zip(values, generate(42, 3)))
+
+def test_buffer_sizes():
+
+    from oclude import profile_opencl_kernel
+    from oclude.utils import evaluate_size, get_arg_sizes
+
+    assert evaluate_size('gsize * gsize', gsize=64, lsize=None) == 4096
+    assert evaluate_size('min(gsize, 2**10) // lsize + 1', gsize=4096, lsize=128) == 9
+    assert get_arg_sizes(['temp=gsize*gsize', 'table = 256'], 16) == {'temp': 256, 'table': 256}
+    assert get_arg_sizes({'table': 256}, 16) == {'table': 256}
+    for expression in ['__import__("os").getpid()', 'gsize.real', 'lsize * 2', 'gsize / 3', 'gsize - 16', '2 ** 100', 'other']:
+        with pytest.raises(ValueError):
+            evaluate_size(expression, gsize=16, lsize=None)
+    with pytest.raises(ValueError):
+        get_arg_sizes(['temp'], 16)
+
+    result = profile_opencl_kernel(
+        file=os.path.join(testdir, 'toy_kernels', 'simplevec.cl'), kernel='vecadd',
+        gsize=GSIZE, lsize=LSIZE, timeit=True, arg_sizes=['c=2*gsize', 'b=min(gsize, lsize)']
+    )
+    assert len(result['results']) == 1
+    # local buffers fit in local memory
+    result = profile_opencl_kernel(
+        file=os.path.join(testdir, 'rodinia_kernels', 'backprop', 'backprop_kernel.cl'), kernel='bpnn_layerforward_ocl',
+        gsize=1 << 20, lsize=256, timeit=True
+    )
+    assert len(result['results']) == 1
@@ -0,0 +1,120 @@
+import pytest
+import os
+import json
+import subprocess as sp
+from oclude.utils.constants import instrumentationGetter
+from oclude.utils.metrics import get_group_imbalance, get_memory_traffic_report, get_roofline
+from oclude.utils.instrumentor import load_instrumentation_data
+
+def test_group_imbalance_balanced():
+    imbalance = get_group_imbalance([[2, 1], [2, 1], [2, 1], [2, 1]])
+    assert imbalance['work groups'] == 4
+    assert imbalance['mean'] == 3
+    assert imbalance['max/mean ratio'] == 1
+    assert imbalance['gini'] == pytest.approx(0)
+
+def test_group_imbalance_one_slow_group():
+    imbalance = get_group_imbalance([[1], [1], [1], [5]], slowest=2)
+    assert imbalance['max/mean ratio'] == pytest.approx(2.5)
+    assert imbalance['gini'] == pytest.approx(0.375)
+    assert imbalance['slowest groups'] == [(3, 5), (2, 1)]
+
+def test_load_instrumentation_data_inlined_calls():
+    record = {'functions': {
+        'helper': [{'counts': [['fadd', 1], ['float ops', 4], ['ret', 1]], 'calls': []}],
+        'k': [
+            {'counts': [['load global', 2], ['load global bytes', 20], ['call', 2], ['br', 1]], 'calls': [5, 7]},
+            {'counts': [['call', 1], ['ret', 1]], 'calls': [9]}
+        ]
+    }}
+    instrumentation = load_instrumentation_data(record, inline_lines=[7, 9])
+    assert instrumentation['helper'] == [[('fadd', 1), ('float ops', 4), ('ret', 1)]]
+    assert dict(instrumentation['k'][0]) == {'load global': 2, 'load global bytes': 20, 'call': 1, 'br': 1, 'retNOT': 1}
+    assert dict(instrumentation['k'][1]) == {'ret': 1, 'retNOT': 1}
+
+def test_memory_traffic_report():
+    memory_traffic = {'load global': 4096, 'store global': 2048, 'load local': 512, 'store private': 64}
+    report = get_memory_traffic_report(memory_traffic, float_ops=3072, device_time=0.5)
+    assert report['bytes per address space'] == {'private': 64, 'global': 6144, 'constant': 0, 'local': 512, 'callee': 0}
+    assert report['total bytes'] == 6720
+    assert report['arithmetic intensity'] == pytest.approx(0.5)
+    # 6144 bytes in 0.5 ms
+    assert report['achieved bandwidth'] == pytest.approx(6144 / 0.5e-3 / 1e9)
+
+def test_memory_traffic_report_no_global_traffic():
+    report = get_memory_traffic_report({'load private': 8}, float_ops=10)
+    assert report['arithmetic intensity'] is None
+    assert 'achieved bandwidth' not in report
+
+def test_roofline_memory_bound():
+    # 1e9 float ops and 4e9 bytes in 1 second, on a 100 GFLOP/s, 10 GB/s device
+    roofline = get_roofline(1e9, 4e9, 1000, peak_float_ops=100, peak_global_bandwidth=10)
+    assert roofline['bound'] == 'memory'
+    assert roofline['ridge point'] == pytest.approx(10)
+    assert roofline['attainable float ops'] == pytest.approx(2.5)
+    assert roofline['efficiency'] == pytest.approx(0.4)
+    assert roofline['headroom'] == pytest.approx(2.5)
+
+def test_roofline_compute_bound():
+    roofline = get_roofline(50e9, 1e9, 1000, peak_float_ops=100, peak_global_bandwidth=10)
+    assert roofline['bound'] == 'compute'
+    assert roofline['attainable float ops'] == pytest.approx(100)
+    assert roofline['efficiency'] == pytest.approx(0.5)
+
+fused_multiply_add_ir = '''\
+target triple = "spir64"
+
+define spir_kernel void @k(float %a, <4 x float> %v, float addrspace(1)* %out, <4 x float> addrspace(1)* %vout) !dbg !5 {
+  %1 = call float @llvm.fmuladd.f32(float %a, float %a, float %a), !dbg !7
+  store float %1, float addrspace(1)* %out, align 4, !dbg !7
+  %2 = call <4 x float> @llvm.fma.v4f32(<4 x float> %v, <4 x float> %v, <4 x float> %v), !dbg !8
+  store <4 x float> %2, <4 x float> addrspace(1)* %vout, align 16, !dbg !8
+  ret void, !dbg !8
+}
+
+declare float @llvm.fmuladd.f32(float, float, float)
+declare <4 x float> @llvm.fma.v4f32(<4 x float>, <4 x float>, <4 x float>)
+
+!llvm.dbg.cu = !{!0}
+!llvm.module.flags = !{!2, !3}
+!0 = distinct !DICompileUnit(language: DW_LANG_OpenCL, file: !1, emissionKind: FullDebug)
+!1 = !DIFile(filename: "k.cl", directory: "/tmp")
+!2 = !{i32 2, !"Dwarf Version", i32 5}
+!3 = !{i32 2, !"Debug Info Version", i32 3}
+!4 = !DISubroutineType(types: !{null})
+!5 = distinct !DISubprogram(name: "k", scope: !1, file: !1, line: 1, type: !4, scopeLine: 1, spFlags: DISPFlagDefinition, unit: !0)
+!7 = !DILocation(line: 2, column: 5, scope: !5)
+!8 = !DILocation(line: 3, column: 5, scope: !5)
+'''
+
+def stream_records(*records):
+    if not os.path.isfile(instrumentationGetter):
+        pytest.skip('the instrumentation parser is not built')
+    parser = sp.run([instrumentationGetter, '--stream'], input=b''.join(records), stdout=sp.PIPE, stderr=sp.DEVNULL)
+    return [json.loads(line) for line in parser.stdout.splitlines()]
+
+def stream_record(llvm_bitcode):
+    data = llvm_bitcode.encode('utf-8')
+    return f'{len(data)}\n'.encode('ascii') + data
+
+def test_fused_multiply_add_intrinsics():
+    record, = stream_records(stream_record(fused_multiply_add_ir))
+    # one multiply and one add per lane, for a scalar and a float4
+    assert dict(record['functions']['k'][0]['counts'])['float ops'] == 2 + 2 * 4
+
+def test_stream_malformed_header():
+    records = stream_records(b'not a size\n', b'99999999999999999999999\n', stream_record(fused_multiply_add_ir))
+    assert len(records) == 3
+    assert 'error' in records[0] and 'error' in records[1]
+    # the parser keeps reading after a malformed header
+    assert 'k' in records[2]['functions']
+
+def test_roofline_zero_time_and_bandwidth():
+    roofline = get_roofline(1e9, 4e9, 0, peak_float_ops=100, peak_global_bandwidth=10)
+    assert roofline['bound'] == 'memory'
+    assert roofline['achieved float ops'] is None and roofline['achieved bandwidth'] is None
+    assert roofline['efficiency'] is None and roofline['headroom'] is None
+    roofline = get_roofline(1e9, 4e9, 1000, peak_float_ops=100, peak_global_bandwidth=0)
+    assert roofline['ridge point'] is None
+    assert roofline['bound'] == 'memory'
+    assert roofline['efficiency'] is None
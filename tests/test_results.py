@@ -0,0 +1,97 @@
+import pytest
+import os
+import json
+import numpy as np
+from testutils import *
+
+kernelfile = os.path.join(testdir, 'toy_kernels', 'simplevec.cl')
+
+@pytest.fixture
+def results_db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'results.sqlite')
+    monkeypatch.setenv('OCLUDE_RESULTS_DB', path)
+    return path
+
+def fake_result(kernel, samples):
+    return {
+        'original file':      kernelfile,
+        'instrumented file':  None,
+        'kernel':             kernel,
+        'results':            [
+            {
+                'instcounts':     {'store global': 10 * i, 'load global': 20 * i},
+                'memory traffic': {'store global': 40 * i},
+                'float ops':      i,
+                'timeit':         {'hostcode': 2.0 * i, 'device': 1.0 * i, 'transfer': 1.0 * i}
+            }
+            for i in range(1, samples + 1)
+        ],
+        'profiling overhead': 0.5
+    }
+
+def test_record_and_query(results_db):
+
+    from oclude.utils import ResultsStore, query_results
+
+    store = ResultsStore()
+    for gsize in [1024, 2048, 4096]:
+        store.record_run({'file': kernelfile, 'gsize': gsize, 'lsize': 128, 'device': 'dev', 'seed': 1}, fake_result('vecadd', 3))
+    store.record_run({'file': kernelfile, 'gsize': 1024, 'lsize': 128, 'device': 'other', 'seed': 1}, fake_result('dotprod', 2))
+    store.close()
+
+    runs = query_results(kernel='vecadd')
+    some_runs = query_results(kernel='vecadd', gsize=(1024, 2048))
+    listed_runs = query_results(gsize=[1024, 4096], device='dev')
+    samples = query_results(per_sample=True, kernel='vecadd', gsize=2048)
+    records = query_results(frame='records', kernel='dotprod')
+
+    assert len(runs) == 3
+    assert list(runs['gsize']) == [1024, 2048, 4096]
+    assert np.allclose(runs['mean device time'], 2.0)
+    assert np.allclose(runs['mean instructions'], 60.0)
+    assert len(some_runs) == 2
+    assert list(listed_runs['gsize']) == [1024, 4096]
+    assert list(samples['sample']) == [0, 1, 2]
+    assert list(samples['store global']) == [10, 20, 30]
+    assert list(samples['store global bytes']) == [40, 80, 120]
+    # counters that were not measured are missing
+    assert np.isnan(samples['load local']).all()
+    assert records[0]['kernel'] == 'dotprod' and records[0]['samples'] is None and records[0]['device'] == 'other'
+
+    with pytest.raises(ValueError):
+        query_results(platform='any')
+
+def test_results_store_of_runs(results_db, tmp_path):
+
+    from oclude import profile_opencl_kernel, query_results
+
+    result = profile_opencl_kernel(file=kernelfile, kernel='vecadd', gsize=GSIZE, lsize=LSIZE, timeit=True, samples=3, results_db=True)
+    # runs are only recorded if requested
+    profile_opencl_kernel(file=kernelfile, kernel='vecadd', gsize=GSIZE, lsize=LSIZE, timeit=True, samples=3)
+    _, _, retcode1 = run_command(f'oclude -f {kernelfile} -k vecadd -g {2 * GSIZE} -l {LSIZE} -t --seed 7 --results-db')
+
+    _, error3, retcode3 = run_command(f'oclude -f {kernelfile} -k vecadd -g {GSIZE} -l {LSIZE} --seed -1')
+
+    runs = query_results()
+    seeded_runs = query_results(seed=7)
+    samples = query_results(per_sample=True, gsize=GSIZE)
+
+    json_file = str(tmp_path / 'runs.json')
+    output, _, retcode2 = run_command(f'oclude results query -g {2 * GSIZE} --json {json_file}')
+    with open(json_file, 'r') as f:
+        dumped_runs = json.load(f)
+
+    assert retcode1 == 0
+    assert len(runs) == 2
+    assert list(runs['gsize']) == [GSIZE, 2 * GSIZE]
+    # the seeds (128-bit, if drawn for unseeded runs) are recorded as text
+    assert runs['seed'][0] == str(result['seed'])
+    assert runs['seed'][1] == '7'
+    assert list(seeded_runs['gsize']) == [2 * GSIZE]
+    assert retcode3 != 0 and 'non-negative' in error3
+    assert all(runs['device'] != None)
+    assert len(samples) == 3
+    assert not np.isnan(samples['device time']).any()
+    assert retcode2 == 0
+    assert len(output.splitlines()) == 2
+    assert [run['gsize'] for run in dumped_runs] == [2 * GSIZE]